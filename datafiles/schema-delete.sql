@@ -1,6 +1,8 @@
 -- OpenNSA SQL Schema (PostgreSQL) DELETEs
 -- This is mainly for development
 
+DELETE FROM connection_events;
+DELETE FROM outbox;
 DELETE FROM generic_backend_connections;
 DELETE FROM sub_connections;
 DELETE FROM service_connections;
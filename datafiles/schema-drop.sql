@@ -1,6 +1,8 @@
 -- OpenNSA SQL Schema (PostgreSQL) DROPs
 -- This is mainly for development
 
+DROP TABLE connection_events;
+DROP TABLE outbox;
 DROP TABLE generic_backend_connections;
 DROP TABLE sub_connections;
 DROP TABLE service_connections;
@@ -73,6 +73,37 @@ CREATE TABLE sub_connections (
     UNIQUE (provider_nsa, connection_id)
 );
 
+CREATE INDEX sub_connections_service_connection_idx ON sub_connections (service_connection_id);
+
+
+-- journal of connection state transitions, append only
+-- connection_table is the table of the connection (service_connections or generic_backend_connections)
+CREATE TABLE connection_events (
+    id                      bigserial                   PRIMARY KEY,
+    connection_table        text                        NOT NULL,
+    connection_id           text                        NOT NULL,
+    event_time              timestamp                   NOT NULL,
+    old_reservation_state   text                        NOT NULL,
+    old_provision_state     text                        NOT NULL,
+    old_lifecycle_state     text                        NOT NULL,
+    reservation_state       text                        NOT NULL,
+    provision_state         text                        NOT NULL,
+    lifecycle_state         text                        NOT NULL
+);
+
+CREATE INDEX connection_events_connection_idx ON connection_events (connection_id, event_time);
+CREATE INDEX connection_events_time_idx ON connection_events (event_time);
+
+
+-- confirmations and notifications waiting to be delivered to requesters
+CREATE TABLE outbox (
+    id                      bigserial                   PRIMARY KEY,
+    requester_url           text                        NOT NULL,
+    soap_action             text                        NOT NULL,
+    payload                 bytea                       NOT NULL,
+    created                 timestamp                   NOT NULL
+);
+
 
 -- move this into the backend sometime
 CREATE TABLE generic_backend_connections (
@@ -110,6 +141,7 @@ CREATE TABLE generic_backend_connections (
 -- INSERT INTO backend_connection_id (connection_id) VALUES (190000)  ON CONFLICT DO NOTHING;
 -- Generate new id with:
 -- UPDATE backend_connection_id SET connection_id = connection_id + 1 RETURNING connection_id;
+-- OpenNSA reserves blocks of ids (connection_id + block size), so there can be gaps in the sequence
 CREATE TABLE backend_connection_id (
     id                      integer                     PRIMARY KEY NOT NULL DEFAULT(1) CHECK (id = 1),
     connection_id           serial                      NOT NULL
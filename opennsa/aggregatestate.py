@@ -0,0 +1,161 @@
+"""
+Aggregated state of the sub connections of service connections.
+
+The aggregator emits a confirmation or notification upwards, when all the sub
+connections of a connection have reached a state (e.g., all provisioned). To
+avoid loading and going through all sub connections on every confirmation,
+the number of sub connections in each state is counted per connection, and
+the counters are updated when a sub connection changes.
+
+The counters are built from the database the first time they are needed for
+a connection (e.g., after a restart), and kept in a size bounded cache.
+"""
+
+import collections
+
+from twisted.python import failure
+from twisted.internet import defer
+
+from opennsa.shared import lrucache
+
+
+# sub connection attributes which are counted
+ATTRIBUTES = ('reservation_state', 'provision_state', 'lifecycle_state', 'data_plane_active', 'data_plane_consistent')
+
+
+
+class AggregateState:
+    """
+    Counters for the sub connections of a single service connection.
+    """
+    def __init__(self):
+        self.sub_connections = {} # (provider_nsa, connection_id) -> (attribute values, data plane version)
+        self.counters = dict( [ (attribute, collections.Counter()) for attribute in ATTRIBUTES ] )
+        self.versions = collections.Counter()
+
+
+    def update(self, sub_conn):
+        """
+        Add a sub connection, or update the counters with its current state.
+        """
+        key = (sub_conn.provider_nsa, sub_conn.connection_id)
+        entry = ( tuple( [ getattr(sub_conn, attribute) for attribute in ATTRIBUTES ] ), sub_conn.data_plane_version or 0)
+
+        old_entry = self.sub_connections.get(key)
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            self._count(old_entry, -1)
+        self.sub_connections[key] = entry
+        self._count(entry, 1)
+
+
+    def _count(self, entry, n):
+        values, version = entry
+        for attribute, value in zip(ATTRIBUTES, values):
+            _add(self.counters[attribute], value, n)
+        _add(self.versions, version, n)
+
+
+    @property
+    def total(self):
+        return len(self.sub_connections)
+
+
+    def count(self, attribute, value):
+        return self.counters[attribute][value]
+
+
+    def all(self, attribute, value):
+        return self.counters[attribute][value] == len(self.sub_connections)
+
+
+    def dataPlaneStatus(self):
+        # (active, version, consistent), consistent requires all sub connections to be active, or all to be inactive
+        n_active = self.count('data_plane_active', True)
+        active      = n_active == self.total
+        version     = max(self.versions) if self.versions else 0
+        consistent  = self.all('data_plane_consistent', True) and n_active in (0, self.total)
+        return (active, version, consistent)
+
+
+
+def _add(counter, value, n):
+    count = counter[value] + n
+    if count:
+        counter[value] = count
+    else:
+        del counter[value]
+
+
+
+class AggregateStates:
+    """
+    Aggregated state for service connections, keyed by the service connection key.
+    """
+    def __init__(self, load_sub_connections, max_size):
+        # load_sub_connections is called with a service connection key, returns a deferred firing with its sub connections
+        self.load_sub_connections = load_sub_connections
+        self.states = lrucache.LRUCache(max_size)
+        self.loading = {} # service connection key -> [ Deferred ], calls waiting for the state to be loaded
+        self.updated = {} # service connection key -> [ sub connection ], updated while the state is loaded
+
+
+    def update(self, sub_conn):
+        """
+        Update the counters for a changed (or new) sub connection. If the state
+        of the connection has not been loaded, it is left to the load. If it
+        is being loaded, the update is applied once it is, as the load may have
+        read the sub connection before the change.
+        """
+        service_connection_key = sub_conn.service_connection_id
+        if service_connection_key in self.loading:
+            self.updated.setdefault(service_connection_key, []).append(sub_conn)
+            return
+        aggr = self.states.get(service_connection_key)
+        if aggr is not None:
+            aggr.update(sub_conn)
+
+
+    def get(self, service_connection_key):
+        """
+        Get the aggregated state of a connection. Returns a deferred.
+        """
+        aggr = self.states.get(service_connection_key)
+        if aggr is not None:
+            return defer.succeed(aggr)
+
+        d = defer.Deferred()
+        if service_connection_key in self.loading:
+            self.loading[service_connection_key].append(d)
+        else:
+            self.loading[service_connection_key] = [ d ]
+            ld = defer.maybeDeferred(self.load_sub_connections, service_connection_key)
+            ld.addBoth(self._loaded, service_connection_key)
+        return d
+
+
+    def _loaded(self, result, service_connection_key):
+        waiting = self.loading.pop(service_connection_key)
+        updated = self.updated.pop(service_connection_key, [])
+        if isinstance(result, failure.Failure):
+            for d in waiting:
+                d.errback(result)
+            return
+
+        aggr = AggregateState()
+        for sub_conn in result:
+            aggr.update(sub_conn)
+        for sub_conn in updated:
+            aggr.update(sub_conn)
+        self.states.put(service_connection_key, aggr)
+        for d in waiting:
+            d.callback(aggr)
+
+
+    def evict(self, service_connection_key):
+        self.states.evict(service_connection_key)
+
+
+    def stats(self):
+        return self.states.stats()
@@ -9,15 +9,20 @@ import datetime
 from zope.interface import implementer
 
 from twisted.python import log
-from twisted.internet import defer
+from twisted.internet import reactor, defer
 
 from opennsa.interface import INSIProvider, INSIRequester
-from opennsa import error, nsa, state, database, constants as cnt
+from opennsa import error, nsa, state, database, aggregatestate, constants as cnt
+from opennsa.shared import lrucache, keyedlock, pendingcalls
 
 
 
 LOG_SYSTEM = 'Aggregator'
 
+CONNECTION_CACHE_SIZE       = 1000
+SUB_CONNECTION_CACHE_SIZE   = 2000
+QUERY_RECURSIVE_TIMEOUT     = 30    # seconds to wait for children to reply to queryRecursive, before emitting a partial result
+
 
 
 def shortLabel(label):
@@ -46,6 +51,17 @@ def _logErrorResponse(err, connection_id, provider_nsa, action):
 
 
 
+def _aggregateDataPlaneStatus(sub_conns):
+    # (active, version, consistent) of a connection, from its sub connections
+    if len(sub_conns) == 0: # apparently this can happen
+        return (False, 0, False)
+    aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
+    aggr_version    = max( [ sc.data_plane_version or 0 for sc in sub_conns ] ) # can be None otherwise
+    aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
+    return (aggr_active, aggr_version, aggr_consistent)
+
+
+
 def _createAggregateException(connection_id, action, results, provider_urns, default_error=error.InternalServerError):
 
     failures = [ conn for success,conn in results if not success ]
@@ -77,16 +93,26 @@ class Aggregator:
         self.policies           = policies
         self.plugin             = plugin
 
-        self.reservations       = {} # correlation_id -> info
+        self.reservations       = pendingcalls.PendingCalls() # correlation_id -> info, grouped by service connection id
         self.notification_id    = 0
 
         # db orm cache, needed to avoid concurrent updates stepping on each other
-        self.db_connections = {}
-        self.db_sub_connections = {}
+        # connections in use are never dropped from it, so all handlers share the same object
+        # terminated connections are not cached, as they are not updated anymore
+        self.db_connections     = lrucache.LRUCache(CONNECTION_CACHE_SIZE)       # connection_id -> ServiceConnection
+        self.db_sub_connections = lrucache.LRUCache(SUB_CONNECTION_CACHE_SIZE)   # (provider_nsa, connection_id) -> SubConnection
+
+        # counters of sub connection states, so confirmations can be aggregated without loading all sub connections
+        self.aggregate_states = aggregatestate.AggregateStates(self.getSubConnectionsByConnectionKey, CONNECTION_CACHE_SIZE)
+
+        # requests for a connection are run one at the time
+        self.connection_locks = keyedlock.KeyedLock()
 
         # these are for query recursive, due to nsi being extremely crappy design
-        self.query_requests = {}
-        self.query_calls = {}
+        self.query_requests = pendingcalls.PendingCalls() # cb correlation_id -> query request info
+        self.query_calls    = pendingcalls.PendingCalls() # correlation_id -> { connection_id -> sub connection key }, grouped by cb correlation_id
+
+        self.clock = reactor
 
 
     def getNotificationId(self):
@@ -103,11 +129,17 @@ class Aggregator:
             # we should get 0 or 1 here since connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No connection with id %s' % connection_id) )
-            self.db_connections[connection_id] = connections[0]
-            return connections[0]
+            conn = connections[0]
+            cached_conn = self.db_connections.get(connection_id) # loaded by a concurrent request
+            if cached_conn is not None:
+                return cached_conn
+            if conn.lifecycle_state != state.TERMINATED:
+                self.db_connections.put(connection_id, conn)
+            return conn
 
-        if connection_id in self.db_connections:
-            return defer.succeed(self.db_connections[connection_id])
+        conn = self.db_connections.get(connection_id)
+        if conn is not None:
+            return defer.succeed(conn)
 
         d = database.ServiceConnection.findBy(connection_id=connection_id)
         d.addCallback(gotResult)
@@ -134,35 +166,58 @@ class Aggregator:
             # we should get 0 or 1 here since provider_nsa + connection id is unique
             if len(connections) == 0:
                 return defer.fail( error.ConnectionNonExistentError('No sub connection with connection id %s at provider %s' % (connection_id, provider_nsa) ) )
-            self.db_sub_connections[connection_id] = connections[0]
-            return connections[0]
+            return self._cachedSubConnection(connections[0])
 
-        if connection_id in self.db_sub_connections:
-            return defer.succeed(self.db_sub_connections[connection_id])
+        sub_conn = self.db_sub_connections.get( (provider_nsa, connection_id) )
+        if sub_conn is not None:
+            return defer.succeed(sub_conn)
 
         d = database.SubConnection.findBy(provider_nsa=provider_nsa, connection_id=connection_id)
         d.addCallback(gotResult)
         return d
 
 
+    def _cachedSubConnection(self, sub_conn):
+        # return the cached object for a loaded sub connection, or cache the loaded one
+        key = (sub_conn.provider_nsa, sub_conn.connection_id)
+        cached_sub_conn = self.db_sub_connections.get(key)
+        if cached_sub_conn is not None:
+            return cached_sub_conn
+        if sub_conn.lifecycle_state != state.TERMINATED:
+            self.db_sub_connections.put(key, sub_conn)
+        return sub_conn
+
+
     def getSubConnectionsByConnectionKey(self, service_connection_key):
 
-        def gotResult(rows):
-            def gotSubConns(results):
-                if all( [ r[0] for r in results ] ):
-                    return [ r[1] for r in results ]
-                else:
-                    return defer.fail( ValueError('Error retrieving one or more subconnections: %s' % str(results)) )
+        def gotResult(sub_conns):
+            return [ self._cachedSubConnection(sc) for sc in sub_conns ]
+
+        d = database.SubConnection.find(where=['service_connection_id = ?', service_connection_key], orderby='order_id')
+        d.addCallback(gotResult)
+        return d
+
+
+    def getSubConnectionsByConnectionKeys(self, service_connection_keys):
+        """
+        Load the sub connections of several service connections in one query.
+        Returns a deferred firing with a dict: service connection key -> [ SubConnection ]
+        """
+        def gotResult(sub_conns):
+            result = { key : [] for key in service_connection_keys }
+            for sc in sub_conns:
+                result[sc.service_connection_id].append( self._cachedSubConnection(sc) )
+            return result
 
-            defs = [ self.getSubConnection(r['provider_nsa'], r['connection_id']) for r in rows ]
-            return defer.DeferredList(defs).addCallback(gotSubConns)
+        if not service_connection_keys:
+            return defer.succeed({})
 
-        dbconfig = database.Registry.getConfig()
-        d = dbconfig.select('sub_connections', where=['service_connection_id = ?', service_connection_key], select='provider_nsa, connection_id')
+        d = database.SubConnection.find(where=['service_connection_id IN ?', tuple(service_connection_keys)], orderby='order_id')
         d.addCallback(gotResult)
         return d
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserve(self, header, connection_id, global_reservation_id, description, criteria, request_info=None):
 
@@ -384,14 +439,14 @@ class Aggregator:
             sd = nsa.Point2PointService(link.src_stp, link.dst_stp, conn.bandwidth, sd.directionality, sd.symmetric)
 
             # save info for db saving
-            self.reservations[c_header.correlation_id] = {
+            self.reservations.add(c_header.correlation_id, conn.id, {
                                                         'provider_nsa'  : provider_urn,
                                                         'service_connection_id' : conn.id,
                                                         'order_id'       : idx,
                                                         'source_network' : link.src_stp.network,
                                                         'source_port'    : link.src_stp.port,
                                                         'dest_network'   : link.dst_stp.network,
-                                                        'dest_port'      : link.dst_stp.port }
+                                                        'dest_port'      : link.dst_stp.port } )
 
             crt = nsa.Criteria(criteria.revision, criteria.schedule, sd)
 
@@ -399,7 +454,7 @@ class Aggregator:
             d = provider.reserve(c_header, sub_connection_id, conn.global_reservation_id, conn.description, crt, request_info)
             d.addErrback(_logErrorResponse, connection_id, provider_urn, 'reserve')
 
-            conn_info.append( (d, link.src_stp.network) )
+            conn_info.append( (d, link.src_stp.network, c_header.correlation_id) )
 
             # Don't bother trying to save connection here, wait for reserveConfirmed
 
@@ -412,12 +467,17 @@ class Aggregator:
             defer.returnValue(connection_id)
 
         else:
+            # requests which were not acked will not be confirmed either
+            for (success,_),(_,_,correlation_id) in zip(results, conn_info):
+                if not success and correlation_id in self.reservations:
+                    self.reservations.pop(correlation_id)
+
             # I think this is out of spec, the aggregator shouldn't do anything here...
             # terminate non-failed connections
             # currently we don't try and be too clever about cleaning, just do it, and switch state
             yield state.terminating(conn)
             defs = []
-            reserved_connections = [ (sc_id, network_urn) for (success,sc_id),(_,network_urn) in zip(results, conn_info) if success ]
+            reserved_connections = [ (sc_id, network_urn) for (success,sc_id),(_,network_urn,_) in zip(results, conn_info) if success ]
             for (sc_id, network_urn) in reserved_connections:
 
                 provider = self.provider_registry.getProvider(network_urn)
@@ -432,6 +492,8 @@ class Aggregator:
             dl = defer.DeferredList(defs)
             yield dl
             yield state.terminated(conn)
+            self.db_connections.evict(conn.connection_id)
+            self.aggregate_states.evict(conn.id)
 
             # construct provider nsa urns, so we can produce a good error message
             provider_urns = [ ci[1] for ci in conn_info ]
@@ -439,6 +501,7 @@ class Aggregator:
             raise err
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserveCommit(self, header, connection_id, request_info=None):
 
@@ -478,6 +541,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'committed', results, provider_urns, error.ConnectionError)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserveAbort(self, header, connection_id, request_info=None):
 
@@ -497,6 +561,7 @@ class Aggregator:
 
         for sc in sub_connections:
             save_defs.append( state.reserveAbort(sc) )
+            self.aggregate_states.update(sc)
             provider = self.provider_registry.getProvider(sc.source_network)
             header = nsa.NSIHeader(self.nsa_.urn(), sc.provider_nsa, security_attributes=header.security_attributes)
             d = provider.reserveAbort(header, sc.connection_id, request_info)
@@ -519,6 +584,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'aborted', results, provider_urns, error.ConnectionError)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def provision(self, header, connection_id, request_info=None):
 
@@ -541,6 +607,7 @@ class Aggregator:
             # only bother saving stuff to db if the state is actually changed
             if sc.provision_state != state.PROVISIONING:
                 save_defs.append( state.provisioning(sc) )
+                self.aggregate_states.update(sc)
         if save_defs:
             yield defer.DeferredList(save_defs) #, consumeErrors=True)
 
@@ -563,6 +630,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'provision', results, provider_urns, error.ConnectionError)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def release(self, header, connection_id, request_info=None):
 
@@ -583,6 +651,7 @@ class Aggregator:
 
         for sc in sub_connections:
             save_defs.append( state.releasing(sc) )
+            self.aggregate_states.update(sc)
         yield defer.DeferredList(save_defs) #, consumeErrors=True)
 
         for sc in sub_connections:
@@ -607,6 +676,7 @@ class Aggregator:
             raise _createAggregateException(connection_id, 'release', results, provider_urns, error.ConnectionError)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def terminate(self, header, connection_id, request_info=None):
 
@@ -646,6 +716,24 @@ class Aggregator:
 
 
 
+    def _createQuerySummaryResult(self, conn, data_plane_status):
+        # largely copied from genericbackend, merge later
+        c = conn
+
+        source_stp  = nsa.STP(c.source_network, c.source_port, c.source_label)
+        dest_stp    = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
+        schedule    = nsa.Schedule(c.start_time, c.end_time)
+        sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
+        criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
+
+        states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
+        notification_id = self.getNotificationId()
+        result_id = 0
+
+        return nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
+                                  self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
+
+
     @defer.inlineCallbacks
     def querySummary(self, header, connection_ids=None, global_reservation_ids=None, request_info=None):
 
@@ -653,38 +741,23 @@ class Aggregator:
 
         try:
             if connection_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND connection_id IN ?', header.requester_nsa, tuple(connection_ids) ] )
+                where = ['requester_nsa = ? AND connection_id IN ?', header.requester_nsa, tuple(connection_ids) ]
             elif global_reservation_ids:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ? AND global_reservation_ids IN ?', header.requester_nsa, tuple(global_reservation_ids) ] )
+                where = ['requester_nsa = ? AND global_reservation_ids IN ?', header.requester_nsa, tuple(global_reservation_ids) ]
             else:
-                conns = yield database.ServiceConnection.find(where=['requester_nsa = ?', header.requester_nsa ] )
+                where = ['requester_nsa = ?', header.requester_nsa ]
 
-            # largely copied from genericbackend, merge later
+            # connections are loaded in pages, with the sub connections of a page in one query,
+            # each page is turned into results before the next is loaded, so the connections can be released
             reservations = []
-            for c in conns:
-
-                source_stp  = nsa.STP(c.source_network, c.source_port, c.source_label)
-                dest_stp    = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
-                schedule    = nsa.Schedule(c.start_time, c.end_time)
-                sd          = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None)
-                criteria    = nsa.QueryCriteria(c.revision, schedule, sd)
-
-                sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-                if len(sub_conns) == 0: # apparently this can happen
-                    data_plane_status = (False, 0, False)
-                else:
-                    aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                    aggr_version    = max( [ sc.data_plane_version or 0 for sc in sub_conns ] ) # py3 - max fails on None
-                    aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                    data_plane_status = (aggr_active, aggr_version, aggr_consistent)
-
-                states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
-                notification_id = self.getNotificationId()
-                result_id = 0
-
-                ci = nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
-                                        self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
-                reservations.append(ci)
+            after_id = 0
+            while True:
+                page = yield database.findConnections(where, after_id)
+                sub_conns = yield self.getSubConnectionsByConnectionKeys( [ c.id for c in page ] )
+                reservations.extend( self._createQuerySummaryResult(c, _aggregateDataPlaneStatus(sub_conns[c.id])) for c in page )
+                if len(page) < database.SUMMARY_PAGE_SIZE:
+                    break
+                after_id = page[-1].id
 
             self.parent_requester.querySummaryConfirmed(header, reservations)
 
@@ -695,7 +768,7 @@ class Aggregator:
 
 
     @defer.inlineCallbacks
-    def queryRecursive(self, header, connection_ids, global_reservation_ids, request_info=None):
+    def queryRecursive(self, header, connection_ids, global_reservation_ids=None, request_info=None):
 
         log.msg('QueryRecursive request from %s. CID: %s. GID: %s' % (header.requester_nsa, connection_ids, global_reservation_ids), system=LOG_SYSTEM)
 
@@ -707,118 +780,161 @@ class Aggregator:
         if not connection_ids:
             raise error.MissingParameterError("At least one connection id must be specified, refusing to do recursive query for all connections")
 
-        # because segmenting the requests is a PITA
-        if len(connection_ids) > 1:
-            raise error.UnsupportedParameter("Can only perform queryRecursive for a single connection id.")
-
         try:
-            conn = yield self.getConnection(connection_ids[0])
+            conns = yield defer.gatherResults( [ self.getConnection(cid) for cid in connection_ids ], consumeErrors=True)
+        except defer.FirstError as e:
+            e.subFailure.raiseException()
 
-            sub_connections = yield self.getSubConnectionsByConnectionKey(conn.id)
+        sub_conns_by_key = yield self.getSubConnectionsByConnectionKeys( [ conn.id for conn in conns ] )
+        sub_connections = [ sub_conns_by_key[conn.id] for conn in conns ]
 
-            cb_header = nsa.NSIHeader(header.requester_nsa, self.nsa_.urn(), header.correlation_id, reply_to=header.reply_to, security_attributes=header.security_attributes)
-            self.query_requests[cb_header.correlation_id]  = (cb_header, conn, len(sub_connections) )
-
-            defs = []
-            for sc in sub_connections:
+        # one query per child provider, for all the sub connections at it
+        provider_queries = {} # id(provider) -> (provider, provider_nsa, { connection_id -> sub connection key } )
+        for sub_conns in sub_connections:
+            for sc in sub_conns:
                 provider = self.provider_registry.getProvider(sc.source_network)
-                sch = nsa.NSIHeader(self.nsa_.urn(), sc.provider_nsa, security_attributes=header.security_attributes)
-                d = provider.queryRecursive(sch, [ sc.connection_id ] , None, request_info)
-                d.addErrback(_logErrorResponse, 'queryRecursive', sc.provider_nsa, 'queryRecursive')
-                defs.append(d)
+                if not id(provider) in provider_queries:
+                    provider_queries[id(provider)] = (provider, sc.provider_nsa, {})
+                provider_queries[id(provider)][2][sc.connection_id] = (sc.provider_nsa, sc.connection_id)
+
+        cb_header = nsa.NSIHeader(header.requester_nsa, self.nsa_.urn(), header.correlation_id, reply_to=header.reply_to, security_attributes=header.security_attributes)
+        query_request = {
+            'header'        : cb_header,
+            'connections'   : list(zip(conns, sub_connections)),
+            'results'       : {},   # sub connection key -> ConnectionInfo
+            'calls'         : [],   # correlation ids of the child queries
+            'timeout'       : self.clock.callLater(QUERY_RECURSIVE_TIMEOUT, self._queryRecursiveTimeout, cb_header.correlation_id)
+        }
+        self.query_requests.add(cb_header.correlation_id, tuple(connection_ids), query_request)
+
+        # register all calls before sending any, so the outstanding count is right if a local provider replies right away
+        calls = []
+        for provider, provider_nsa, sub_keys in provider_queries.values():
+            sch = nsa.NSIHeader(self.nsa_.urn(), provider_nsa, security_attributes=header.security_attributes)
+            self.query_calls.add(sch.correlation_id, cb_header.correlation_id, sub_keys)
+            query_request['calls'].append(sch.correlation_id)
+            calls.append( (provider, provider_nsa, sch, list(sub_keys)) )
+
+        defs = []
+        for provider, provider_nsa, sch, sub_connection_ids in calls:
+            d = provider.queryRecursive(sch, sub_connection_ids, None, request_info)
+            d.addErrback(_logErrorResponse, 'queryRecursive', provider_nsa, 'queryRecursive')
+            defs.append(d)
+
+        results = yield defer.DeferredList(defs, consumeErrors=True)
+        successes = [ r[0] for r in results ]
 
-                self.query_calls[sch.correlation_id] = (cb_header.correlation_id, None)
+        # children which did not ack will not reply
+        for success, (_, _, sch, _) in zip(successes, calls):
+            if not success and sch.correlation_id in self.query_calls:
+                self.query_calls.pop(sch.correlation_id)
 
-            results = yield defer.DeferredList(defs, consumeErrors=True)
-            successes = [ r[0] for r in results ]
-            if all(successes):
-                # this just means we got an ack from all children
-                defer.returnValue(None)
+        if calls and not any(successes):
+            log.msg('QueryRecursive failure. None of %i providers acked the query' % len(defs), system=LOG_SYSTEM)
+            # no result will be emitted, clear out the temporary state
+            if cb_header.correlation_id in self.query_requests:
+                self._clearQueryRecursive(cb_header.correlation_id)
+            provider_urns = [ c[1] for c in calls ]
+            raise _createAggregateException('', 'queryRecursive', results, provider_urns, error.ConnectionError)
 
-            else:
-                n_success = sum( [ 1 for s in successes if s ] )
-                log.msg('QueryRecursive failure. %i of %i connections successfully replied' % (n_success, len(defs)), system=LOG_SYSTEM)
-                # we should really clear out the temporary state here...
-                provider_urns = [ sc.provider_nsa for sc in sub_connections ]
-                raise _createAggregateException('', 'queryRecursive', results, provider_urns, error.ConnectionError)
-
-        except ValueError as e:
-            log.msg('Error during queryRecursive request: %s' % str(e), system=LOG_SYSTEM)
-            raise e
+        if not all(successes):
+            log.msg('QueryRecursive: %i of %i providers acked the query, result will be partial' % (sum(successes), len(defs)), system=LOG_SYSTEM)
 
+        # if there was nothing to wait for, or all the children replied while we were waiting for acks, emit now
+        if cb_header.correlation_id in self.query_requests and self.query_calls.outstanding(cb_header.correlation_id) == 0:
+            self._emitQueryRecursive(cb_header.correlation_id)
 
-    @defer.inlineCallbacks
-    def queryRecursiveConfirmed(self, header, sub_result):
+        # this just means we got an ack from the children
+        defer.returnValue(None)
 
-        @defer.inlineCallbacks
-        def createCQR(conn, children=None):
-            # can we make this generic?
-            c = conn
 
-            source_stp = nsa.STP(c.source_network, c.source_port, c.source_label)
-            dest_stp = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
+    def _createQueryRecursiveResult(self, conn, sub_conns, children):
 
-            schedule = nsa.Schedule(c.start_time, c.end_time)
-            sd = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None, None)
+        c = conn
 
-            criteria = nsa.QueryCriteria(c.revision, schedule, sd, children)
+        source_stp = nsa.STP(c.source_network, c.source_port, c.source_label)
+        dest_stp = nsa.STP(c.dest_network, c.dest_port, c.dest_label)
 
-            sub_conns = yield self.getSubConnectionsByConnectionKey(c.id)
-            if len(sub_conns) == 0: # apparently this can happen
-                data_plane_status = (False, 0, False)
-            else:
-                aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-                aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-                aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-                data_plane_status = (aggr_active, aggr_version, aggr_consistent)
+        schedule = nsa.Schedule(c.start_time, c.end_time)
+        sd = nsa.Point2PointService(source_stp, dest_stp, c.bandwidth, cnt.BIDIRECTIONAL, False, None, None)
 
-            states = (c.reservation_state, c.provision_state, c.lifecycle_state, data_plane_status)
-            notification_id = self.getNotificationId()
-            result_id = notification_id
+        criteria = nsa.QueryCriteria(c.revision, schedule, sd, children)
 
-            ci = nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
-                                    self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
-            defer.returnValue(ci)
+        states = (c.reservation_state, c.provision_state, c.lifecycle_state, _aggregateDataPlaneStatus(sub_conns))
+        notification_id = self.getNotificationId()
+        result_id = notification_id
 
-        # ---
+        return nsa.ConnectionInfo(c.connection_id, c.global_reservation_id, c.description, cnt.EVTS_AGOLE, [ criteria ],
+                                  self.nsa_.urn(), c.requester_nsa, states, notification_id, result_id)
 
-        log.msg('queryRecursiveConfirmed from %s.' % (header.provider_nsa,), system=LOG_SYSTEM)
 
-        if not header.correlation_id in self.query_calls:
-            log.msg('queryRecursiveConfirmed could not match correlation id %s' % header.correlation_id, system=LOG_SYSTEM)
-            return
+    def _clearQueryRecursive(self, cbh_correlation_id):
+        # remove the state for a query recursive request, returns it
+        query_request = self.query_requests.pop(cbh_correlation_id)
+        if query_request['timeout'].active():
+            query_request['timeout'].cancel()
+        for correlation_id in query_request['calls']:
+            if correlation_id in self.query_calls:
+                self.query_calls.pop(correlation_id)
+        return query_request
+
+
+    def _emitQueryRecursive(self, cbh_correlation_id):
+
+        query_request = self._clearQueryRecursive(cbh_correlation_id)
+        results = query_request['results']
+
+        reservations = []
+        for conn, sub_conns in query_request['connections']:
+            children = [ results[key] for key in [ (sc.provider_nsa, sc.connection_id) for sc in sub_conns ] if key in results ]
+            if len(children) < len(sub_conns):
+                log.msg('QueryRecursive : Connection %s: Missing result for %i of %i sub connections' % (conn.connection_id, len(sub_conns) - len(children), len(sub_conns)), system=LOG_SYSTEM)
+            reservations.append( self._createQueryRecursiveResult(conn, sub_conns, children) )
 
-        cbh_correlation_id, res = self.query_calls[header.correlation_id]
-        if res:
-            log.msg('queryRecursiveConfirmed : Already have result for correlation id %s' % header.correlation_id, system=LOG_SYSTEM)
+        log.msg('QueryRecursive : Emitting %i connection(s) to parent requester' % len(reservations), system=LOG_SYSTEM)
+        self.parent_requester.queryRecursiveConfirmed(query_request['header'], reservations)
+
+
+    def _queryRecursiveTimeout(self, cbh_correlation_id):
+
+        if not cbh_correlation_id in self.query_requests:
             return
 
-        # update temporary result structure
+        outstanding = self.query_calls.outstanding(cbh_correlation_id)
+        log.msg('QueryRecursive : %i child queries did not reply in %i seconds, emitting partial result' % (outstanding, QUERY_RECURSIVE_TIMEOUT), system=LOG_SYSTEM)
+        self._emitQueryRecursive(cbh_correlation_id)
 
-        self.query_calls[header.correlation_id] = cbh_correlation_id, sub_result
 
-        # done updating
+    def queryRecursiveConfirmed(self, header, sub_result):
 
-        # check if all sub results have been received
-        cb_header, conn, count = self.query_requests[cbh_correlation_id]
-        scr = [ res[0] for cbhci, res in self.query_calls.values() if res and cbhci == cbh_correlation_id ]
+        log.msg('queryRecursiveConfirmed from %s.' % (header.provider_nsa,), system=LOG_SYSTEM)
 
-        if len(scr) == count:
-            # all results back, can emit
+        # a duplicate result will not match, as the call is completed by the first one
+        if not header.correlation_id in self.query_calls:
+            log.msg('queryRecursiveConfirmed could not match correlation id %s' % header.correlation_id, system=LOG_SYSTEM)
+            return
 
-            # clear temporary structure
-            self.query_requests.pop(cbh_correlation_id)
-            for k,v in list(self.query_calls.items()): # make a copy to avoid changing the dict while iterating
-                cbhci, res = v
-                if cbhci == cbh_correlation_id:
-                    self.query_calls.pop(k)
+        cbh_correlation_id = self.query_calls.group(header.correlation_id)
+        sub_keys = self.query_calls.pop(header.correlation_id)
 
-            log.msg('QueryRecursive : Emitting to parent requester', system=LOG_SYSTEM)
-            results = yield createCQR(conn, scr)
-            self.parent_requester.queryRecursiveConfirmed(cb_header, [ results ] )
+        if not cbh_correlation_id in self.query_requests:
+            log.msg('queryRecursiveConfirmed : No request for correlation id %s (expired)' % cbh_correlation_id, system=LOG_SYSTEM)
+            return
 
+        # update temporary result structure
+        results = self.query_requests[cbh_correlation_id]['results']
+        for ci in sub_result:
+            try:
+                results[ sub_keys[ci.connection_id] ] = ci
+            except KeyError:
+                log.msg('queryRecursiveConfirmed : Result for connection %s, which was not queried, ignoring it' % ci.connection_id, system=LOG_SYSTEM)
+
+        # check if all sub results have been received
+        outstanding = self.query_calls.outstanding(cbh_correlation_id)
+        if outstanding == 0:
+            self._emitQueryRecursive(cbh_correlation_id)
         else:
-            log.msg('QueryRecursive : Still neeed %i/%i results to emit result' % (count-len(scr), count), system=LOG_SYSTEM)
+            log.msg('QueryRecursive : Still need %i/%i results to emit result' % (outstanding, len(self.query_requests[cbh_correlation_id]['calls'])), system=LOG_SYSTEM)
 
 
     def queryNotification(self, header, connection_id, start_notification, end_notification):
@@ -882,26 +998,27 @@ class Aggregator:
                                     start_time=db_start_time, end_time=db_end_time, bandwidth=sd.capacity)
 
         yield sc.save()
+        self.aggregate_states.update(sc)
 
         # figure out if we can aggregate upwards
 
         conn = yield self.getConnectionByKey(sc.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         if sc.order_id == 0:
             conn.source_label = sd.source_stp.label
-        if sc.order_id == len(sub_conns)-1:
+        if sc.order_id == aggr.total-1:
             conn.dest_label = sd.dest_stp.label
 
         yield conn.save()
 
-        outstanding_calls = [ v for v in self.reservations.values() if v.get('service_connection_id') == resv_info['service_connection_id'] ]
-        if len(outstanding_calls) > 0:
-            log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, len(outstanding_calls)), system=LOG_SYSTEM)
+        outstanding_calls = self.reservations.outstanding(resv_info['service_connection_id'])
+        if outstanding_calls > 0:
+            log.msg('Connection %s: Still missing %i reserveConfirmed call(s) to aggregate' % (conn.connection_id, outstanding_calls), system=LOG_SYSTEM)
             return
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.reservation_state == state.RESERVE_HELD for sc in sub_conns ] ) and conn.reservation_state != state.RESERVE_HELD:
+        if aggr.all('reservation_state', state.RESERVE_HELD) and conn.reservation_state != state.RESERVE_HELD:
             log.msg('Connection %s: All sub connections reserve held, can emit reserveConfirmed' % (conn.connection_id), system=LOG_SYSTEM)
             yield state.reserveHeld(conn)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
@@ -954,12 +1071,13 @@ class Aggregator:
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.RESERVE_START
         yield sub_connection.save()
+        self.aggregate_states.update(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.reservation_state == state.RESERVE_START for sc in sub_conns ] ) and conn.reservation_state != state.RESERVE_START:
+        if aggr.all('reservation_state', state.RESERVE_START) and conn.reservation_state != state.RESERVE_START:
             yield state.reserved(conn)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.reserveCommitConfirmed(header, conn.connection_id)
@@ -975,12 +1093,13 @@ class Aggregator:
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.reservation_state = state.RESERVE_START
         yield sub_connection.save()
+        self.aggregate_states.update(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.reservation_state == state.RESERVE_START for sc in sub_conns ] ) and conn.reservation_state != state.RESERVE_START:
+        if aggr.all('reservation_state', state.RESERVE_START) and conn.reservation_state != state.RESERVE_START:
             yield state.reserved(conn)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.reserveAbortConfirmed(header, conn.connection_id)
@@ -994,12 +1113,13 @@ class Aggregator:
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         yield state.provisioned(sub_connection)
+        self.aggregate_states.update(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.provision_state == state.PROVISIONED for sc in sub_conns ] ) and conn.provision_state != state.PROVISIONED:
+        if aggr.all('provision_state', state.PROVISIONED) and conn.provision_state != state.PROVISIONED:
             yield state.provisioned(conn)
             req_header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.provisionConfirmed(req_header, conn.connection_id)
@@ -1013,12 +1133,13 @@ class Aggregator:
 
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         yield state.released(sub_connection)
+        self.aggregate_states.update(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.provision_state == state.RELEASED for sc in sub_conns ] ) and conn.provision_state != state.RELEASED:
+        if aggr.all('provision_state', state.RELEASED) and conn.provision_state != state.RELEASED:
             yield state.released(conn)
             req_header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.releaseConfirmed(req_header, conn.connection_id)
@@ -1030,13 +1151,17 @@ class Aggregator:
         sub_connection = yield self.getSubConnection(header.provider_nsa, connection_id)
         sub_connection.lifecycle_state = state.TERMINATED
         yield sub_connection.save()
+        self.db_sub_connections.evict( (header.provider_nsa, connection_id) )
+        self.aggregate_states.update(sub_connection)
 
         conn = yield self.getConnectionByKey(sub_connection.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # if we get responses very close, multiple requests can trigger this, so we check main state as well
-        if all( [ sc.lifecycle_state == state.TERMINATED for sc in sub_conns ] ) and conn.lifecycle_state != state.TERMINATED:
+        if aggr.all('lifecycle_state', state.TERMINATED) and conn.lifecycle_state != state.TERMINATED:
             yield state.terminated(conn)
+            self.db_connections.evict(conn.connection_id)
+            self.aggregate_states.evict(conn.id)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn())
             self.parent_requester.terminateConfirmed(header, conn.connection_id)
             self.plugin.connectionTerminated(conn)
@@ -1065,13 +1190,14 @@ class Aggregator:
         sub_conn = yield self.getSubConnection(header.provider_nsa, connection_id)
 
         yield state.reserveTimeout(sub_conn)
+        self.aggregate_states.update(sub_conn)
 
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         if conn.reservation_state == state.RESERVE_FAILED:
             log.msg("Connection %s: reserveTimeout: Connection has already failed, not notifying parent" % conn.connection_id, system=LOG_SYSTEM)
-        elif sum ( [ 1 if sc.reservation_state == state.RESERVE_TIMEOUT else 0 for sc in sub_conns ] ) == 1:
+        elif aggr.count('reservation_state', state.RESERVE_TIMEOUT) == 1:
             log.msg("Connection %s: reserveTimeout, first occurance, notifying parent" % conn.connection_id, system=LOG_SYSTEM)
             header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn(), reply_to=conn.requester_url)
             self.parent_requester.reserveTimeout(header, conn.connection_id, notification_id, timestamp, timeout_value, org_connection_id, org_nsa)
@@ -1093,21 +1219,19 @@ class Aggregator:
         sub_conn.data_plane_consistent  = consistent
 
         yield sub_conn.save()
+        self.aggregate_states.update(sub_conn)
 
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
         # At some point we should check if data plane aggregated state actually changes and only emit for those that change
 
         # do notification
-        actives  = [ sc.data_plane_active     for sc in sub_conns ]
-        aggr_active     = all( actives )
-        aggr_version    = max( [ sc.data_plane_version or 0 for sc in sub_conns ] )
-        aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] ) and all( [ a == actives[0] for a in actives ] ) # we need version here
+        data_plane_status = aggr.dataPlaneStatus() # we need version here
+        aggr_active, aggr_version, aggr_consistent = data_plane_status
 
         header = nsa.NSIHeader(conn.requester_nsa, self.nsa_.urn(), reply_to=conn.requester_url)
         now = datetime.datetime.utcnow()
-        data_plane_status = (aggr_active, aggr_version, aggr_consistent)
 
         log.msg("Connection %s: Aggregated data plane status: Active %s, version %s, consistent %s" % \
             (conn.connection_id, aggr_active, aggr_version, aggr_consistent), system=LOG_SYSTEM)
@@ -1140,9 +1264,9 @@ class Aggregator:
         sub_conn = yield self.getSubConnection(header.provider_nsa, connection_id)
 
         conn = yield self.getConnectionByKey(sub_conn.service_connection_id)
-        sub_conns = yield self.getSubConnectionsByConnectionKey(conn.id)
+        aggr = yield self.aggregate_states.get(conn.id)
 
-        if len(sub_conns) == 1:
+        if aggr.total == 1:
             log.msg("errorEvent: One sub connection for connection %s, notifying" % conn.connection_id, system=LOG_SYSTEM)
             self.doErrorEvent(conn, notification_id, event, info, service_ex)
         else:
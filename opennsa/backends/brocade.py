@@ -25,11 +25,14 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, error
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.brocade'
 
+# the device reports failed commands with these, and gives a new prompt
+ERROR_OUTPUT = ('Error', 'Invalid input')
+
 
 COMMAND_PRIVILEGE   = 'enable %s'
 COMMAND_CONFIGURE   = 'configure terminal'
@@ -88,7 +91,7 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -105,7 +108,7 @@ class SSHChannel(ssh.SSHChannel):
 
         try:
             log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
             d = self.waitForData('>')
             self.write(COMMAND_PRIVILEGE % enable_password + LT)
@@ -145,49 +148,41 @@ class SSHChannel(ssh.SSHChannel):
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         if len(data) == 0:
             pass
         else:
             self.data += data
             if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
+                output = self.data
                 self.data       = ''
                 self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
+                if any( e in output for e in ERROR_OUTPUT ):
+                    # the device gives a prompt after the error as well
+                    self.failWait( error.InternalNRMError('Error from device: %s' % output.strip()) )
+                else:
+                    d = self.wait_defer
+                    self.wait_defer = None
+                    d.callback(self)
 
 
 
 
 class BrocadeCommandSender:
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, enable_password, ssh_channels=1):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        # This is based on the Force10 backend, it is currently unknown if the
+        # Brocade SSH implementation supports multiple ssh channels, so the default is one
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
         self.enable_password = enable_password
 
 
-    @defer.inlineCallbacks
     def sendCommands(self, commands):
 
-        # Open a connection for each request
-        # This is done due to the code being based on the Force10 backend
-        # It is currently unknown if the Brocade SSH implementation
-        # supports multiple ssh channels.
-
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
-
-            yield channel.channel_open
-            yield channel.sendCommands(commands, self.enable_password)
-
-        finally:
-            ssh_connection.transport.loseConnection()
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands, self.enable_password)
 
 
 
@@ -204,8 +199,9 @@ class BrocadeConnectionManager:
         ssh_public_key   = cfg[config.BROCADE_SSH_PUBLIC_KEY]
         ssh_private_key  = cfg[config.BROCADE_SSH_PRIVATE_KEY]
         enable_password  = cfg[config.BROCADE_ENABLE_PASSWORD]
+        ssh_channels     = int(cfg.get(config.BROCADE_SSH_CHANNELS, 1))
 
-        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password)
+        self.command_sender = BrocadeCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, enable_password, ssh_channels)
 
 
     def getResource(self, port, label):
@@ -259,5 +255,5 @@ def BrocadeBackend(network_name, nrm_ports, parent_requester, configuration):
     port_map = dict( [ (p.name, p.interface) for p in nrm_ports ] ) # for the nrm backend
 
     cm = BrocadeConnectionManager(name, port_map, configuration)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(configuration))
 
@@ -11,25 +11,190 @@ overlap detection will not work properly.
 None is allowed for start and end time. In that case the semantics is now for
 start time and forever for end time.
 
+Reservations are indexed per resource, in a blocked list sorted by start time
+along with running maximums of end times. This allows overlap checks to be
+done with a binary search instead of scanning every reservation in the
+calendar, and adding or removing a reservation does not shift the entire list.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2016)
 """
 
+import bisect
 import datetime
+import itertools
+
+from opennsa import error, nsa
+
+
+
+# used when coalescing None start / end times in the index
+BEGINNING_OF_TIME = datetime.datetime.min
+END_OF_TIME       = datetime.datetime.max
 
-from opennsa import error
+
+
+class IntervalIndex:
+    """
+    Sorted index of time intervals for a single resource.
+
+    Intervals are kept sorted by (start, end), in blocks of at most twice
+    BLOCK_SIZE intervals. Each block has the running maximum of its end times,
+    and the maximum end time of all blocks up to (and including) each block is
+    kept as well. Overlap checks are then a binary search on the start time,
+    followed by a lookup in the running maxima. Adding or removing an interval
+    only updates the block it is in and the per block maxima, i.e., it takes
+    O(sqrt(n)) time for a well chosen block size, instead of O(n).
+    """
+    __slots__ = ('blocks', 'block_max_ends', 'firsts', 'max_ends', 'size')
+
+    BLOCK_SIZE = 256
+
+    def __init__(self):
+        self.blocks         = [] # [ [ (start_time, end_time) ] ], None coalesced
+        self.block_max_ends = [] # [ [ running maximum of end times in the block ] ]
+        self.firsts         = [] # first interval of each block, for finding the block of an interval
+        self.max_ends       = [] # maximum end time of all blocks up to each block
+        self.size           = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _updateBlock(self, bi, idx=0):
+        # recompute the running maximum of block bi from position idx and onwards,
+        # once it is the same as before the change, the rest of it is as well
+        block = self.blocks[bi]
+        block_max_ends = self.block_max_ends[bi]
+        self.firsts[bi] = block[0]
+        running = block_max_ends[idx-1] if idx > 0 else BEGINNING_OF_TIME
+        for i in range(idx, len(block)):
+            running = max(running, block[i][1])
+            if block_max_ends[i] == running:
+                return
+            block_max_ends[i] = running
+
+
+    def _updateMaxEnds(self, bi):
+        # recompute the maximum of the blocks from block bi and onwards, same as above
+        running = self.max_ends[bi-1] if bi > 0 else BEGINNING_OF_TIME
+        for i in range(bi, len(self.blocks)):
+            running = max(running, self.block_max_ends[i][-1])
+            if self.max_ends[i] == running:
+                return
+            self.max_ends[i] = running
+
+
+    def _findBlock(self, key):
+        # index of the last block starting at or before key, which is where key is, or should go
+        return max(bisect.bisect_right(self.firsts, key) - 1, 0)
+
+
+    def add(self, start_time, end_time):
+        key = (start_time, end_time)
+        if not self.blocks:
+            self.extend( [ key ] )
+            return
+
+        bi = self._findBlock(key)
+        block = self.blocks[bi]
+        idx = bisect.bisect_right(block, key)
+        block.insert(idx, key)
+        self.block_max_ends[bi].insert(idx, None) # placeholder, computed below
+        self._updateBlock(bi, idx)
+
+        if len(block) > 2 * self.BLOCK_SIZE:
+            # split the block in two, the maximum of both halves is computed below
+            self.blocks.insert(bi+1, block[self.BLOCK_SIZE:])
+            self.block_max_ends.insert(bi+1, [ None ] * (len(block) - self.BLOCK_SIZE))
+            self.firsts.insert(bi+1, None)
+            self.max_ends[bi:bi+1] = [ None, None ]
+            del block[self.BLOCK_SIZE:]
+            del self.block_max_ends[bi][self.BLOCK_SIZE:]
+            self._updateBlock(bi+1)
+
+        self._updateMaxEnds(bi)
+        self.size += 1
+
+
+    def extend(self, intervals):
+        # add many intervals, with a single sort and rebuild of the blocks
+        keys = sorted(itertools.chain(self.intervals(), intervals))
+        self.blocks = [ keys[i:i+self.BLOCK_SIZE] for i in range(0, len(keys), self.BLOCK_SIZE) ]
+        self.block_max_ends = [ [ None ] * len(block) for block in self.blocks ]
+        self.firsts = [ None ] * len(self.blocks)
+        self.max_ends = [ None ] * len(self.blocks)
+        for bi in range(len(self.blocks)):
+            self._updateBlock(bi)
+        self._updateMaxEnds(0)
+        self.size = len(keys)
+
+
+    def remove(self, start_time, end_time):
+        key = (start_time, end_time)
+        bi = self._findBlock(key)
+        block = self.blocks[bi] if self.blocks else []
+        idx = bisect.bisect_left(block, key)
+        if idx == len(block) or block[idx] != key:
+            raise KeyError(key)
+
+        del block[idx]
+        if block:
+            del self.block_max_ends[bi][idx]
+            self._updateBlock(bi, idx)
+        else:
+            del self.blocks[bi], self.block_max_ends[bi], self.firsts[bi], self.max_ends[bi]
+        self._updateMaxEnds(bi)
+        self.size -= 1
+
+
+    def overlaps(self, start_time, end_time):
+        # the last block with intervals starting at or before the end time
+        query = (end_time, END_OF_TIME)
+        bi = bisect.bisect_right(self.firsts, query) - 1
+        if bi < 0:
+            return False
+        # number of intervals in it starting at or before the end time, at least one
+        idx = bisect.bisect_right(self.blocks[bi], query)
+        max_end = self.block_max_ends[bi][idx-1]
+        if bi > 0:
+            max_end = max(max_end, self.max_ends[bi-1])
+        # if any of these end at or after start time, there is overlap
+        return max_end >= start_time
+
+
+    def intervals(self):
+        return itertools.chain.from_iterable(self.blocks)
 
 
 
 class ReservationCalendar:
 
     def __init__(self):
-        self.reservations = [] # [ ( resource, start_time, end_time ) ]
+        self.index = {} # resource -> IntervalIndex
+        self.port_values = {} # port -> { label value : resource }, for resources reserved with a single value label
+        self.resource_ports = {} # resource -> set( (port, label value) ), for removing them from port_values
+
+
+    @property
+    def reservations(self):
+        # [ ( resource, start_time, end_time ) ], mainly for debugging and testing
+        uncoalesce = lambda t, c : None if t == c else t
+        return [ (resource, uncoalesce(st, BEGINNING_OF_TIME), uncoalesce(et, END_OF_TIME))
+                 for resource, ii in self.index.items() for st, et in ii.intervals() ]
+
+
+    def _indexKey(self, start_time, end_time):
+        return start_time or BEGINNING_OF_TIME, end_time or END_OF_TIME
 
 
     def _checkArgs(self, resource, start_time, end_time):
         assert type(resource)    is str, 'Resource must be a string'
+        self._checkTimes(start_time, end_time)
 
+
+    def _checkTimes(self, start_time, end_time):
         assert start_time is None or type(start_time) is datetime.datetime, 'Start time must be a datetime object or None, not %s' % str(type(start_time))
         assert end_time   is None or type(end_time)   is datetime.datetime, 'End time must be a datetime object or None, not %s' % str(type(end_time))
 
@@ -39,26 +204,58 @@ class ReservationCalendar:
             assert end_time.tzinfo   is None, 'End time must NOT have time zone.'
 
 
-    def addReservation(self, resource, start_time, end_time):
+    def _addLabel(self, resource, port, label):
+        # port and label are what the resource was found with, used for finding free labels
+        if port is not None and label is not None and label.singleValue():
+            value = label.range_set.first()
+            self.port_values.setdefault(port, {})[value] = resource
+            self.resource_ports.setdefault(resource, set()).add( (port, value) )
+
+
+    def _removeLabels(self, resource):
+        for port, value in self.resource_ports.pop(resource, ()):
+            values = self.port_values[port]
+            if values.get(value) == resource:
+                del values[value]
+            if not values:
+                del self.port_values[port]
+
+
+    def addReservation(self, resource, start_time, end_time, port=None, label=None):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
-        self.reservations.append(reservation)
+        start_key, end_key = self._indexKey(start_time, end_time)
+        self.index.setdefault(resource, IntervalIndex()).add(start_key, end_key)
+        self._addLabel(resource, port, label)
+
+
+    def addReservations(self, reservations):
+        # bulk version of addReservation, reservations is an iterable of (resource, start_time, end_time, port, label)
+        intervals = {}
+        for resource, start_time, end_time, port, label in reservations:
+            self._checkArgs(resource, start_time, end_time)
+            intervals.setdefault(resource, []).append( self._indexKey(start_time, end_time) )
+            self._addLabel(resource, port, label)
+
+        for resource, keys in intervals.items():
+            self.index.setdefault(resource, IntervalIndex()).extend(keys)
 
 
     def removeReservation(self, resource, start_time, end_time):
         self._checkArgs(resource, start_time, end_time)
 
-        reservation = (resource, start_time, end_time)
+        start_key, end_key = self._indexKey(start_time, end_time)
         try:
-            self.reservations.remove(reservation)
-        except ValueError:
+            ii = self.index[resource]
+            ii.remove(start_key, end_key)
+        except KeyError:
             raise ValueError('Reservation (%s, %s, %s) does not exist. Cannot remove' % (resource, start_time, end_time))
+        if len(ii) == 0:
+            del self.index[resource]
+            self._removeLabels(resource)
 
 
-    def checkReservation(self, resource, start_time, end_time):
-        self._checkArgs(resource, start_time, end_time)
-
+    def _checkSchedule(self, start_time, end_time):
         # check start time is before end time
         if start_time is not None and end_time is not None and start_time > end_time:
             raise error.PayloadError('Invalid request: Reverse duration (end time before start time)')
@@ -76,36 +273,88 @@ class ReservationCalendar:
             if start_time > datetime.datetime(2025, 1, 1):
                 raise error.PayloadError('Invalid request: Start time after year 2025')
 
-        for (c_resource, c_start_time, c_end_time) in self.reservations:
-            if resource == c_resource:
-                if self._resourceOverlap(c_start_time, c_end_time, start_time, end_time):
-                    raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
 
-        # all good
-
-
-    def _resourceOverlap(self, res1_start_time, res1_end_time, res2_start_time, res2_end_time):
-        # resource temporal availability
-
-        # hack on
-        # instead of doing a lot of complicated branching for None checking, we just coalesce the values into something easier
-
-        now = datetime.datetime.utcnow()
-        forever = datetime.datetime(9999, 1, 1)
+    def checkReservation(self, resource, start_time, end_time):
+        self._checkArgs(resource, start_time, end_time)
+        self._checkSchedule(start_time, end_time)
 
-        r1s = res1_start_time or now
-        r2s = res2_start_time or now
-        r1e = res1_end_time or forever
-        r2e = res2_end_time or forever
+        ii = self.index.get(resource)
+        if ii is not None and self._resourceOverlap(ii, start_time, end_time):
+            raise error.STPUnavailableError('Resource %s not available in specified time span' % resource)
 
-        assert r1s < r1e, 'Cannot detect overlap for backwards reservation (1)'
-        assert r2s < r2e, 'Cannot detect overlap for backwards reservation (2)'
+        # all good
 
-        if r2e < r1s:
-            return False # res2 ends before res1 starts so it is ok
-        if r2s > r1e:
-            return False # res2 starts after res1 ends so it is ok
 
-        # resources overlap in time
-        return True
+    def freeLabels(self, get_resource, ports, label, start_time, end_time):
+        """
+        Generator for the label values which are available on all the given
+        ports in the specified time span. Label values are yielded as single
+        value labels, in ascending order. If label is None, None is yielded if
+        the ports are available.
+
+        get_resource is a function mapping port and label to the calendar
+        resource, i.e., the getResource method of a connection manager.
+        The schedule is only validated once, and no exceptions are raised for
+        unavailable label values.
+
+        Instead of looking up the resource of every label value, the values
+        reserved on the given ports in the time span are removed from the
+        label, which requires reservations to be added with their port and
+        label. Resources can be shared between ports (e.g., vlans on some
+        switches), and reserved through another port, so the remaining values
+        are checked as they are yielded. This is normally only the first one.
+        """
+        self._checkTimes(start_time, end_time)
+        self._checkSchedule(start_time, end_time)
+
+        # coalesce once, instead of for every resource
+        r2s, r2e = self._queryTimes(start_time, end_time)
+
+        def available(resource):
+            ii = self.index.get(resource)
+            return ii is None or not ii.overlaps(r2s, r2e)
+
+        if label is None:
+            if all( available(get_resource(port, None)) for port in ports ):
+                yield None
+            return
+
+        busy = []
+        for port in ports:
+            for value, resource in self.port_values.get(port, {}).items():
+                if value in label.range_set and not available(resource):
+                    busy.append( (value, value) )
+
+        for value in label.range_set - nsa.RangeSet(busy):
+            candidate = nsa.Label(label.type_, value)
+            if all( available(get_resource(port, candidate)) for port in ports ):
+                yield candidate
+
+
+    def findFreeLabel(self, get_resource, ports, label, start_time, end_time):
+        """
+        Find the first label value which is available on all the given ports
+        in the specified time span. See freeLabels for arguments.
+        Raises STPUnavailableError if no label value is available.
+        """
+        for candidate in self.freeLabels(get_resource, ports, label, start_time, end_time):
+            return candidate
+        raise error.STPUnavailableError('No label in %s available on %s in specified time span' % (label, ', '.join(ports)))
+
+
+    def _queryTimes(self, start_time, end_time):
+        # reservations with None start time are indexed at the beginning of time,
+        # which is equivalent to now for queries, as expired reservations are removed
+
+        r2s = start_time or datetime.datetime.utcnow()
+        r2e = end_time   or END_OF_TIME
+
+        assert r2s < r2e, 'Cannot detect overlap for backwards reservation'
+        return r2s, r2e
+
+
+    def _resourceOverlap(self, interval_index, start_time, end_time):
+        # resource temporal availability, touching intervals are considered overlapping
+        r2s, r2e = self._queryTimes(start_time, end_time)
+        return interval_index.overlaps(r2s, r2e)
 
@@ -23,14 +23,24 @@ from twisted.application import service
 
 from opennsa.interface import INSIProvider
 
-from opennsa import constants as cnt, error, state, nsa, authz
-from opennsa.backends.common import scheduler, calendar
+from opennsa import constants as cnt, error, state, nsa, authz, database, config
+from opennsa.shared import keyedlock
+from opennsa.backends.common import scheduler, calendar, linkbatch
 
-from twistar.dbobject import DBObject
 
 
+RESTORE_CONCURRENCY       = 8     # concurrent transitions (activate, rollback, end) when restoring
+RESTORE_PROGRESS_INTERVAL = 100   # log progress every this many transitions
 
-class GenericBackendConnections(DBObject):
+
+
+def restoreConcurrency(cfg):
+    # restore concurrency from a backend configuration block, for the backend setup functions
+    return int(cfg.get(config.RESTORE_CONCURRENCY, RESTORE_CONCURRENCY))
+
+
+
+class GenericBackendConnections(database.TrackedDBObject):
     pass
 
 
@@ -43,7 +53,7 @@ class GenericBackend(service.Service):
     # Yeah, it should be much less, but some NRMs are that slow
     TPC_TIMEOUT = 120 # seconds
 
-    def __init__(self, network, nrm_ports, connection_manager, parent_requester, log_system, minimum_duration=60):
+    def __init__(self, network, nrm_ports, connection_manager, parent_requester, log_system, minimum_duration=60, restore_concurrency=RESTORE_CONCURRENCY):
 
         self.network            = network
         self.nrm_ports          = nrm_ports
@@ -51,13 +61,21 @@ class GenericBackend(service.Service):
         self.parent_requester   = parent_requester
         self.log_system         = log_system
         self.minimum_duration   = minimum_duration
+        self.restore_concurrency = restore_concurrency # max concurrent device transitions when restoring the schedule
+        self.restore_stopped     = False
 
         self.notification_id = 0
 
-        self.scheduler = scheduler.CallScheduler()
+        # requests and scheduled calls for a connection are run one at the time
+        self.connection_locks = keyedlock.KeyedLock()
+
+        self.scheduler = scheduler.CallScheduler(self.connection_locks)
         self.calendar  = calendar.ReservationCalendar()
         # need to build the calendar as well
 
+        # link setups and teardowns due at the same time are sent to the connection manager together (if it supports it)
+        self.link_batcher = linkbatch.LinkBatcher(connection_manager, log_system)
+
         # need to build schedule here
         self.restore_defer = defer.Deferred()
         reactor.callWhenRunning(self.buildSchedule)
@@ -69,6 +87,7 @@ class GenericBackend(service.Service):
 
     def stopService(self):
         service.Service.stopService(self)
+        self.restore_stopped = True # don't start restore transitions that are still waiting
         if self.restore_defer.called:
             self.scheduler.cancelAllCalls()
             return defer.succeed(None)
@@ -84,16 +103,22 @@ class GenericBackend(service.Service):
 
     @defer.inlineCallbacks
     def buildSchedule(self):
+        # Restore is done in three steps: All connections are classified, scheduling future calls, and
+        # collecting reservations and the transitions that should happen right away. Then the calendar
+        # is loaded, and finally the transitions are run, with limited concurrency towards the device.
 
         # make sure we only get connections belonging to this backend, as the table is shared between backends
         conns = yield GenericBackendConnections.find(where=['source_network = ? AND dest_network = ? AND lifecycle_state <> ?', self.network, self.network, state.TERMINATED])
+
+        now = datetime.datetime.utcnow()
+        reservations = []
+        transitions = [] # [ (transition, conn) ]
+
         for conn in conns:
             # avoid race with newly created connections
             if self.scheduler.hasScheduledCall(conn.connection_id):
                 continue
 
-            now = datetime.datetime.utcnow()
-
             if conn.lifecycle_state in (state.PASSED_ENDTIME, state.TERMINATED):
                 continue # This connection has already lived it life to the fullest :-)
 
@@ -105,12 +130,12 @@ class GenericBackend(service.Service):
             # add reservation, some of the following code will remove the reservation again
             src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
             dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
-            self.calendar.addReservation(  src_resource, conn.start_time, conn.end_time)
-            self.calendar.addReservation(  dst_resource, conn.start_time, conn.end_time)
+            reservations.append( (src_resource, conn.start_time, conn.end_time, conn.source_port, conn.source_label) )
+            reservations.append( (dst_resource, conn.start_time, conn.end_time, conn.dest_port,   conn.dest_label) )
 
             if conn.end_time is not None and conn.end_time < now and conn.lifecycle_state not in (state.PASSED_ENDTIME, state.TERMINATED):
                 log.msg('Connection %s: Immediate end during buildSchedule' % conn.connection_id, system=self.log_system)
-                yield self._doEndtime(conn)
+                transitions.append( (self._doEndtime, conn) )
                 continue
 
             elif conn.reservation_state == state.RESERVE_HELD:
@@ -119,7 +144,7 @@ class GenericBackend(service.Service):
                 if timeout_time < now:
                     # have passed the time when timeout should occur
                     log.msg('Connection %s: Reservation Held, but timeout has passed, doing rollback' % conn.connection_id, system=self.log_system)
-                    yield self._doReserveRollback(conn) # will remove reservation
+                    transitions.append( (self._doReserveRollback, conn) ) # will remove reservation
                 else:
                     td = timeout_time - now
                     log.msg('Connection %s: Reservation Held, scheduling timeout in %i seconds' % (conn.connection_id, td.total_seconds()), system=self.log_system)
@@ -137,7 +162,7 @@ class GenericBackend(service.Service):
                             log.msg('Connection %s: already active, scheduling end for %s UTC (%i seconds) (buildSchedule)' % (conn.connection_id, conn.end_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
                     else:
                         log.msg('Connection %s: Immediate activate during buildSchedule' % conn.connection_id, system=self.log_system)
-                        yield self._doActivate(conn)
+                        transitions.append( (self._doActivate, conn) )
                 elif conn.provision_state == state.RELEASED:
                     if conn.end_time is None:
                         log.msg('Connection %s: Currently released, no end scheduled' % conn.connection_id, system=self.log_system)
@@ -164,10 +189,50 @@ class GenericBackend(service.Service):
             else:
                 log.msg('Unhandled start/end time configuration for connection %s' % conn.connection_id, system=self.log_system)
 
+        self.calendar.addReservations(reservations)
+        log.msg('Schedule restored for %i connections, %i transitions to run' % (len(conns), len(transitions)), system=self.log_system)
+
+        yield self._runTransitions(transitions)
+
         log.msg('Scheduled calls restored', system=self.log_system)
         self.restore_defer.callback(None)
 
 
+    def _runTransitions(self, transitions):
+        # run transitions found during restore, at most restore_concurrency at the time
+        # if the service is stopped, transitions that have not been started are skipped
+
+        semaphore = defer.DeferredSemaphore(self.restore_concurrency)
+        progress = { 'finished': 0, 'failed': 0, 'skipped': 0 }
+
+        def runTransition(transition, conn):
+            if self.restore_stopped:
+                progress['skipped'] += 1
+                return
+            return self.connection_locks.run(conn.connection_id, transition, conn)
+
+        def transitionFailed(err, conn):
+            progress['failed'] += 1
+            log.msg('Connection %s: Error during restore transition: %s' % (conn.connection_id, err.getErrorMessage()), system=self.log_system)
+
+        def transitionFinished(_):
+            progress['finished'] += 1
+            if progress['finished'] % RESTORE_PROGRESS_INTERVAL == 0:
+                log.msg('Restore progress: %i of %i transitions finished' % (progress['finished'], len(transitions)), system=self.log_system)
+
+        def allDone(_):
+            log.msg('Restore transitions finished: %i (failed: %i, skipped: %i)' % (progress['finished'], progress['failed'], progress['skipped']), system=self.log_system)
+
+        defs = []
+        for transition, conn in transitions:
+            d = semaphore.run(runTransition, transition, conn)
+            d.addErrback(transitionFailed, conn)
+            d.addCallback(transitionFinished)
+            defs.append(d)
+
+        return defer.DeferredList(defs).addCallback(allDone)
+
+
 
     @defer.inlineCallbacks
     def _getConnection(self, connection_id, requester_nsa):
@@ -204,6 +269,7 @@ class GenericBackend(service.Service):
         log.msg('Connection %s: %s -> %s %s' % (conn.connection_id, src_target, dst_target, state_msg), system=self.log_system)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserve(self, header, connection_id, global_reservation_id, description, criteria, request_info=None):
 
@@ -280,36 +346,20 @@ class GenericBackend(service.Service):
         if not nsa.Label.canMatch(nrm_dest_port.label, dest_stp.label):
             raise error.TopologyError('Destination port %s cannot match label set %s' % (nrm_dest_port.name, dest_stp.label) )
 
-        labelEnum = lambda label : [None] if label is None else [ nsa.Label(label.type_, lv) for lv in label.enumerateValues() ]
+        get_resource = self.connection_manager.getResource
 
         # do the find the label value dance
         if self.connection_manager.canSwapLabel(labelType(source_stp)) and self.connection_manager.canSwapLabel(labelType(dest_stp)):
-            for lv in labelEnum(source_stp.label):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    src_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            try:
+                src_label = self.calendar.findFreeLabel(get_resource, [ source_stp.port ], source_stp.label, start_time, end_time)
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % source_stp)
 
-            for lv in labelEnum(dest_stp.label):
-                dst_resource = self.connection_manager.getResource(dest_stp.port, lv)
-                try:
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    pass
-            else:
+            try:
+                dst_label = self.calendar.findFreeLabel(get_resource, [ dest_stp.port ], dest_stp.label, start_time, end_time)
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('STP %s not available in specified time span' % dest_stp)
 
-            # Only add reservations, when src and dest stps are both available
-            self.calendar.addReservation(  src_resource, start_time, end_time)
-            self.calendar.addReservation(  dst_resource, start_time, end_time)
-
         else:
             if source_stp.label is None:
                 label_candidate = dest_stp.label
@@ -321,22 +371,18 @@ class GenericBackend(service.Service):
                 except nsa.EmptyLabelSet:
                     raise error.VLANInterchangeNotSupportedError('VLAN re-write not supported and no possible label intersection')
 
-            for lv in labelEnum(label_candidate):
-                src_resource = self.connection_manager.getResource(source_stp.port, lv)
-                dst_resource = self.connection_manager.getResource(dest_stp.port,   lv)
-                try:
-                    self.calendar.checkReservation(src_resource, start_time, end_time)
-                    self.calendar.checkReservation(dst_resource, start_time, end_time)
-                    self.calendar.addReservation(  src_resource, start_time, end_time)
-                    self.calendar.addReservation(  dst_resource, start_time, end_time)
-                    src_label = lv
-                    dst_label = lv
-                    break
-                except error.STPUnavailableError:
-                    continue
-            else:
+            try:
+                src_label = self.calendar.findFreeLabel(get_resource, [ source_stp.port, dest_stp.port ], label_candidate, start_time, end_time)
+                dst_label = src_label
+            except error.STPUnavailableError:
                 raise error.STPUnavailableError('Link %s and %s not available in specified time span' % (source_stp, dest_stp))
 
+        # Only add reservations, when src and dest stps are both available
+        src_resource = get_resource(source_stp.port, src_label)
+        dst_resource = get_resource(dest_stp.port,   dst_label)
+        self.calendar.addReservation(  src_resource, start_time, end_time, source_stp.port, src_label)
+        self.calendar.addReservation(  dst_resource, start_time, end_time, dest_stp.port,   dst_label)
+
         now =  datetime.datetime.utcnow()
 
         source_target = self.connection_manager.getTarget(source_stp.port, src_label)
@@ -359,6 +405,7 @@ class GenericBackend(service.Service):
         defer.returnValue(connection_id)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserveCommit(self, header, connection_id, request_info=None):
 
@@ -389,6 +436,7 @@ class GenericBackend(service.Service):
         defer.returnValue(connection_id)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def reserveAbort(self, header, connection_id, request_info=None):
 
@@ -406,6 +454,7 @@ class GenericBackend(service.Service):
         self.parent_requester.reserveAbortConfirmed(header, conn.connection_id)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def provision(self, header, connection_id, request_info=None):
 
@@ -427,20 +476,25 @@ class GenericBackend(service.Service):
         if conn.end_time is not None and conn.end_time <= now:
             raise error.ConnectionGoneError('Cannot provision connection after end time (end time: %s, current time: %s).' % (conn.end_time, now))
 
-        yield state.provisioning(conn)
-        self.logStateUpdate(conn, 'PROVISIONING')
-
-        self.scheduler.cancelCall(connection_id)
+        # provisioning and provisioned are saved together
+        state.coalesce(conn)
+        try:
+            yield state.provisioning(conn)
+            self.logStateUpdate(conn, 'PROVISIONING')
 
-        if conn.start_time is None or conn.start_time <= now:
-            self._doActivate(conn) # returns a deferred, but it isn't used
-        else:
-            self.scheduler.scheduleCall(connection_id, conn.start_time, self._doActivate, conn)
-            td = conn.start_time - now
-            log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (provision)' % \
-                    (conn.connection_id, conn.start_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+            self.scheduler.cancelCall(connection_id)
 
-        yield state.provisioned(conn)
+            if conn.start_time is None or conn.start_time <= now:
+                self._doActivate(conn) # returns a deferred, but it isn't used
+            else:
+                self.scheduler.scheduleCall(connection_id, conn.start_time, self._doActivate, conn)
+                td = conn.start_time - now
+                log.msg('Connection %s: activate scheduled for %s UTC (%i seconds) (provision)' % \
+                        (conn.connection_id, conn.start_time.replace(microsecond=0), td.total_seconds()), system=self.log_system)
+
+            yield state.provisioned(conn)
+        finally:
+            yield state.commit(conn)
         self.logStateUpdate(conn, 'PROVISIONED')
 
         self.parent_requester.provisionConfirmed(header, connection_id)
@@ -448,6 +502,7 @@ class GenericBackend(service.Service):
         defer.returnValue(conn.connection_id)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def release(self, header, connection_id, request_info=None):
 
@@ -483,6 +538,7 @@ class GenericBackend(service.Service):
         defer.returnValue(conn.connection_id)
 
 
+    @keyedlock.connectionLocked
     @defer.inlineCallbacks
     def terminate(self, header, connection_id, request_info=None):
         # return defer.fail( error.InternalNRMError('test termination failure') )
@@ -619,19 +675,24 @@ class GenericBackend(service.Service):
     def _doReserveRollback(self, conn):
 
         try:
-            yield state.reserveAbort(conn)
-            self.logStateUpdate(conn, 'RESERVE ABORTING')
+            # aborting and reserve start are saved together
+            state.coalesce(conn)
+            try:
+                yield state.reserveAbort(conn)
+                self.logStateUpdate(conn, 'RESERVE ABORTING')
 
-            self.scheduler.cancelCall(conn.connection_id) # we only have this for non-timeout calls, but just cancel
+                self.scheduler.cancelCall(conn.connection_id) # we only have this for non-timeout calls, but just cancel
 
-            # release the resources
-            src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
-            dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
+                # release the resources
+                src_resource = self.connection_manager.getResource(conn.source_port, conn.source_label)
+                dst_resource = self.connection_manager.getResource(conn.dest_port,   conn.dest_label)
 
-            self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
-            self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
+                self.calendar.removeReservation(src_resource, conn.start_time, conn.end_time)
+                self.calendar.removeReservation(dst_resource, conn.start_time, conn.end_time)
 
-            yield state.reserved(conn) # we only log this, when we haven't passed end time, as it looks wonky with start+end together
+                yield state.reserved(conn) # we only log this, when we haven't passed end time, as it looks wonky with start+end together
+            finally:
+                yield state.commit(conn)
 
             now = datetime.datetime.utcnow()
             if conn.end_time is not None and now > conn.end_time:
@@ -655,7 +716,7 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label)
         try:
             log.msg('Connection %s: Activating data plane...' % conn.connection_id, system=self.log_system)
-            yield self.connection_manager.setupLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            yield self.link_batcher.setupLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
         except Exception as e:
             # We need to mark failure in state machine here somehow....
             #log.err(e) # note: this causes error in tests
@@ -705,7 +766,7 @@ class GenericBackend(service.Service):
         dst_target = self.connection_manager.getTarget(conn.dest_port,   conn.dest_label)
         try:
             log.msg('Connection %s: Deactivating data plane...' % conn.connection_id, system=self.log_system)
-            yield self.connection_manager.teardownLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
+            yield self.link_batcher.teardownLink(conn.connection_id, src_target, dst_target, conn.bandwidth)
         except Exception as e:
             # We need to mark failure in state machine here somehow....
             log.msg('Connection %s: Error deactivating data plane: %s' % (conn.connection_id, str(e)), system=self.log_system)
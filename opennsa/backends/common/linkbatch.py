@@ -0,0 +1,154 @@
+"""
+Batching of link setup and teardown.
+
+Connection managers can optionally implement setupLinks and teardownLinks,
+which take a list of (connection_id, source_target, dest_target, bandwidth)
+tuples, and return a deferred firing with a list of (success, result) tuples
+in the same order (like a DeferredList). This allows a backend to configure
+several links in one device session / commit.
+
+The LinkBatcher collects setup and teardown requests for a short window, and
+sends them to the connection manager as batches. If a batch fails as a whole,
+its links are sent one at the time, so a single bad link does not fail the
+others. Connection managers without the batch interface are called directly.
+"""
+
+from twisted.python import log, failure
+from twisted.internet import reactor, defer
+
+
+LOG_SYSTEM = 'opennsa.LinkBatch'
+
+BATCH_WINDOW = 0.5 # seconds, setups and teardowns requested within this window are sent as one batch
+
+SETUP       = 'setup'
+TEARDOWN    = 'teardown'
+
+
+
+@defer.inlineCallbacks
+def sendBatch(links, createCommands, sendCommands):
+    """
+    Utility for connection managers, which configure devices with commands.
+    The commands for each link are created with createCommands(*link), and
+    all of them are sent with one sendCommands call. A link fails on its own
+    if its commands cannot be created. If sending the commands fails, the
+    commands of each link are sent on their own, so every link gets its own
+    result (a device typically rejects the whole commit for one bad link).
+    """
+    results = [ None ] * len(links)
+    link_commands = [] # (idx, commands)
+
+    for idx, link in enumerate(links):
+        try:
+            link_commands.append( (idx, createCommands(*link)) )
+        except Exception:
+            results[idx] = (False, failure.Failure())
+
+    if len(link_commands) > 1:
+        try:
+            yield sendCommands( [ cmd for _, commands in link_commands for cmd in commands ] )
+            for idx, _ in link_commands:
+                results[idx] = (True, None)
+            link_commands = []
+        except Exception as e:
+            log.msg('Sending commands for %i links failed (%s), sending them one link at the time' % (len(link_commands), e), system=LOG_SYSTEM)
+
+    for idx, commands in link_commands:
+        try:
+            yield sendCommands(commands)
+            results[idx] = (True, None)
+        except Exception:
+            results[idx] = (False, failure.Failure())
+
+    defer.returnValue(results)
+
+
+
+class LinkBatcher:
+
+    def __init__(self, connection_manager, log_system=LOG_SYSTEM, window=BATCH_WINDOW):
+        self.connection_manager = connection_manager
+        self.log_system = log_system
+        self.window = window
+        self.batching = hasattr(connection_manager, 'setupLinks') and hasattr(connection_manager, 'teardownLinks')
+
+        self.pending = { SETUP: [], TEARDOWN: [] } # kind -> [ (link, Deferred) ]
+        self.flush_call = None
+
+        self.clock = reactor
+
+
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+        if not self.batching:
+            return self.connection_manager.setupLink(connection_id, source_target, dest_target, bandwidth)
+        return self._add(SETUP, (connection_id, source_target, dest_target, bandwidth) )
+
+
+    def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
+        if not self.batching:
+            return self.connection_manager.teardownLink(connection_id, source_target, dest_target, bandwidth)
+        return self._add(TEARDOWN, (connection_id, source_target, dest_target, bandwidth) )
+
+
+    def _add(self, kind, link):
+        d = defer.Deferred()
+        self.pending[kind].append( (link, d) )
+        if self.flush_call is None:
+            self.flush_call = self.clock.callLater(self.window, self.flush)
+        return d
+
+
+    def flush(self):
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        setups, teardowns = self.pending[SETUP], self.pending[TEARDOWN]
+        self.pending = { SETUP: [], TEARDOWN: [] }
+
+        # teardowns first, so resources they free can be used by the setups
+        d = defer.succeed(None)
+        if teardowns:
+            d = self._sendBatch(TEARDOWN, teardowns)
+        if setups:
+            d.addBoth(lambda _ : self._sendBatch(SETUP, setups))
+        return d
+
+
+    def _sendBatch(self, kind, batch):
+        # returns a deferred, which fires (with None) when all links in the batch are done
+        cm = self.connection_manager
+        sendLinks, sendLink = (cm.setupLinks, cm.setupLink) if kind == SETUP else (cm.teardownLinks, cm.teardownLink)
+
+        def gotResults(results):
+            for (_, d), (success, result) in zip(batch, results):
+                if success:
+                    d.callback(result)
+                else:
+                    d.errback(result)
+
+        def batchFailed(err):
+            if len(batch) == 1:
+                batch[0][1].errback(err)
+                return
+            log.msg('Batch of %i link %ss failed (%s), sending them one at the time' % (len(batch), kind, err.getErrorMessage()), system=self.log_system)
+            return self._sendSingly(sendLink, batch)
+
+        if len(batch) > 1:
+            log.msg('Sending %i link %ss as one batch' % (len(batch), kind), system=self.log_system)
+
+        d = defer.maybeDeferred(sendLinks, [ link for link, _ in batch ])
+        d.addCallbacks(gotResults, batchFailed)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _sendSingly(self, sendLink, batch):
+        for link, d in batch:
+            try:
+                result = yield sendLink(*link)
+            except Exception:
+                d.errback(failure.Failure())
+            else:
+                d.callback(result)
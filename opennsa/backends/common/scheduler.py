@@ -1,19 +1,26 @@
 """
 Call scheduler. Handles one future call per connection.
 
+All calls are kept in a heap ordered by fire time, with a single reactor
+timer armed for the earliest one. Calls that are due when the timer fires
+are made as one batch.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011)
 """
 
+import heapq
 import datetime
 
 from twisted.python import log
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer
 
 
 
 LOG_SYSTEM = 'opennsa.Scheduler'
 
+COMPACT_THRESHOLD = 1024 # rebuild the heap when it has this many cancelled entries, and they are the majority
+
 
 
 def deferTaskFailed(err):
@@ -25,35 +32,59 @@ def deferTaskFailed(err):
 
 
 
+class _ScheduledCall:
+
+    __slots__ = ('fire_time', 'connection_id', 'call', 'args', 'cancelled')
+
+    def __init__(self, fire_time, connection_id, call, args):
+        self.fire_time      = fire_time
+        self.connection_id  = connection_id
+        self.call           = call
+        self.args           = args
+        self.cancelled      = False
+
+
+
 class CallScheduler:
 
-    def __init__(self):
-        self.scheduled_calls = {}
+    def __init__(self, connection_locks=None):
+        self.connection_locks = connection_locks # KeyedLock, calls are made with the connection lock held, if set
+        self.waiting_calls = {}     # connection_id -> _ScheduledCall, due calls waiting for the connection lock
+
+        self.scheduled_calls = {}   # connection_id -> _ScheduledCall
+        self.heap = []              # (fire_time, sequence, _ScheduledCall), cancelled calls are removed lazily
+        self.sequence = 0           # tie breaker, calls with the same fire time are made in scheduling order
+        self.cancelled = 0          # number of cancelled calls in the heap
+
+        self.timer = None           # reactor DelayedCall for the earliest call
+        self.timer_time = None
+
+        self.calls_made = 0
+        self.last_lag = 0.0         # seconds between the fire time and when the call was made
+        self.max_lag = 0.0
+
         self.clock = reactor # this is needed in order to test scheduled calls
 
 
     def scheduleCall(self, connection_id, transition_time, call, *args):
         assert callable(call), 'call argument is not a callable'
-
-        try:
-            sched_call = self.scheduled_calls[connection_id]
-            assert sched_call.called is True, 'Connection %s: Attempt to schedule transition with existing schedule transition' % connection_id
-        except KeyError:
-            pass # no scheduled call
+        assert connection_id not in self.scheduled_calls, 'Connection %s: Attempt to schedule transition with existing schedule transition' % connection_id
 
         dt_now = datetime.datetime.utcnow()
 
         # allow a bit leeway in transition to avoid odd race conditions
         assert transition_time >= (dt_now - datetime.timedelta(seconds=1)), 'Scheduled transition is not in the future (%s >= %s is False)' % (transition_time, dt_now)
 
-        td = (transition_time - dt_now)
-        transition_delta_seconds = (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) / 10**6.0
-        transition_delta_seconds = max(transition_delta_seconds, 0) # if dt_now is passed during calculation
+        # if dt_now is passed during calculation, the call is made on the next timer
+        fire_time = self.clock.seconds() + max( (transition_time - dt_now).total_seconds(), 0)
 
-        d = task.deferLater(self.clock, transition_delta_seconds, call, *args)
-        d.addErrback(deferTaskFailed)
-        self.scheduled_calls[connection_id] = d
-        return d
+        sc = _ScheduledCall(fire_time, connection_id, call, args)
+        self.scheduled_calls[connection_id] = sc
+        heapq.heappush(self.heap, (fire_time, self.sequence, sc) )
+        self.sequence += 1
+
+        if self.timer_time is None or fire_time < self.timer_time:
+            self._armTimer(fire_time)
 
 
     def hasScheduledCall(self, connection_id):
@@ -61,15 +92,88 @@ class CallScheduler:
 
 
     def cancelCall(self, connection_id):
+        waiting_call = self.waiting_calls.pop(connection_id, None)
+        if waiting_call is not None:
+            waiting_call.cancelled = True # due, but not made yet
         try:
-            sched_call = self.scheduled_calls.pop(connection_id)
-            sched_call.cancel()
+            sc = self.scheduled_calls.pop(connection_id)
         except KeyError:
-            pass
+            return
+        sc.cancelled = True
+        self.cancelled += 1
+        if self.cancelled > COMPACT_THRESHOLD and self.cancelled * 2 > len(self.heap):
+            self.heap = [ entry for entry in self.heap if not entry[2].cancelled ]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        # the timer is left armed, if the call was the earliest one, the timer just rearms
 
 
     def cancelAllCalls(self):
-        for d in self.scheduled_calls.values():
-            d.cancel()
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = None
+        self.timer_time = None
+        for sc in self.waiting_calls.values():
+            sc.cancelled = True
+        self.waiting_calls = {}
         self.scheduled_calls = {}
-
+        self.heap = []
+        self.cancelled = 0
+
+
+    def stats(self):
+        return { 'pending': len(self.scheduled_calls), 'calls': self.calls_made, 'last_lag': self.last_lag, 'max_lag': self.max_lag }
+
+
+    def _armTimer(self, fire_time):
+        if self.timer is not None:
+            self.timer.cancel()
+        delay = max(fire_time - self.clock.seconds(), 0)
+        self.timer = self.clock.callLater(delay, self._fireCalls)
+        self.timer_time = fire_time
+
+
+    def _fireCalls(self):
+        self.timer = None
+        self.timer_time = None
+
+        now = self.clock.seconds()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, sc = heapq.heappop(self.heap)
+            if sc.cancelled:
+                self.cancelled -= 1
+            else:
+                del self.scheduled_calls[sc.connection_id]
+                due.append(sc)
+
+        # skip cancelled calls at the head, so the timer is not armed for them
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+        if self.heap:
+            self._armTimer(self.heap[0][0])
+
+        if due:
+            self.last_lag = now - due[0].fire_time
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.calls_made += len(due)
+            if len(due) > 1:
+                log.msg('Making %i scheduled calls' % len(due), debug=True, system=LOG_SYSTEM)
+
+        for sc in due:
+            if self.connection_locks is None:
+                d = defer.maybeDeferred(sc.call, *sc.args)
+            else:
+                self.waiting_calls[sc.connection_id] = sc
+                d = self.connection_locks.run(sc.connection_id, self._makeWaitingCall, sc)
+            d.addErrback(deferTaskFailed)
+
+
+    def _makeWaitingCall(self, sc):
+        # called with the connection lock held, the call may have been cancelled while waiting for it
+        if self.waiting_calls.get(sc.connection_id) is sc:
+            del self.waiting_calls[sc.connection_id]
+        if not sc.cancelled:
+            return sc.call(*sc.args)
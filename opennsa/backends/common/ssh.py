@@ -1,15 +1,23 @@
 """
-Basic SSH connectivity.
+Basic SSH connectivity, and a connection pool for keeping SSH connections to
+devices open between command batches.
 """
 
-from twisted.python import log
-from twisted.internet import defer, protocol, reactor, endpoints
+from twisted.python import log, failure
+from twisted.internet import defer, protocol, reactor, endpoints, error as interneterror
 from twisted.conch import error as concherror
 from twisted.conch.ssh import transport, keys, userauth, connection, channel
 
 
 LOG_SYSTEM = 'opennsa.SSH'
 
+DEFAULT_CHANNELS    = 4     # concurrent channels per device connection
+KEEPALIVE_INTERVAL  = 30    # seconds between keepalives, a connection is dropped if a keepalive is unanswered by the next one
+IDLE_TIMEOUT        = 300   # seconds, connections without channels for this long are closed
+COMMAND_TIMEOUT     = 180   # seconds, a command batch (channel) running longer than this is closed
+
+KEEPALIVE_REQUEST   = b'keepalive@openssh.com'
+
 
 
 class SSHClientTransport(transport.SSHClientTransport):
@@ -20,6 +28,8 @@ class SSHClientTransport(transport.SSHClientTransport):
 
 
     def verifyHostKey(self, public_key, fingerprint):
+        if isinstance(fingerprint, bytes): # configured fingerprints are text
+            fingerprint = fingerprint.decode()
         if fingerprint in self.fingerprints:
             return defer.succeed(1)
         else:
@@ -78,7 +88,7 @@ class PasswordUserAuthClient(userauth.SSHUserAuthClient):
         self.password = password
 
     def getPassword(self, prompt=None):
-        return defer.succeed( self.password )
+        return defer.succeed( self.password.encode() )
 
 
 
@@ -88,25 +98,63 @@ class SSHConnection(connection.SSHConnection):
         connection.SSHConnection.__init__(self)
         self.ssh_connection_established_d = defer.Deferred()
 
+        self.ssh_connection_lost_d = defer.Deferred()
+
     def serviceStarted(self):
         self.ssh_connection_established_d.callback(self)
 
+    def serviceStopped(self):
+        connection.SSHConnection.serviceStopped(self)
+        self.ssh_connection_lost_d.callback(self)
+
 
 
 class SSHChannel(channel.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, localWindow=0, localMaxPacket=0, remoteWindow=0, remoteMaxPacket=0, conn=None, data=None, avatar=None):
         channel.SSHChannel.__init__(self, localWindow, localMaxPacket, remoteWindow, remoteMaxPacket, conn, data, avatar)
         self.channel_open = defer.Deferred()
 
+        # sub-classes wait for device output with wait_defer, optionally with a timeout in delayed_call
+        self.wait_defer   = None
+        self.delayed_call = None
+
 
     def channelOpen(self, data):
         self.channel_open.callback(self)
         log.msg('SSH channel open.', debug=True, system=LOG_SYSTEM)
 
 
+    def openFailed(self, reason):
+        self.channel_open.errback(reason)
+
+
+    def closed(self):
+        if not self.channel_open.called: # connection lost before the channel was opened
+            self.channel_open.errback(interneterror.ConnectionLost('SSH connection lost before channel was opened'))
+        # the device output will never come now
+        self.failWait(interneterror.ConnectionLost('SSH channel closed while waiting for device output'))
+
+
+    def failWait(self, err):
+        # fail the pending wait for device output, if any
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+        wait_defer, self.wait_defer = self.wait_defer, None
+        if wait_defer is not None and not wait_defer.called:
+            wait_defer.errback(err)
+
+
+    def write(self, data):
+        # commands are text, the channel sends bytes
+        if isinstance(data, str):
+            data = data.encode()
+        channel.SSHChannel.write(self, data)
+
+
     def request_exit_status(self, data):
         if data and len(data) != 4:
             log.msg('Exit status data: %s' % data, system=LOG_SYSTEM)
@@ -118,7 +166,8 @@ class SSHChannel(channel.SSHChannel):
 
 
     def closeIt(self, passthru=None):
-        self.loseConnection()
+        if not self.localClosed: # already closed, e.g., when the connection was lost
+            self.loseConnection()
         return passthru
 
 
@@ -163,10 +212,11 @@ class SSHConnectionCreator:
 
         def gotTCPConnection(proto):
             ssh_connection = SSHConnection()
+            username = self.username.encode() # ssh user names are bytes in conch
             if self.public_key_path and self.private_key_path:
-                proto.requestService(KeyUserAuthClient(self.username, ssh_connection, self.public_key_path, self.private_key_path))
+                proto.requestService(KeyUserAuthClient(username, ssh_connection, self.public_key_path, self.private_key_path))
             elif self.password:
-                proto.requestService(PasswordUserAuthClient(self.username, ssh_connection, self.password))
+                proto.requestService(PasswordUserAuthClient(username, ssh_connection, self.password))
             else:
                 raise AssertionError('No ssh keys or password supplied')
 
@@ -176,3 +226,224 @@ class SSHConnectionCreator:
         d.addCallback(gotTCPConnection)
         return d
 
+
+
+
+class SSHConnectionPool:
+    """
+    Keeps an SSH connection to a device open, and runs command channels on it,
+    so key exchange and authentication are only done when connecting.
+
+    At most max_channels channels are open at the time, further requests wait
+    for a channel. A channel which fails, or has not completed within
+    command_timeout seconds (e.g., waiting for a prompt which never comes), is
+    closed, so it does not hold on to the slot. The connection is kept alive
+    with keepalives, closed when it has been idle for idle_timeout seconds, and
+    recreated when needed.
+    """
+    def __init__(self, connection_creator, max_channels=DEFAULT_CHANNELS, idle_timeout=IDLE_TIMEOUT, keepalive_interval=KEEPALIVE_INTERVAL,
+                 command_timeout=COMMAND_TIMEOUT):
+        self.connection_creator = connection_creator
+        self.max_channels       = max_channels
+        self.channel_slots      = defer.DeferredSemaphore(max_channels)
+        self.idle_timeout       = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.command_timeout    = command_timeout
+
+        self.ssh_connection = None
+        self.connecting = None          # [ Deferred ] waiting for the connection being created
+        self.open_channels = 0
+        self.last_used = 0
+        self.keepalive_pending = False
+        self.check_call = None
+
+        self.connections_created = 0
+        self.channels_opened = 0
+        self.channels_timed_out = 0
+
+        self.clock = reactor
+
+
+    def getConnection(self):
+        if self.ssh_connection is not None:
+            return defer.succeed(self.ssh_connection)
+
+        d = defer.Deferred()
+        if self.connecting is None:
+            # since creating a new connection should be uncommon, we log it
+            log.msg('Creating new SSH connection to %s:%s' % (self.connection_creator.host, self.connection_creator.port), system=LOG_SYSTEM)
+            self.connecting = [ d ]
+            cd = self.connection_creator.getSSHConnection()
+            cd.addCallbacks(self._connected, self._connectFailed)
+        else:
+            self.connecting.append(d)
+        return d
+
+
+    def _connected(self, ssh_connection):
+        self.ssh_connection = ssh_connection
+        self.connections_created += 1
+        self.last_used = self.clock.seconds()
+        self.keepalive_pending = False
+        ssh_connection.ssh_connection_lost_d.addCallback(self._connectionLost)
+        self._scheduleCheck()
+
+        waiting, self.connecting = self.connecting, None
+        for d in waiting:
+            d.callback(ssh_connection)
+
+
+    def _connectFailed(self, err):
+        log.msg('Error creating SSH connection to %s:%s: %s' % (self.connection_creator.host, self.connection_creator.port, err.getErrorMessage()), system=LOG_SYSTEM)
+        waiting, self.connecting = self.connecting, None
+        for d in waiting:
+            d.errback(err)
+
+
+    def _connectionLost(self, ssh_connection):
+        if self.ssh_connection is ssh_connection:
+            log.msg('SSH connection to %s:%s lost' % (self.connection_creator.host, self.connection_creator.port), system=LOG_SYSTEM)
+            self.ssh_connection = None
+
+
+    def _dropConnection(self, ssh_connection):
+        if self.ssh_connection is ssh_connection:
+            self.ssh_connection = None
+        ssh_connection.transport.loseConnection()
+
+
+    def runChannel(self, createChannel, f, *args):
+        """
+        Open a channel, created with createChannel(ssh_connection), and call
+        f(channel, *args) when it is open. Returns a deferred with the result of f.
+        If f fails or times out, the channel is closed.
+        """
+        return self.channel_slots.run(self._runChannel, createChannel, f, *args)
+
+
+    def _commandTimedOut(self, result, timeout):
+        self.channels_timed_out += 1
+        log.msg('Command on SSH connection to %s:%s did not complete in %s seconds, closing channel' % \
+                (self.connection_creator.host, self.connection_creator.port, timeout), system=LOG_SYSTEM)
+        if isinstance(result, failure.Failure):
+            result.trap(defer.CancelledError)
+            raise defer.TimeoutError(timeout, 'SSH command did not complete')
+        return result
+
+
+    @defer.inlineCallbacks
+    def _runChannel(self, createChannel, f, *args):
+        channel = yield self._openChannel(createChannel)
+        self.open_channels += 1
+        try:
+            d = defer.maybeDeferred(f, channel, *args)
+            d.addTimeout(self.command_timeout, self.clock, onTimeoutCancel=self._commandTimedOut)
+            result = yield d
+        except Exception:
+            channel.closeIt() # the device may be stuck, or in an unknown state
+            raise
+        finally:
+            self.open_channels -= 1
+            self.last_used = self.clock.seconds()
+        defer.returnValue(result)
+
+
+    @defer.inlineCallbacks
+    def _openChannel(self, createChannel, retry=True):
+        ssh_connection = yield self.getConnection()
+        channel = createChannel(ssh_connection)
+        ssh_connection.openChannel(channel)
+        try:
+            yield channel.channel_open
+        except Exception as e:
+            if not retry:
+                raise
+            # the device may have closed the connection, while it was idle in the pool
+            log.msg('Could not open channel on SSH connection (%s), reconnecting' % str(e), system=LOG_SYSTEM)
+            self._dropConnection(ssh_connection)
+            channel = yield self._openChannel(createChannel, retry=False)
+
+        self.channels_opened += 1
+        defer.returnValue(channel)
+
+
+    def _scheduleCheck(self):
+        if self.check_call is None or not self.check_call.active():
+            self.check_call = self.clock.callLater(self.keepalive_interval, self._checkConnection)
+
+
+    def _checkConnection(self):
+        self.check_call = None
+        ssh_connection = self.ssh_connection
+        if ssh_connection is None:
+            return
+
+        if self.open_channels == 0 and self.clock.seconds() - self.last_used >= self.idle_timeout:
+            log.msg('Closing idle SSH connection to %s:%s' % (self.connection_creator.host, self.connection_creator.port), debug=True, system=LOG_SYSTEM)
+            self._dropConnection(ssh_connection)
+            return
+
+        if self.keepalive_pending:
+            log.msg('No keepalive reply from %s:%s, dropping connection' % (self.connection_creator.host, self.connection_creator.port), system=LOG_SYSTEM)
+            self._dropConnection(ssh_connection)
+            return
+
+        def keepaliveReply(_):
+            # any reply, including a request failure, means the device is alive
+            if self.ssh_connection is ssh_connection:
+                self.keepalive_pending = False
+
+        self.keepalive_pending = True
+        d = ssh_connection.sendGlobalRequest(KEEPALIVE_REQUEST, b'', wantReply=True)
+        d.addBoth(keepaliveReply)
+        self._scheduleCheck()
+
+
+    def close(self):
+        """
+        Close the connection, if any. Returns a deferred, which fires when it is closed.
+        """
+        if self.check_call is not None and self.check_call.active():
+            self.check_call.cancel()
+        self.check_call = None
+        if self.ssh_connection is None:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.ssh_connection.ssh_connection_lost_d.addBoth(lambda _ : d.callback(None))
+        self._dropConnection(self.ssh_connection)
+        return d
+
+
+    def stats(self):
+        return { 'connected': self.ssh_connection is not None, 'open_channels': self.open_channels,
+                 'connections_created': self.connections_created, 'channels_opened': self.channels_opened,
+                 'channels_timed_out': self.channels_timed_out }
+
+
+
+_POOLS = {} # (host, port, username) -> SSHConnectionPool
+
+
+def getConnectionPool(connection_creator, max_channels=DEFAULT_CHANNELS):
+    """
+    Get the connection pool for the device of the connection creator. Backends
+    for the same device and user share the pool, and with it the channel limit.
+    """
+    key = (connection_creator.host, connection_creator.port, connection_creator.username)
+    try:
+        pool = _POOLS[key]
+        if pool.max_channels != max_channels:
+            log.msg('SSH connection pool for %s:%s already exists with %i channels, ignoring request for %i channels' % \
+                    (connection_creator.host, connection_creator.port, pool.max_channels, max_channels), system=LOG_SYSTEM)
+        return pool
+    except KeyError:
+        pool = SSHConnectionPool(connection_creator, max_channels)
+        _POOLS[key] = pool
+        return pool
+
+
+def closeConnectionPools():
+    # called when the service stops, returns a deferred, which fires when all connections are closed
+    defs = [ pool.close() for pool in _POOLS.values() ]
+    _POOLS.clear()
+    return defer.DeferredList(defs)
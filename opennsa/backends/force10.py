@@ -55,11 +55,14 @@ from twisted.python import log
 from twisted.internet import defer
 from twisted.conch.ssh import session
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, error
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'Force10'
 
+# the device reports failed commands with this, and gives a new prompt
+ERROR_OUTPUT = ('% Error',)
+
 
 
 COMMAND_ENABLE          = 'enable'
@@ -118,7 +121,7 @@ def _createTeardownCommands(source_nrm_port, dest_nrm_port):
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -137,9 +140,9 @@ class SSHChannel(ssh.SSHChannel):
             log.msg('Requesting shell for sending commands', debug=True, system=LOG_SYSTEM)
             term = os.environ.get('TERM', 'xterm')
             winSize = (25,80,0,0)
-            ptyReqData = session.packRequest_pty_req(term, winSize, '')
-            yield self.conn.sendRequest(self, 'pty-req', ptyReqData, wantReply=1)
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            ptyReqData = session.packRequest_pty_req(term.encode(), winSize, b'')
+            yield self.conn.sendRequest(self, b'pty-req', ptyReqData, wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
             log.msg('Got shell', system=LOG_SYSTEM, debug=True)
 
             d = self.waitForData('>')
@@ -198,52 +201,40 @@ class SSHChannel(ssh.SSHChannel):
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         log.msg("DATA:" + data, system=LOG_SYSTEM, debug=True)
         if len(data) == 0:
             pass
         else:
             self.data += data
             if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
+                output = self.data
                 self.data       = ''
                 self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
+                if any( e in output for e in ERROR_OUTPUT ):
+                    # the device gives a prompt after the error as well
+                    self.failWait( error.InternalNRMError('Error from device: %s' % output.strip()) )
+                else:
+                    d = self.wait_defer
+                    self.wait_defer = None
+                    d.callback(self)
 
 
 
 
 class Force10CommandSender:
 
-    def __init__(self, ssh_connection_creator, enable_password):
+    def __init__(self, ssh_connection_creator, enable_password, ssh_channels=1):
 
-        self.ssh_connection_creator = ssh_connection_creator
+        # Note: FTOS does not allow multiple channels in an SSH connection at the same time,
+        # so the default is one channel, the connection is kept open between requests
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
         self.enable_password = enable_password
 
 
-    @defer.inlineCallbacks
     def sendCommands(self, commands):
 
-        # Note: FTOS does not allow multiple channels in an SSH connection,
-        # so we open a connection for each request. Party like it is 1988.
-
-        # The "correct" solution for this would be to create a connection pool,
-        # but that won't happen just now.
-
-        log.msg('Creating new SSH connection', debug=True, system=LOG_SYSTEM)
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            channel = SSHChannel(conn=ssh_connection)
-            ssh_connection.openChannel(channel)
-            log.msg("Opening channel", system=LOG_SYSTEM, debug=True)
-
-            yield channel.channel_open
-            log.msg("Channel open, sending commands", system=LOG_SYSTEM, debug=True)
-            yield channel.sendCommands(commands, self.enable_password)
-
-        finally:
-            ssh_connection.transport.loseConnection()
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands, self.enable_password)
 
 
 
@@ -268,8 +259,10 @@ class Force10ConnectionManager:
             ssh_private_key  = cfg[config.FORCE10_SSH_PRIVATE_KEY]
             ssh_connection_creator = ssh.SSHConnectionCreator(host, port, [ host_fingerprint ], user, ssh_public_key, ssh_private_key)
 
+        ssh_channels = int(cfg.get(config.FORCE10_SSH_CHANNELS, 1))
+
         # this will blow up when used with ssh keys
-        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password)
+        self.command_sender = Force10CommandSender(ssh_connection_creator, enable_password=password, ssh_channels=ssh_channels)
 
 
     def getResource(self, port, label):
@@ -318,4 +311,4 @@ class Force10ConnectionManager:
 def Force10Backend(network_name, network_topology, parent_requester, port_map, configuration):
     name = 'Force10 %s' % network_name
     cm = Force10ConnectionManager(name, port_map, configuration)
-    return genericbackend.GenericBackend(network_name, network_topology, cm, parent_requester, name)
+    return genericbackend.GenericBackend(network_name, network_topology, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(configuration))
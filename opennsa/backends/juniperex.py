@@ -25,7 +25,7 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, error
 from opennsa.backends.common import genericbackend, ssh
 
 
@@ -43,6 +43,9 @@ COMMAND_DELETE_INTERFACE_VLAN   = 'delete interfaces %s unit 0 family ethernet-s
 
 LOG_SYSTEM = 'JuniperEX'
 
+# the device reports failed commands and commits with these, and stays in configuration mode
+ERROR_OUTPUT = ('error:', 'syntax error')
+
 
 
 
@@ -68,7 +71,7 @@ def createDeleteCommands(source_nrm_port, dest_nrm_port, vlan):
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -84,7 +87,7 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
             d = self.waitForLine('>')
             self.write(COMMAND_CONFIGURE + LT)
             yield d
@@ -130,11 +133,13 @@ class SSHChannel(ssh.SSHChannel):
                 self.wait_line  = None
                 self.wait_defer = None
                 d.callback(self)
-            else:
-                pass
+            elif line.startswith(ERROR_OUTPUT):
+                self.wait_line = None
+                self.failWait( error.InternalNRMError('Error from device: %s' % line) )
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         if len(data) == 0:
             pass
         else:
@@ -150,48 +155,17 @@ class SSHChannel(ssh.SSHChannel):
 class JuniperEXCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, ssh_channels=ssh.DEFAULT_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-
-
-    def _getSSHChannel(self):
-
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
-
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
-
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
 
 
     def _sendCommands(self, commands):
 
-        def gotChannel(channel):
-            d = channel.sendCommands(commands)
-            return d
-
-        d = self._getSSHChannel()
-        d.addCallback(gotChannel)
-        return d
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands)
 
 
     def setupLink(self, source_nrm_port, dest_nrm_port, vlan):
@@ -225,10 +199,10 @@ class JunosEXTarget(object):
 
 class JuniperEXConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, ssh_channels=ssh.DEFAULT_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperEXCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, ssh_channels)
 
 
     def getResource(self, port, label):
@@ -291,6 +265,7 @@ def JuniperEXBackend(network_name, nrm_ports, parent_requester, cfg):
     user             = cfg[config.JUNIPER_USER]
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
+    ssh_channels     = int(cfg.get(config.JUNIPER_SSH_CHANNELS, ssh.DEFAULT_CHANNELS))
 
-    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    cm = JuniperEXConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, ssh_channels)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
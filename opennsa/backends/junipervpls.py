@@ -71,12 +71,15 @@ Copyright: NORDUnet (2017)
 from twisted.python import log
 from twisted.internet import defer, reactor
 
-from opennsa import constants as cnt, config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa import constants as cnt, config, error
+from opennsa.backends.common import genericbackend, ssh, linkbatch
 
 
 LOG_SYSTEM = 'JuniperVPLS'
 
+# the device reports failed commands and commits with these, and stays in configuration mode
+ERROR_OUTPUT = ('error:', 'syntax error')
+
 
 # JunOS commands, static
 CONFIGURE   = 'configure private'
@@ -105,7 +108,7 @@ SET_RI_VPLS_SITE            = 'set routing-instances {instance} protocols vpls s
 
 # Delete statements
 DELETE_UNIT             = 'delete interfaces {interface} unit {unit}'
-DELETE_ROUTING_INSTANCE = 'delete routing-instance {instance}'
+DELETE_ROUTING_INSTANCE = 'delete routing-instances {instance}'
 
 
 
@@ -149,7 +152,7 @@ def createDeleteCommands(source_port, dest_port, vlan, instance_id):
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -165,7 +168,7 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
             d = self.waitForLine('[edit]', 3)
             self.write(CONFIGURE + LT)
@@ -207,9 +210,7 @@ class SSHChannel(ssh.SSHChannel):
     def waitTimeout(self):
         log.msg('Timeout while waiting for line: ' + self.wait_line, system=LOG_SYSTEM)
         self.wait_line  = None
-        wd = self.wait_defer = None
-        self.delayed_call = None
-        defer.timeout(wd)
+        self.failWait(defer.TimeoutError('Timeout while waiting for device output'))
 
 
     def matchLine(self, line):
@@ -228,6 +229,10 @@ class SSHChannel(ssh.SSHChannel):
                     self.delayed_call = None
                 d.callback(self)
 
+            elif line.startswith(ERROR_OUTPUT):
+                self.wait_line = None
+                self.failWait( error.InternalNRMError('Error from device: %s' % line) )
+
             else:
                 log.msg('Discarding wait line: ' + line, debug=True, system=LOG_SYSTEM)
 
@@ -237,6 +242,7 @@ class SSHChannel(ssh.SSHChannel):
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         if len(data) == 0:
             pass
         else:
@@ -252,51 +258,21 @@ class SSHChannel(ssh.SSHChannel):
 class JuniperVPLSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, ssh_channels=ssh.DEFAULT_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-
+        # configure private is used, so channels can configure the device at the same time
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
 
-    def _getSSHChannel(self):
-
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
-
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
-
-        if self.ssh_connection and not self.ssh_connection.transport.factory.stopped:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
 
+    def sendCommands(self, commands):
 
-    def _sendCommands(self, commands):
-
-        def gotChannel(channel):
-            d = channel.sendCommands(commands)
-            return d
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands)
 
-        d = self._getSSHChannel()
-        d.addCallback(gotChannel)
-        return d
 
-
-    def setupLink(self, source_port, dest_port, vlan, instance_id, as_number):
+    def createSetupCommands(self, source_port, dest_port, vlan, instance_id, as_number):
 
         # createSetupCommands(source_port, dest_port, vlan, instance_id, description, route_distinguiser, vrf_target)
 
@@ -305,18 +281,19 @@ class JuniperVPLSCommandSender:
         route_distinguisher = as_number + ':' + unique_id
         vrf_target = 'target:' + as_number + ':' + unique_id
 
-        commands = createSetupCommands(source_port, dest_port, vlan, instance_id, description, route_distinguisher, vrf_target)
+        return createSetupCommands(source_port, dest_port, vlan, instance_id, description, route_distinguisher, vrf_target)
 
-        return self._sendCommands(commands)
 
+    def setupLink(self, source_port, dest_port, vlan, instance_id, as_number):
 
-    def teardownLink(self, source_port, dest_port, vlan, instance_id):
+        commands = self.createSetupCommands(source_port, dest_port, vlan, instance_id, as_number)
+        return self.sendCommands(commands)
 
-        # createDeleteCommands(source_port, dest_port, vlan, instance_id)
 
-        commands = createDeleteCommands(source_port, dest_port, vlan, instance_id)
+    def teardownLink(self, source_port, dest_port, vlan, instance_id):
 
-        return self._sendCommands(commands)
+        commands = createDeleteCommands(source_port, dest_port, vlan, instance_id)
+        return self.sendCommands(commands)
 
 
 # --------
@@ -336,10 +313,10 @@ class JunosUnitTarget(object):
 class JuniperVPLSConnectionManager:
 
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number, ssh_channels=ssh.DEFAULT_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key)
+        self.command_sender = JuniperVPLSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, ssh_channels)
         self.as_number = as_number
 
 
@@ -396,6 +373,36 @@ class JuniperVPLSConnectionManager:
         return d
 
 
+    def setupLinks(self, links):
+
+        def createCommands(connection_id, source_target, dest_target, bandwidth):
+            assert source_target.vlan == dest_target.vlan, 'Source and destination vlan must match'
+            return self.command_sender.createSetupCommands(source_target.port, dest_target.port, dest_target.vlan, connection_id, self.as_number)
+
+        def linksUp(results):
+            log.msg('%i of %i links setup done' % (len([ r for r in results if r[0] ]), len(results)), system=LOG_SYSTEM)
+            return results
+
+        d = linkbatch.sendBatch(links, createCommands, self.command_sender.sendCommands)
+        d.addCallback(linksUp)
+        return d
+
+
+    def teardownLinks(self, links):
+
+        def createCommands(connection_id, source_target, dest_target, bandwidth):
+            assert source_target.vlan == dest_target.vlan, 'Source and destination vlan must match'
+            return createDeleteCommands(source_target.port, dest_target.port, dest_target.vlan, connection_id)
+
+        def linksDown(results):
+            log.msg('%i of %i links teardown done' % (len([ r for r in results if r[0] ]), len(results)), system=LOG_SYSTEM)
+            return results
+
+        d = linkbatch.sendBatch(links, createCommands, self.command_sender.sendCommands)
+        d.addCallback(linksDown)
+        return d
+
+
 
 def JuniperVPLSBackend(network_name, nrm_ports, parent_requester, cfg):
 
@@ -411,6 +418,7 @@ def JuniperVPLSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
     as_number        = cfg[config.AS_NUMBER]
+    ssh_channels     = int(cfg.get(config.JUNIPER_SSH_CHANNELS, ssh.DEFAULT_CHANNELS))
 
-    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    cm = JuniperVPLSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, as_number, ssh_channels)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
@@ -15,8 +15,8 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import config
-from opennsa.backends.common import genericbackend, ssh
+from opennsa import config, error
+from opennsa.backends.common import genericbackend, ssh, linkbatch
 
 
 
@@ -52,11 +52,14 @@ COMMAND_REMOTE_CONNECTIONS_RECEIVE_LSP  = 'set protocols connections remote-inte
 
 LOG_SYSTEM = 'EX4550'
 
+# the device reports failed commands and commits with these, and stays in configuration mode
+ERROR_OUTPUT = ('error:', 'syntax error')
+
 
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -72,7 +75,7 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\r' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
             d = self.waitForLine('{master:0}[edit]')
             self.write(COMMAND_CONFIGURE + LT)
@@ -119,11 +122,13 @@ class SSHChannel(ssh.SSHChannel):
                 self.wait_line  = None
                 self.wait_defer = None
                 d.callback(self)
-            else:
-                pass
+            elif line.startswith(ERROR_OUTPUT):
+                self.wait_line = None
+                self.failWait( error.InternalNRMError('Error from device: %s' % line) )
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         if len(data) == 0:
             pass
         else:
@@ -140,67 +145,43 @@ class SSHChannel(ssh.SSHChannel):
 class JunosEx4550CommandSender:
 
     def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path,
-            network_name):
-        self.ssh_connection_creator = \
+            network_name, ssh_channels=1):
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
 
-        self.ssh_connection = None # cached connection
-        self.connection_lock = defer.DeferredLock()
+        # junos uses a shared candidate configuration, so by default only one channel
+        # configures the device at the time, otherwise a commit can include changes of another channel
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
         self.network_name = network_name
 
-    def _getSSHChannel(self):
 
-        def setSSHConnectionCache(ssh_connection):
-            log.msg('SSH Connection created and cached', system=LOG_SYSTEM)
-            self.ssh_connection = ssh_connection
-            return ssh_connection
+    def sendCommands(self, commands):
 
-        def gotSSHConnection(ssh_connection):
-            channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(channel)
-            return channel.channel_open
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands)
 
-        if self.ssh_connection:
-            log.msg('Reusing SSH connection', debug=True, system=LOG_SYSTEM)
-            return gotSSHConnection(self.ssh_connection)
-        else:
-            # since creating a new connection should be uncommon, we log it
-            # this makes it possible to see if something fucks up and creates connections continuously
-            log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-            d = self.ssh_connection_creator.getSSHConnection()
-            d.addCallback(setSSHConnectionCache)
-            d.addCallback(gotSSHConnection)
-            return d
 
+    def createSetupCommands(self, connection_id, source_port, dest_port, bandwidth):
 
-    @defer.inlineCallbacks
-    def _sendCommands(self, commands):
+        cg = JunosEx4550CommandGenerator(connection_id,source_port,dest_port,self.network_name,bandwidth)
+        return cg.generateActivateCommand()
 
-        channel = yield self._getSSHChannel()
-        log.msg('Acquiring ssh session lock', debug=True, system=LOG_SYSTEM)
-        yield self.connection_lock.acquire()
-        log.msg('Got ssh session lock', debug=True, system=LOG_SYSTEM)
 
-        try:
-            yield channel.sendCommands(commands)
-        finally:
-            log.msg('Releasing ssh session lock', debug=True, system=LOG_SYSTEM)
-            self.connection_lock.release()
-            log.msg('Released ssh session lock', debug=True, system=LOG_SYSTEM)
+    def createTeardownCommands(self, connection_id, source_port, dest_port, bandwidth):
+
+        cg = JunosEx4550CommandGenerator(connection_id,source_port,dest_port,self.network_name,bandwidth)
+        return cg.generateDeactivateCommand()
 
 
     def setupLink(self, connection_id, source_port, dest_port, bandwidth):
 
-        cg = JunosEx4550CommandGenerator(connection_id,source_port,dest_port,self.network_name,bandwidth)
-        commands = cg.generateActivateCommand() 
-        return self._sendCommands(commands)
+        commands = self.createSetupCommands(connection_id, source_port, dest_port, bandwidth)
+        return self.sendCommands(commands)
 
 
     def teardownLink(self, connection_id, source_port, dest_port, bandwidth):
 
-        cg = JunosEx4550CommandGenerator(connection_id,source_port,dest_port,self.network_name,bandwidth)
-        commands = cg.generateDeactivateCommand() 
-        return self._sendCommands(commands)
+        commands = self.createTeardownCommands(connection_id, source_port, dest_port, bandwidth)
+        return self.sendCommands(commands)
 
 
 class JunosEx4550Target(object):
@@ -221,11 +202,11 @@ class JunosEx4550Target(object):
 class JunosEx4550ConnectionManager:
 
     def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            network_name):
+            network_name, ssh_channels=1):
         self.network_name = network_name
         self.port_map = port_map
         self.command_sender = JunosEx4550CommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-                network_name)
+                network_name, ssh_channels)
 
 
     def getResource(self, port, label):
@@ -260,6 +241,24 @@ class JunosEx4550ConnectionManager:
         return d
 
 
+    def setupLinks(self, links):
+        def linksUp(results):
+            log.msg('%i of %i links up' % (len([ r for r in results if r[0] ]), len(results)), system=LOG_SYSTEM)
+            return results
+        d = linkbatch.sendBatch(links, self.command_sender.createSetupCommands, self.command_sender.sendCommands)
+        d.addCallback(linksUp)
+        return d
+
+
+    def teardownLinks(self, links):
+        def linksDown(results):
+            log.msg('%i of %i links down' % (len([ r for r in results if r[0] ]), len(results)), system=LOG_SYSTEM)
+            return results
+        d = linkbatch.sendBatch(links, self.command_sender.createTeardownCommands, self.command_sender.sendCommands)
+        d.addCallback(linksDown)
+        return d
+
+
 
 def JunosEXBackend(network_name, nrm_ports , parent_requester, cfg):
 
@@ -273,10 +272,11 @@ def JunosEXBackend(network_name, nrm_ports , parent_requester, cfg):
     user             = cfg[config.JUNIPER_USER]
     ssh_public_key   = cfg[config.JUNIPER_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.JUNIPER_SSH_PRIVATE_KEY]
+    ssh_channels     = int(cfg.get(config.JUNIPER_SSH_CHANNELS, 1))
 
     cm = JunosEx4550ConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key,
-            network_name)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+            network_name, ssh_channels)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
 
 
 class JunosEx4550CommandGenerator(object):
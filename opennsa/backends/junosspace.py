@@ -281,7 +281,7 @@ def JUNOSSPACEBackend(network_name, nrm_ports , parent_requester, cfg):
     log.msg("Junosspace local deactivate configlet id {}".format(LOCAL_DEACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
     log.msg("Junosspace remote deactivate configlet id {}".format(REMOTE_DEACTIVATE_CONFIGLET_ID),debug=True,system=LOG_SYSTEM)
 
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
 
 
 class JUNOSSPACECommandGenerator(object):
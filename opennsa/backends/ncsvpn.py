@@ -254,5 +254,5 @@ def NCSVPNBackend(network_name, nrm_ports, parent_requester, cfg):
     password         = cfg[config.NCS_PASSWORD]
 
     cm = NCSVPNConnectionManager(ncs_services_url, user, password, port_map, name)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
 
@@ -424,5 +424,5 @@ def OESSBackend(network_name, nrm_ports, parent_requester, cfg):
     oess_workgroup = cfg[config.OESS_WORKGROUP]
 
     cm = OESSConnectionManager(name, port_map, oess_url, oess_user, oess_pass, oess_workgroup)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, minimum_duration=1)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, minimum_duration=1, restore_concurrency=genericbackend.restoreConcurrency(cfg))
 
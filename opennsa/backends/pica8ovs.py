@@ -10,11 +10,14 @@ import random
 from twisted.python import log
 from twisted.internet import defer
 
-from opennsa import constants as cnt, config
+from opennsa import constants as cnt, config, error
 from opennsa.backends.common import ssh, genericbackend
 
 LOG_SYSTEM = 'opennsa.pica8ovs'
 
+# ovs commands print nothing on success, and errors prefixed with the command name
+ERROR_OUTPUT = ('ovs-vsctl:', 'ovs-ofctl:')
+
 # parameterized commands
 COMMAND_ECHO            = 'echo'
 
@@ -59,7 +62,7 @@ def createDeleteCommands(db_ip, source_nrm_port, dest_nrm_port, source_vlan, des
 
 class SSHChannel(ssh.SSHChannel):
 
-    name = 'session'
+    name = b'session'
 
     def __init__(self, conn):
         ssh.SSHChannel.__init__(self, conn=conn)
@@ -75,7 +78,7 @@ class SSHChannel(ssh.SSHChannel):
         LT = '\n' # line termination
 
         try:
-            yield self.conn.sendRequest(self, 'shell', '', wantReply=1)
+            yield self.conn.sendRequest(self, b'shell', b'', wantReply=1)
 
 #            time.sleep(1) # FIXME
             d = self.waitForData('\n')
@@ -122,48 +125,40 @@ class SSHChannel(ssh.SSHChannel):
 
 
     def dataReceived(self, data):
+        data = data.decode(errors='replace')
         if len(data) == 0:
             pass
         else:
             self.data += data
             if self.wait_data and self.wait_data in self.data:
-                d = self.wait_defer
+                output = self.data
                 self.data       = ''
                 self.wait_data  = None
-                self.wait_defer = None
-                d.callback(self)
+                if any( e in output for e in ERROR_OUTPUT ):
+                    # the device gives a prompt after the error as well
+                    self.failWait( error.InternalNRMError('Error from device: %s' % output.strip()) )
+                else:
+                    d = self.wait_defer
+                    self.wait_defer = None
+                    d.callback(self)
 
 
 class Pica8OVSCommandSender:
 
 
-    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip):
+    def __init__(self, host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path, db_ip, ssh_channels=ssh.DEFAULT_CHANNELS):
 
-        self.ssh_connection_creator = \
+        ssh_connection_creator = \
              ssh.SSHConnectionCreator(host, port, [ ssh_host_fingerprint ], user, ssh_public_key_path, ssh_private_key_path)
+        self.ssh_pool = ssh.getConnectionPool(ssh_connection_creator, ssh_channels)
         self.db_ip = db_ip
 
         log.msg('SSH connection arguments %s, %s, %s, %s, %s, %s' % (host, port, ssh_host_fingerprint, user, ssh_public_key_path, ssh_private_key_path), system=LOG_SYSTEM)
 
 
-    @defer.inlineCallbacks
     def _sendCommands(self, commands):
 
-        log.msg('Creating new SSH connection', system=LOG_SYSTEM)
-
-        ssh_connection = yield self.ssh_connection_creator.getSSHConnection()
-
-        try:
-            ssh_channel = SSHChannel(conn = ssh_connection)
-            ssh_connection.openChannel(ssh_channel)
-            yield ssh_channel.channel_open
-            yield ssh_channel.sendCommands(commands)
-            # not a yield, just being nice
-            ssh_channel.loseConnection()
-
-        finally:
-            # twisted/os will flush data, before closing
-            ssh_connection.transport.loseConnection()
+        return self.ssh_pool.runChannel(SSHChannel, SSHChannel.sendCommands, commands)
 
 
     def setupLink(self, source_target, dest_target):
@@ -197,10 +192,10 @@ class Pica8OVSTarget(object):
 
 class Pica8OVSConnectionManager:
 
-    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip):
+    def __init__(self, port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, ssh_channels=ssh.DEFAULT_CHANNELS):
 
         self.port_map = port_map
-        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
+        self.command_sender = Pica8OVSCommandSender(host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, ssh_channels)
 
 
     def getResource(self, port, label):
@@ -261,6 +256,7 @@ def Pica8OVSBackend(network_name, nrm_ports, parent_requester, cfg):
     ssh_public_key   = cfg[config.PICA8OVS_SSH_PUBLIC_KEY]
     ssh_private_key  = cfg[config.PICA8OVS_SSH_PRIVATE_KEY]
     db_ip            = cfg[config.PICA8OVS_DB_IP]
+    ssh_channels     = int(cfg.get(config.PICA8OVS_SSH_CHANNELS, ssh.DEFAULT_CHANNELS))
 
-    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip)
-    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name)
+    cm = Pica8OVSConnectionManager(port_map, host, port, host_fingerprint, user, ssh_public_key, ssh_private_key, db_ip, ssh_channels)
+    return genericbackend.GenericBackend(network_name, nrm_map, cm, parent_requester, name, restore_concurrency=genericbackend.restoreConcurrency(cfg))
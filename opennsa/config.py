@@ -73,9 +73,12 @@ _SSH_USER               = 'user'
 _SSH_PASSWORD           = 'password'
 _SSH_PUBLIC_KEY         = 'publickey'
 _SSH_PRIVATE_KEY        = 'privatekey'
+_SSH_CHANNELS           = 'sshchannels' # number of concurrent ssh channels to the device
 
 AS_NUMBER              = 'asnumber'
 
+RESTORE_CONCURRENCY    = 'restoreconcurrency' # concurrent device operations when restoring connections at startup, any backend
+
 # TODO: Don't do backend specifics for everything, it causes confusion, and doesn't really solve anything
 
 # juniper block - same for mx / ex backends
@@ -85,6 +88,7 @@ JUNIPER_HOST_FINGERPRINT    = _SSH_HOST_FINGERPRINT
 JUNIPER_USER                = _SSH_USER
 JUNIPER_SSH_PUBLIC_KEY      = _SSH_PUBLIC_KEY
 JUNIPER_SSH_PRIVATE_KEY     = _SSH_PRIVATE_KEY
+JUNIPER_SSH_CHANNELS        = _SSH_CHANNELS
 
 # force10 block
 FORCE10_HOST            = _SSH_HOST
@@ -94,6 +98,7 @@ FORCE10_PASSWORD        = _SSH_PASSWORD
 FORCE10_HOST_FINGERPRINT = _SSH_HOST_FINGERPRINT
 FORCE10_SSH_PUBLIC_KEY  = _SSH_PUBLIC_KEY
 FORCE10_SSH_PRIVATE_KEY = _SSH_PRIVATE_KEY
+FORCE10_SSH_CHANNELS    = _SSH_CHANNELS
 
 # Brocade block
 BROCADE_HOST              = _SSH_HOST
@@ -102,6 +107,7 @@ BROCADE_HOST_FINGERPRINT  = _SSH_HOST_FINGERPRINT
 BROCADE_USER              = _SSH_USER
 BROCADE_SSH_PUBLIC_KEY    = _SSH_PUBLIC_KEY
 BROCADE_SSH_PRIVATE_KEY   = _SSH_PRIVATE_KEY
+BROCADE_SSH_CHANNELS      = _SSH_CHANNELS
 BROCADE_ENABLE_PASSWORD   = 'enablepassword'
 
 # Pica8 OVS
@@ -111,6 +117,7 @@ PICA8OVS_HOST_FINGERPRINT    = _SSH_HOST_FINGERPRINT
 PICA8OVS_USER                = _SSH_USER
 PICA8OVS_SSH_PUBLIC_KEY      = _SSH_PUBLIC_KEY
 PICA8OVS_SSH_PRIVATE_KEY     = _SSH_PRIVATE_KEY
+PICA8OVS_SSH_CHANNELS        = _SSH_CHANNELS
 PICA8OVS_DB_IP               = 'dbip'
 
 
@@ -126,6 +133,7 @@ JUNOS_HOST_FINGERPRINT    = _SSH_HOST_FINGERPRINT
 JUNOS_USER                = _SSH_USER
 JUNOS_SSH_PUBLIC_KEY      = _SSH_PUBLIC_KEY
 JUNOS_SSH_PRIVATE_KEY     = _SSH_PRIVATE_KEY
+JUNOS_SSH_CHANNELS        = _SSH_CHANNELS
 JUNOS_ROUTERS             = 'routers'
 
 #Junosspace backend
@@ -7,9 +7,13 @@ NORDUnet holds the copyright for SGAS 3.X LUTS and OpenNSA.
 
 import os
 
+from zope.interface import implementer
+
 from OpenSSL import SSL
 
 from twisted.python import log
+from twisted.web.iweb import IPolicyForHTTPS
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 
 LOG_SYSTEM = 'CTXFactory'
 
@@ -94,3 +98,37 @@ class ContextFactory(RequestContextFactory):
 
         return ctx
 
+
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ClientConnectionCreator:
+
+    def __init__(self, ctx_factory, hostname):
+        self.ctx_factory = ctx_factory
+        self.hostname    = hostname
+
+
+    def clientConnectionForTLS(self, tls_protocol):
+        connection = SSL.Connection(self.ctx_factory.getContext(), None)
+        connection.set_app_data(tls_protocol)
+        connection.set_tlsext_host_name(self.hostname)
+        connection.set_connect_state()
+        return connection
+
+
+
+@implementer(IPolicyForHTTPS)
+class AgentPolicy:
+    """
+    HTTPS policy for twisted.web.client.Agent, using the contexts from one
+    of the context factories above. Certificate verification is done by the
+    context, as when connecting with reactor.connectSSL.
+    """
+    def __init__(self, ctx_factory):
+        self.ctx_factory = ctx_factory
+
+
+    def creatorForNetloc(self, hostname, port):
+        return _ClientConnectionCreator(self.ctx_factory, hostname)
+
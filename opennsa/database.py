@@ -11,6 +11,8 @@ Copyright: NORDUnet (2011-2013)
 
 import datetime
 
+from twisted.python import log
+from twisted.internet import defer
 from twisted.enterprise import adbapi
 
 from psycopg2.extensions import adapt, register_adapter, AsIs
@@ -27,6 +29,13 @@ from opennsa import nsa
 
 LOG_SYSTEM = 'opennsa.Database'
 
+SUMMARY_PAGE_SIZE = 500
+
+ID_BLOCK_SIZE = 20 # number of backend connection ids reserved from the database at a time
+
+# aggregated data plane status of a service connection without sub connections
+NO_DATA_PLANE_STATUS = (False, 0, False)
+
 
 # psycopg2 plumming to get automatic adaption
 def adaptLabel(label):
@@ -90,11 +99,68 @@ def setupDatabase(database, user, password=None, host=None, connection_id_start=
 
 # ORM Objects
 
-class ServiceConnection(DBObject):
+class TrackedDBObject(DBObject):
+    """
+    DBObject which keeps the column values last read from or written to the
+    database. Saving an object which is already in the database only updates
+    the columns that have changed, and does nothing if no columns have changed.
+    """
+    _persisted = None # column -> value
+
+
+    def afterInit(self):
+        # called by twistar when the object has been loaded from the database
+        self.markPersisted()
+
+
+    def markPersisted(self):
+        columns = Registry.SCHEMAS.get(self.tablename()) or [ k for k in vars(self) if not k.startswith('_') and k != 'errors' ]
+        self._persisted = { col : _copyValue(getattr(self, col, None)) for col in columns if col != 'id' }
+
+
+    def changedColumns(self):
+        return { col : getattr(self, col, None) for col, value in self._persisted.items() if getattr(self, col, None) != value }
+
+
+    def save(self):
+        if self.id is None or self._persisted is None:
+            # new object (or unknown state), do a full save
+            return DBObject.save(self).addCallback(self._saved)
+
+        changes = self.changedColumns()
+        if not changes:
+            return defer.succeed(self)
+
+        def updated(_):
+            self._persisted.update( { col : _copyValue(value) for col, value in changes.items() } )
+            return self
+
+        d = self._config.update(self.tablename(), changes, where=['id = ?', self.id])
+        d.addCallback(updated)
+        return d
+
+
+    def refresh(self):
+        return DBObject.refresh(self).addCallback(self._saved)
+
+
+    def _saved(self, _):
+        self.markPersisted()
+        return self
+
+
+
+def _copyValue(value):
+    # array columns are lists, copy these so in-place changes are detected
+    return list(value) if type(value) is list else value
+
+
+
+class ServiceConnection(TrackedDBObject):
     HASMANY = ['SubConnections']
 
 
-class SubConnection(DBObject):
+class SubConnection(TrackedDBObject):
     BELONGSTO = ['ServiceConnection']
 
 
@@ -102,30 +168,158 @@ class STPAuthz(DBObject):
     TABLENAME = 'stp_authz'
 
 
+def getDataPlaneStatus(service_connection_ids):
+    """
+    Compute the aggregated data plane status (active, version, consistent)
+    from the sub connections of the given service connections, in the database.
+    Returns a deferred firing with a dict: service connection id -> status.
+    Service connections without sub connections are not in the result.
+    """
+    def gotResult(rows):
+        return { row[0] : (row[1], row[2], row[3]) for row in rows }
+
+    if not service_connection_ids:
+        return defer.succeed({})
+
+    query = 'SELECT service_connection_id, bool_and(data_plane_active), COALESCE(max(data_plane_version), 0), ' \
+            'bool_and(COALESCE(data_plane_consistent, false)) ' \
+            'FROM sub_connections WHERE service_connection_id IN %s GROUP BY service_connection_id;'
+    return Registry.DBPOOL.runQuery(query, (tuple(service_connection_ids),) ).addCallback(gotResult)
+
+
+@defer.inlineCallbacks
+def findConnections(where=None, after_id=0, page_size=SUMMARY_PAGE_SIZE):
+    """
+    Find a page of service connections, ordered by id. The where argument is
+    the same as for DBObject.find. Pass the id of the last connection in a
+    page as after_id to get the next page, a page shorter than page_size is
+    the last one. Returns a deferred firing with a list of ServiceConnection.
+    """
+    if where:
+        where = [ '(%s) AND id > ?' % where[0] ] + list(where[1:]) + [ after_id ]
+    else:
+        where = [ 'id > ?', after_id ]
+
+    conns = yield ServiceConnection.find(where=where, orderby='id', limit=page_size)
+    if not isinstance(conns, list): # twistar returns the object itself when limit is 1
+        conns = [ conns ] if conns is not None else []
+    defer.returnValue(conns)
+
+
+@defer.inlineCallbacks
+def findConnectionSummaries(where=None, after_id=0, page_size=SUMMARY_PAGE_SIZE):
+    """
+    Find a page of service connections, with their aggregated data plane
+    status. Arguments are the same as for findConnections.
+    Returns a deferred firing with a list of (ServiceConnection, data_plane_status).
+    """
+    conns = yield findConnections(where, after_id, page_size)
+    status = yield getDataPlaneStatus( [ c.id for c in conns ] )
+    defer.returnValue( [ (c, status.get(c.id, NO_DATA_PLANE_STATUS)) for c in conns ] )
+
+
 # Not really needed
 class BackendConnectionID(DBObject):
     TABLENAME = 'backend_connection_id'
 
-#@defer.inlineCallbacks
-def getBackendConnectionId():
-
-#    rows = yield BackendConnectionID.find()
-#    if len(rows) == 0:
-#        defer.returnValue(0)
-#    else:
-#        connection_id = rows[0].connection_id
-#        rows[0].connection_id += 1
-#        rows[0].save()
-#        defer.returnValue(connection_id)
-
+def _reserveIdBlock(block_size):
+    # reserves the ids (high - block_size, high], the update is atomic, so blocks never overlap, even across processes
     def gotResult(rows):
-        print('rows: {}'.format(rows))
         if len(rows) == 0:
-            return None
+            return None # no start value in the table
         else:
             return rows[0][0]
 
-    return Registry.DBPOOL.runQuery('UPDATE backend_connection_id SET connection_id = connection_id + 1 RETURNING connection_id;').addCallback(gotResult)
+    return Registry.DBPOOL.runQuery('UPDATE backend_connection_id SET connection_id = connection_id + %s RETURNING connection_id;', (block_size,)).addCallback(gotResult)
+
+
+
+class ConnectionIdAllocator:
+    """
+    Hands out unique connection ids from blocks reserved in the database
+    (hi/lo allocation), so a new id does not require a database round trip.
+    The next block is reserved when the current one is running low.
+
+    Ids that are not handed out before the process stops are not used, so
+    there may be gaps in the sequence, but an id is never handed out twice.
+    """
+    def __init__(self, block_size=ID_BLOCK_SIZE, refill_threshold=None):
+        self.block_size = block_size
+        self.refill_threshold = refill_threshold if refill_threshold is not None else block_size // 4
+
+        self.blocks = []        # [ [next_id, last_id] ]
+        self.waiting = []       # [ Deferred ] waiting for a block
+        self.refilling = False
+
+
+    def available(self):
+        return sum( last_id - next_id + 1 for next_id, last_id in self.blocks )
+
+
+    def allocate(self):
+        """
+        Returns a deferred firing with a new id, or None if the id table has not been initialized.
+        """
+        if self.blocks:
+            connection_id = self._take()
+            if self.available() <= self.refill_threshold:
+                self._refill()
+            return defer.succeed(connection_id)
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._refill()
+        return d
+
+
+    def _take(self):
+        block = self.blocks[0]
+        connection_id = block[0]
+        block[0] += 1
+        if block[0] > block[1]:
+            self.blocks.pop(0)
+        return connection_id
+
+
+    def _refill(self):
+        if self.refilling:
+            return
+        self.refilling = True
+        d = _reserveIdBlock(self.block_size)
+        d.addCallbacks(self._gotBlock, self._blockFailed)
+
+
+    def _gotBlock(self, high):
+        self.refilling = False
+        if high is None:
+            waiting, self.waiting = self.waiting, []
+            for d in waiting:
+                d.callback(None)
+            return
+
+        log.msg('Reserved connection ids %i - %i' % (high - self.block_size + 1, high), debug=True, system=LOG_SYSTEM)
+        self.blocks.append( [ high - self.block_size + 1, high ] )
+        while self.waiting and self.blocks:
+            self.waiting.pop(0).callback( self._take() )
+
+        if self.waiting or self.available() <= self.refill_threshold:
+            self._refill()
+
+
+    def _blockFailed(self, err):
+        self.refilling = False
+        log.msg('Error reserving connection ids: %s' % err.getErrorMessage(), system=LOG_SYSTEM)
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(err)
+
+
+
+_ID_ALLOCATOR = ConnectionIdAllocator()
+
+
+def getBackendConnectionId():
+    return _ID_ALLOCATOR.allocate()
 
 
 
@@ -1,7 +1,15 @@
 # Fetches discovory documents from other nsas
+#
+# Each peer is fetched on its own schedule, with exponential backoff (x2) of
+# the fetch interval, and a bit of jitter so fetches do not line up. Requests
+# are conditional (if-modified-since / if-none-match), and documents are only
+# parsed if their content changed since the last fetch.
+
+import random
+import hashlib
 
 from twisted.python import log
-from twisted.internet import defer, task, reactor
+from twisted.internet import defer, reactor
 from twisted.application import service
 
 from opennsa import nsa, constants as cnt
@@ -16,11 +24,39 @@ LOG_SYSTEM = 'discovery.Fetcher'
 FETCH_INTERVAL_MIN = 10 # seconds
 FETCH_INTERVAL_MAX = 3600 # seconds - 3600 seconds = 1 hour
 
+FETCH_JITTER = 0.1 # fraction of interval, random +/-
+FETCH_TIMEOUT = 10 # seconds
+MAX_CONCURRENT_FETCHES = 10
+
+
+
+class PeerFetchState(object):
+    # fetch schedule and cache validators for a single peer
+
+    def __init__(self, peer):
+        self.peer           = peer
+        self.interval       = FETCH_INTERVAL_MIN // 2 # doubled on first fetch
+        self.failures       = 0
+        self.last_modified  = None  # last-modified header of last document
+        self.etag           = None  # etag header of last document
+        self.document_hash  = None  # hash of last parsed document
+        self.call           = None  # delayed call for next fetch
+        self.fetching       = None  # deferred for the fetch in progress
+
+
+    def requestHeaders(self):
+        headers = {}
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        return headers
+
 
 
 class FetcherService(service.Service):
 
-    def __init__(self, link_vectors, nrm_ports, peers, provider_registry, ctx_factory=None):
+    def __init__(self, link_vectors, nrm_ports, peers, provider_registry, ctx_factory=None, max_concurrent_fetches=MAX_CONCURRENT_FETCHES):
         for peer in peers:
             assert peer.url.startswith('http'), 'Peer URL %s does not start with http' % peer.url
 
@@ -30,43 +66,113 @@ class FetcherService(service.Service):
         self.provider_registry = provider_registry
         self.ctx_factory = ctx_factory
 
-        self.call = task.LoopingCall(self.fetchDocuments)
+        self.peer_states = [ PeerFetchState(peer) for peer in peers ]
+        self.semaphore = defer.DeferredSemaphore(max_concurrent_fetches)
+        self.clock = reactor # this is needed in order to test scheduled fetches
 
 
     def startService(self):
-        # we use half, as it is doubled on first run
-        reactor.callWhenRunning(self.call.start, FETCH_INTERVAL_MIN // 2)
+        # spread out the initial fetches a bit
+        for ps in self.peer_states:
+            self._scheduleFetch(ps, random.uniform(0, FETCH_INTERVAL_MIN // 2))
         service.Service.startService(self)
 
 
     def stopService(self):
-        self.call.stop()
+        for ps in self.peer_states:
+            if ps.call is not None and ps.call.active():
+                ps.call.cancel()
+            ps.call = None
         service.Service.stopService(self)
 
 
+    def _scheduleFetch(self, peer_state, delay):
+        if peer_state.call is not None and peer_state.call.active():
+            peer_state.call.cancel()
+        jitter = random.uniform(-FETCH_JITTER, FETCH_JITTER) * delay
+        peer_state.call = self.clock.callLater(max(delay + jitter, 0), self._fetchPeer, peer_state)
+
+
+    def _nextInterval(self, peer_state, success):
+        if success:
+            peer_state.failures = 0
+            peer_state.interval = min(peer_state.interval * 2, FETCH_INTERVAL_MAX)
+            return peer_state.interval
+        else:
+            # retry failed peers sooner, with their own backoff
+            peer_state.failures += 1
+            return min(FETCH_INTERVAL_MIN * 2 ** (peer_state.failures - 1), FETCH_INTERVAL_MAX)
+
+
     def fetchDocuments(self):
-        log.msg('Fetching %i documents.' % len(self.peers), system=LOG_SYSTEM)
+        # fetch all documents now, regardless of schedule
+        log.msg('Fetching %i documents.' % len(self.peer_states), system=LOG_SYSTEM)
+        for ps in self.peer_states:
+            if ps.call is not None and ps.call.active():
+                ps.call.cancel()
+        defs = [ self._fetchPeer(ps) for ps in self.peer_states ]
+        if defs:
+            return defer.DeferredList(defs)
 
-        defs = []
-        for peer in self.peers:
+
+    def _fetchPeer(self, peer_state):
+
+        if peer_state.fetching is not None:
+            # already being fetched, wait for that, instead of fetching (and rescheduling) it twice
+            d = defer.Deferred()
+            peer_state.fetching.addBoth(lambda result : d.callback(result) or result)
+            return d
+
+        peer = peer_state.peer
+        peer_state.call = None
+
+        def fetch():
             log.msg('Fetching %s' % peer.url, debug=True, system=LOG_SYSTEM)
-            d = httpclient.httpRequest(peer.url.encode('utf-8'), b'', {}, b'GET', timeout=10, ctx_factory=self.ctx_factory)
-            d.addCallbacks(self.gotDocument, self.retrievalFailed, callbackArgs=(peer,), errbackArgs=(peer,))
-            defs.append(d)
+            return httpclient.httpGet(peer.url, peer_state.requestHeaders(), timeout=FETCH_TIMEOUT, ctx_factory=self.ctx_factory)
 
-        def updateInterval(passthrough):
-            self.call.interval = min(self.call.interval * 2, FETCH_INTERVAL_MAX)
-            return passthrough
+        def gotResponse(response):
+            if response.code == 304:
+                log.msg('NSA description from %s not modified' % peer.url, debug=True, system=LOG_SYSTEM)
+                return True
+            if response.code != 200:
+                raise httpclient.HTTPRequestError('Unexpected status code %i' % response.code)
 
-        if defs:
-            return defer.DeferredList(defs).addBoth(updateInterval)
+            peer_state.last_modified = response.headers.get('last-modified')
+            peer_state.etag          = response.headers.get('etag')
+
+            document_hash = hashlib.sha1(response.body).digest()
+            if document_hash == peer_state.document_hash:
+                log.msg('NSA description from %s unchanged, skipping parse' % peer.url, debug=True, system=LOG_SYSTEM)
+                return True
+
+            if self.gotDocument(response.body, peer):
+                peer_state.document_hash = document_hash
+            return True
+
+        def fetchFailed(err):
+            self.retrievalFailed(err, peer)
+            return False
+
+        def reschedule(success):
+            peer_state.fetching = None
+            if self.running:
+                self._scheduleFetch(peer_state, self._nextInterval(peer_state, success))
+
+        d = self.semaphore.run(fetch)
+        peer_state.fetching = d
+        d.addCallbacks(gotResponse, fetchFailed)
+        d.addErrback(fetchFailed) # errors from parsing
+        d.addCallback(reschedule)
+        return d
 
 
     def gotDocument(self, result, peer):
 
-        if result is None:
+        # returns True if the document was processed, False otherwise
+
+        if not result:
             log.msg('Got empty NSA discovery document (URL: %s)' % peer.url, system=LOG_SYSTEM)
-            return
+            return False
 
         log.msg('Got NSA description from %s (%i bytes)' % (peer.url, len(result)), debug=True, system=LOG_SYSTEM)
         try:
@@ -83,7 +189,7 @@ class FetcherService(service.Service):
 
             if cs_service_url is None:
                 log.msg('NSA description does not have CS interface url, discarding description', system=LOG_SYSTEM)
-                return
+                return False
 
             network_ids = [ _baseName(nid) for nid in nsa_description.networkId if nid.startswith(cnt.URN_OGF_PREFIX) ] # silent discard weird stuff
             if not network_ids:
@@ -105,21 +211,23 @@ class FetcherService(service.Service):
             for nid in network_ids:
                 vectors[nid] = 1
 
-            # update per-port link vectors
+            # update per-port link vectors, as a single change set
             if vectors:
-                for network, no in self.nrm_ports.items():
-                    for np in no['nrm_ports']:
-                        if np.remote_network in network_ids:
-                            # this may add the vectors to multiple ports (though not likely)
-                            self.link_vectors.updateVector(network, np.name, vectors)
+                with self.link_vectors.batch():
+                    for network, no in self.nrm_ports.items():
+                        for np in no['nrm_ports']:
+                            if np.remote_network in network_ids:
+                                # this may add the vectors to multiple ports (though not likely)
+                                self.link_vectors.updateVector(network, np.name, vectors)
 
             # there is lots of other stuff in the nsa description but we don't really use it
-
+            return True
 
         except Exception as e:
             log.msg('Error parsing NSA description from url %s. Reason %s' % (peer.url, str(e)), system=LOG_SYSTEM)
             import traceback
             traceback.print_exc()
+            return False
 
 
     def retrievalFailed(self, result, peer):
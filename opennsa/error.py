@@ -170,6 +170,11 @@ class DownstreamNSAError(InternalServerError):
     errorId = '00505' # NOT OFFICAL ERROR CODE
 
 
+class DownstreamNSAUnreachableError(DownstreamNSAError):
+    # the downstream nsa could not be contacted, as opposed to one further down the chain failing
+    pass
+
+
 class ResourceUnavailableError(NSIError):
 
     errorId = '00600'
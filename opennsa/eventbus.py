@@ -0,0 +1,132 @@
+"""
+In-process event bus for connection state changes.
+
+Subscriptions are per connection id. They are removed when cancelled, when
+the request they are scoped to finishes, or when the connection is
+terminated. Events are delivered asynchronously, in the order they were
+published.
+"""
+
+import time
+
+from twisted.python import log
+from twisted.internet import reactor
+
+
+LOG_SYSTEM = 'opennsa.EventBus'
+
+TERMINATED = 'Terminated' # same as state.TERMINATED, state imports this module
+
+
+
+class StateEvent:
+    """
+    A state change of a connection. The states are tuples of
+    (reservation state, provision state, lifecycle state).
+    """
+    def __init__(self, connection_id, old_states, new_states, timestamp=None):
+        self.connection_id  = connection_id
+        self.old_states     = old_states
+        self.new_states     = new_states
+        self.timestamp      = timestamp if timestamp is not None else time.time()
+
+
+    def __repr__(self):
+        return '<StateEvent %s %s -> %s>' % (self.connection_id, self.old_states, self.new_states)
+
+
+
+class Subscription:
+
+    def __init__(self, bus, connection_id, f):
+        self.bus            = bus
+        self.connection_id  = connection_id
+        self.f              = f
+        self.active         = True
+
+
+    def cancel(self):
+        # safe to call more than once
+        if self.active:
+            self.active = False
+            self.bus._remove(self)
+
+
+
+class EventBus:
+
+    def __init__(self):
+        self.subscriptions = {} # connection_id -> [ Subscription ]
+        self.pending = []       # [ (event, [ Subscription ]) ] not yet delivered
+        self.delivery_call = None
+
+        self.published = 0
+        self.delivered = 0
+
+        self.clock = reactor
+
+
+    def subscribe(self, connection_id, f, request=None):
+        """
+        Subscribe to state events for a connection. f is called with a StateEvent.
+        If request is given, the subscription is cancelled when the request finishes.
+        Returns a Subscription.
+        """
+        subscription = Subscription(self, connection_id, f)
+        self.subscriptions.setdefault(connection_id, []).append(subscription)
+        if request is not None:
+            request.notifyFinish().addBoth(lambda _ : subscription.cancel())
+        return subscription
+
+
+    def _remove(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.connection_id, [])
+        if subscription in subscriptions:
+            subscriptions.remove(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.connection_id]
+
+
+    def publish(self, event):
+        self.published += 1
+
+        if event.new_states[2] == TERMINATED:
+            # there will be no more events for the connection, subscribers get this one and are then removed
+            subscriptions = self.subscriptions.pop(event.connection_id, None)
+        else:
+            subscriptions = self.subscriptions.get(event.connection_id)
+
+        if not subscriptions:
+            return
+
+        self.pending.append( (event, list(subscriptions)) )
+        if self.delivery_call is None:
+            self.delivery_call = self.clock.callLater(0, self._deliver)
+
+
+    def _deliver(self):
+        self.delivery_call = None
+        pending, self.pending = self.pending, []
+
+        for event, subscriptions in pending:
+            for s in subscriptions:
+                if not s.active:
+                    continue # cancelled after the event was published
+                try:
+                    s.f(event)
+                    self.delivered += 1
+                except Exception as e:
+                    log.msg('Error during state notification for %s: %s' % (event.connection_id, str(e)), system=LOG_SYSTEM)
+                if event.new_states[2] == TERMINATED:
+                    s.active = False
+
+
+    def subscriberCount(self, connection_id=None):
+        if connection_id is None:
+            return sum( len(s) for s in self.subscriptions.values() )
+        return len(self.subscriptions.get(connection_id, []))
+
+
+    def stats(self):
+        return { 'connections': len(self.subscriptions), 'subscribers': self.subscriberCount(),
+                 'published': self.published, 'delivered': self.delivered }
@@ -0,0 +1,161 @@
+"""
+Journal of connection state transitions.
+
+Transitions are recorded in the append-only connection_events table. Writes
+are buffered and flushed in batches, using a multi-row INSERT, so state
+transitions never wait on the journal. If the database is unavailable, the
+buffer is kept (up to a limit) and the write is tried again on the next flush.
+"""
+
+import datetime
+
+from twisted.python import log
+from twisted.internet import reactor, defer
+
+from twistar.registry import Registry
+
+
+LOG_SYSTEM = 'opennsa.Journal'
+
+FLUSH_INTERVAL  = 2     # seconds, maximum time an event is buffered
+BATCH_SIZE      = 500   # flush right away when this many events are buffered, also max rows per insert
+MAX_BUFFER      = 50000 # drop the oldest events if the buffer gets larger than this (database is down)
+
+COLUMNS = ('connection_table', 'connection_id', 'event_time',
+           'old_reservation_state', 'old_provision_state', 'old_lifecycle_state',
+           'reservation_state', 'provision_state', 'lifecycle_state')
+
+
+
+class ConnectionEvent:
+    """
+    A recorded transition, the states are (reservation, provision, lifecycle) tuples.
+    """
+    def __init__(self, connection_table, connection_id, event_time, old_states, new_states):
+        self.connection_table   = connection_table
+        self.connection_id      = connection_id
+        self.event_time         = event_time
+        self.old_states         = old_states
+        self.new_states         = new_states
+
+
+    def __repr__(self):
+        return '<ConnectionEvent %s %s %s -> %s>' % (self.connection_id, self.event_time, self.old_states, self.new_states)
+
+
+
+class JournalWriter:
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE, max_buffer=MAX_BUFFER):
+        self.flush_interval = flush_interval
+        self.batch_size     = batch_size
+        self.max_buffer     = max_buffer
+
+        self.buffer = []            # [ row tuple ]
+        self.flush_call = None
+        self.lock = defer.DeferredLock() # one flush at the time
+
+        self.written = 0
+        self.dropped = 0
+
+        self.clock = reactor
+
+
+    def record(self, connection_table, event):
+        # event is an eventbus.StateEvent
+        event_time = datetime.datetime.utcfromtimestamp(event.timestamp)
+        self.buffer.append( (connection_table, event.connection_id, event_time) + tuple(event.old_states) + tuple(event.new_states) )
+        self._trimBuffer()
+
+        if len(self.buffer) >= self.batch_size:
+            self._scheduleFlush(0)
+        else:
+            self._scheduleFlush(self.flush_interval)
+
+
+    def _trimBuffer(self):
+        if len(self.buffer) > self.max_buffer:
+            n_drop = len(self.buffer) - self.max_buffer
+            del self.buffer[:n_drop]
+            self.dropped += n_drop
+            log.msg('Journal buffer full, dropped %i connection events' % n_drop, system=LOG_SYSTEM)
+
+
+    def _scheduleFlush(self, delay):
+        if self.flush_call is not None:
+            if self.flush_call.getTime() <= self.clock.seconds() + delay:
+                return
+            self.flush_call.cancel()
+        self.flush_call = self.clock.callLater(delay, self.flush)
+
+
+    def flush(self):
+        """
+        Write all buffered events. Returns a deferred, which fires when they are written.
+        """
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        return self.lock.run(self._writeBatches)
+
+
+    @defer.inlineCallbacks
+    def _writeBatches(self):
+        while self.buffer:
+            rows = self.buffer[:self.batch_size]
+            del self.buffer[:len(rows)]
+            try:
+                yield _insertRows(rows)
+                self.written += len(rows)
+            except Exception as e:
+                log.msg('Error writing %i connection events, will retry: %s' % (len(rows), str(e)), system=LOG_SYSTEM)
+                self.buffer[0:0] = rows
+                self._trimBuffer()
+                self._scheduleFlush(self.flush_interval)
+                break
+
+
+    def stats(self):
+        return { 'buffered': len(self.buffer), 'written': self.written, 'dropped': self.dropped }
+
+
+
+def _insertRows(rows):
+    row_placeholder = '(' + ','.join( ['%s'] * len(COLUMNS) ) + ')'
+    query = 'INSERT INTO connection_events (%s) VALUES %s;' % (','.join(COLUMNS), ','.join( [row_placeholder] * len(rows) ))
+    args = [ value for row in rows for value in row ]
+    return Registry.DBPOOL.runOperation(query, args)
+
+
+
+def _createEvents(rows):
+    return [ ConnectionEvent(r[0], r[1], r[2], (r[3], r[4], r[5]), (r[6], r[7], r[8])) for r in rows ]
+
+
+def connectionEvents(connection_id, connection_table=None):
+    """
+    Get the recorded events of a connection, ordered by time.
+    Returns a deferred firing with a list of ConnectionEvent.
+    """
+    query = 'SELECT %s FROM connection_events WHERE connection_id = %%s' % ','.join(COLUMNS)
+    args = [ connection_id ]
+    if connection_table is not None:
+        query += ' AND connection_table = %s'
+        args.append(connection_table)
+    query += ' ORDER BY event_time, id;'
+    return Registry.DBPOOL.runQuery(query, args).addCallback(_createEvents)
+
+
+def eventsBetween(start_time, end_time, connection_table=None):
+    """
+    Get all recorded events in a time range (start inclusive, end exclusive), ordered by time.
+    Returns a deferred firing with a list of ConnectionEvent.
+    """
+    query = 'SELECT %s FROM connection_events WHERE event_time >= %%s AND event_time < %%s' % ','.join(COLUMNS)
+    args = [ start_time, end_time ]
+    if connection_table is not None:
+        query += ' AND connection_table = %s'
+        args.append(connection_table)
+    query += ' ORDER BY event_time, id;'
+    return Registry.DBPOOL.runQuery(query, args).addCallback(_createEvents)
@@ -10,9 +10,10 @@ Copyright: NORDUnet (2011-2013)
 
 
 import uuid
+import array
+import bisect
 import random
 from urllib.parse import urlparse
-import itertools
 
 from opennsa import error, constants as cnt
 
@@ -69,17 +70,159 @@ class EmptyLabelSet(Exception):
 
 
 
+class RangeSet(object):
+    """
+    Immutable set of integers, represented as sorted, non-overlapping ranges.
+
+    The ranges are stored in a flat array of half-open boundaries, i.e.,
+    [ start_1, end_1+1, start_2, end_2+1, ... ]. A value is in the set if an odd
+    number of boundaries are less than or equal to it. Set operations are done
+    with a single sweep over the boundaries of both sets.
+    """
+    __slots__ = ('_bounds',)
+
+    def __init__(self, ranges=()):
+        # ranges is an iterable of inclusive (start, end) tuples, in any order
+        bounds = array.array('q')
+        for start, end in sorted(ranges):
+            if len(bounds) > 0 and start <= bounds[-1]: # overlap or adjacent, merge
+                bounds[-1] = max(bounds[-1], end + 1)
+            else:
+                bounds.extend( (start, end + 1) )
+        self._bounds = bounds
+
+
+    @classmethod
+    def _fromBounds(cls, bounds):
+        range_set = cls.__new__(cls)
+        range_set._bounds = bounds
+        return range_set
+
+
+    def _sweep(self, other, member):
+        # member is a function telling if a value is in the result, given if it is in self and other
+        a, b = self._bounds, other._bounds
+        la, lb = len(a), len(b)
+        i = j = 0
+        inside = False
+        bounds = array.array('q')
+        while i < la or j < lb:
+            if j == lb or (i < la and a[i] <= b[j]):
+                x = a[i]
+            else:
+                x = b[j]
+            if i < la and a[i] == x:
+                i += 1
+            if j < lb and b[j] == x:
+                j += 1
+            now_inside = member(i % 2 == 1, j % 2 == 1)
+            if now_inside != inside:
+                bounds.append(x)
+                inside = now_inside
+        return RangeSet._fromBounds(bounds)
+
+
+    def intersection(self, other):
+        return self._sweep(other, lambda in_a, in_b : in_a and in_b)
+
+    def union(self, other):
+        return self._sweep(other, lambda in_a, in_b : in_a or in_b)
+
+    def difference(self, other):
+        return self._sweep(other, lambda in_a, in_b : in_a and not in_b)
+
+    __and__ = intersection
+    __or__  = union
+    __sub__ = difference
+
+
+    def isdisjoint(self, other):
+        a, b = self._bounds, other._bounds
+        i = j = 0
+        while i < len(a) and j < len(b):
+            if a[i+1] <= b[j]:
+                i += 2
+            elif b[j+1] <= a[i]:
+                j += 2
+            else:
+                return False
+        return True
+
+
+    def ranges(self):
+        # iterate over inclusive (start, end) tuples
+        b = self._bounds
+        return ( (b[i], b[i+1] - 1) for i in range(0, len(b), 2) )
+
+
+    def count(self):
+        b = self._bounds
+        return sum(b[1::2]) - sum(b[0::2])
+
+
+    def first(self):
+        if len(self._bounds) == 0:
+            raise ValueError('Cannot get first value of empty range set')
+        return self._bounds[0]
+
+
+    def __contains__(self, value):
+        return bisect.bisect_right(self._bounds, value) % 2 == 1
+
+
+    def __iter__(self):
+        # lazy, values are not materialized
+        b = self._bounds
+        for i in range(0, len(b), 2):
+            yield from range(b[i], b[i+1])
+
+
+    def __len__(self):
+        return self.count()
+
+
+    def __bool__(self):
+        return len(self._bounds) > 0
+
+
+    def __eq__(self, other):
+        if not type(other) is RangeSet:
+            return False
+        return self._bounds == other._bounds
+
+
+    def __hash__(self):
+        return hash(self._bounds.tobytes())
+
+
+    def __repr__(self):
+        return '<RangeSet %s>' % ','.join( '%i-%i' % r for r in self.ranges() )
+
+
+
 class Label(object):
 
+    __slots__ = ('type_', 'range_set')
+
     def __init__(self, type_, values=None):
 
-        assert type(values) in (None, str, list, int), 'Type of Label values must be a None, str, or list. Was given %s' % type(values)
+        assert type(values) in (None, str, list, int, RangeSet), 'Type of Label values must be a None, str, list, or RangeSet. Was given %s' % type(values)
 
         self.type_ = type_
-        if type(values) is int:
-            self.values = [ [values, values] ]
+        if values is None:
+            self.range_set = None
+        elif type(values) is int:
+            self.range_set = RangeSet( [ (values, values) ] )
+        elif type(values) is RangeSet:
+            self.range_set = values
         else:
-            self.values = self._parseLabelValues(values) if values is not None else None
+            self.range_set = RangeSet( self._parseLabelValues(values) )
+
+
+    @property
+    def values(self):
+        # [ (start, end) ], sorted and normalized
+        return None if self.range_set is None else list(self.range_set.ranges())
 
 
     def _parseLabelValues(self, values):
@@ -101,70 +244,52 @@ class Label(object):
         if type(values) is str:
             values = values.split(',')
 
-        parsed_values = sorted( [ createValue(value) for value in values ] )
+        # overlap is removed by the range set
+        return [ createValue(value) for value in values ]
 
-        # detect any overlap and remove it - remember that the list is sorted
 
-        nv = [] # normalized values
-        for v1, v2 in parsed_values:
-            if len(nv) == 0:
-                nv.append( (v1,v2) )
-                continue
-
-            l = nv[-1] # last
-            if v1 <= l[1] + 1: # merge
-                nv = nv[:-1] + [ (l[0], max(l[1],v2)) ]
-            else:
-                nv.append( (v1,v2) )
-
-        return nv
+    def _checkOther(self, other, operation):
+        assert type(other) is Label, 'Cannot %s label with something that is not a label (other was %s)' % (operation, type(other))
+        assert self.type_ == other.type_, 'Cannot %s label of different types' % operation
 
 
     def intersect(self, other):
         # get the common values between two labels
-        assert type(other) is Label, 'Cannot intersect label with something that is not a label (other was %s)' % type(other)
-        assert self.type_ == other.type_, 'Cannot insersect label of different types'
-
-        label_values = []
-        i = iter(other.values)
-        o1, o2 = next(i)
-
-        for v1, v2 in self.values:
-            while True:
-                if v2 < o1:
-                    break
-                elif o2 < v1:
-                    try:
-                        o1, o2 = next(i)
-                    except StopIteration:
-                        break
-                    continue
-                label_values.append( ( max(v1,o1), min(v2,o2)) )
-                if v2 <= o2:
-                    break
-                elif o2 <= v2:
-                    try:
-                        o1, o2 = next(i)
-                    except StopIteration:
-                        break
-
-        if len(label_values) == 0:
+        self._checkOther(other, 'intersect')
+        range_set = self.range_set & other.range_set
+        if not range_set:
             raise EmptyLabelSet('Label intersection produced empty label set')
+        return Label(self.type_, range_set)
+
 
-        ls = ','.join( [ '%i-%s' % (nv[0], nv[1]) for nv in label_values ] )
-        return Label(self.type_, ls)
+    def union(self, other):
+        self._checkOther(other, 'union')
+        return Label(self.type_, self.range_set | other.range_set)
+
+
+    def difference(self, other):
+        self._checkOther(other, 'difference')
+        range_set = self.range_set - other.range_set
+        if not range_set:
+            raise EmptyLabelSet('Label difference produced empty label set')
+        return Label(self.type_, range_set)
 
 
     def labelValue(self):
-        vs = [ str(v1) if v1 == v2 else str(v1) + '-' + str(v2) for v1,v2 in self.values ]
+        vs = [ str(v1) if v1 == v2 else str(v1) + '-' + str(v2) for v1,v2 in self.range_set.ranges() ]
         return ','.join(vs)
 
     def singleValue(self):
-        return len(self.values) == 1 and self.values[0][0] == self.values[0][1]
+        return self.range_set.count() == 1
+
+    def count(self):
+        return self.range_set.count()
+
+    def iterValues(self):
+        return iter(self.range_set)
 
     def enumerateValues(self):
-        lv = [ range(lr[0], lr[1]+1) for lr in self.values ]
-        return list(itertools.chain.from_iterable( lv ) )
+        return list(self.range_set)
 
     def randomLabel(self):
         # not evenly distributed, but that isn't promised anyway
@@ -177,17 +302,18 @@ class Label(object):
             return True
         elif l1 is None or l2 is None:
             return False
-        try:
-            l1.intersect(l2) # this checks type as well as range
-            return True
-        except EmptyLabelSet:
-            return False
+        assert l1.type_ == l2.type_, 'Cannot insersect label of different types'
+        return not l1.range_set.isdisjoint(l2.range_set)
+
+
+    def __contains__(self, value):
+        return value in self.range_set
 
 
     def __eq__(self, other):
         if not type(other) is Label:
             return False
-        return self.type_ == other.type_ and sorted(self.values) == sorted(other.values)
+        return self.type_ == other.type_ and self.range_set == other.range_set
 
 
     def __repr__(self):
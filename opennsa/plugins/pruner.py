@@ -13,7 +13,6 @@ from zope.interface import implementer
 
 from twisted.internet import defer
 
-from opennsa import nsa
 from opennsa.interface import IPlugin
 from opennsa.plugin import BasePlugin
 
@@ -28,8 +27,7 @@ def pruneLabels(path):
     for idx, link in enumerate(path):
 
         if any( [ n in link.src_stp.network for n in NETWORKS ] ):
-            liv = link.src_stp.label.intersect(link.dst_stp.label)
-            lnv = nsa.Label(liv.type_, liv.labelValue())
+            lnv = link.src_stp.label.intersect(link.dst_stp.label)
             link.src_stp.label = lnv
             link.dst_stp.label = lnv
 
@@ -14,11 +14,11 @@ from opennsa.protocols.nsi2 import providerservice, providerclient, provider, \
 
 
 
-def setupProvider(child_provider, top_resource, tls=False, ctx_factory=None, allowed_hosts=None):
+def setupProvider(child_provider, top_resource, tls=False, ctx_factory=None, allowed_hosts=None, outbox=None):
 
     soap_resource = soapresource.setupSOAPResource(top_resource, b'CS2', allowed_hosts=allowed_hosts)
 
-    provider_client = providerclient.ProviderClient(ctx_factory)
+    provider_client = providerclient.ProviderClient(ctx_factory, outbox)
 
     nsi2_provider = provider.Provider(child_provider, provider_client)
 
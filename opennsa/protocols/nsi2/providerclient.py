@@ -17,9 +17,17 @@ from opennsa.protocols.nsi2.bindings import actions, nsiconnection, p2pservices
 
 class ProviderClient:
 
-    def __init__(self, ctx_factory=None):
+    def __init__(self, ctx_factory=None, outbox=None):
 
         self.ctx_factory = ctx_factory
+        self.outbox = outbox # confirmations and notifications are sent through the outbox, if set
+
+
+    def _send(self, requester_url, action, payload):
+        # the deferred fires when the message has been delivered, or stored for delivery if using the outbox
+        if self.outbox is None:
+            return httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        return self.outbox.send(requester_url, action, payload)
 
 
     def _genericConfirm(self, element_name, requester_url, action, correlation_id, requester_nsa, provider_nsa, connection_id):
@@ -35,7 +43,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, action, payload)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -61,7 +69,7 @@ class ProviderClient:
             # for now we just ignore this, as long as we get an okay
             return
 
-        d = httpclient.soapRequest(requester_url, action, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, action, payload)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -91,7 +99,7 @@ class ProviderClient:
             # we don't really do anything about these
             return ""
 
-        d = httpclient.soapRequest(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload, ctx_factory=self.ctx_factory)
+        d = self._send(nsi_header.reply_to, actions.RESERVE_CONFIRMED, payload)
         d.addCallbacks(gotReply) #, errReply)
         return d
 
@@ -152,7 +160,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.RESERVE_TIMEOUT, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.RESERVE_TIMEOUT, payload)
         return d
 
 
@@ -168,7 +176,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.DATA_PLANE_STATE_CHANGE, payload)
         return d
 
 
@@ -193,7 +201,7 @@ class ProviderClient:
 
         payload = minisoap.createSoapPayload(body_element, header_element)
 
-        d = httpclient.soapRequest(requester_url, actions.ERROR_EVENT, payload, ctx_factory=self.ctx_factory)
+        d = self._send(requester_url, actions.ERROR_EVENT, payload)
         return d
 
 
@@ -64,7 +64,7 @@ class RequesterClient:
             if err.check(ConnectionRefusedError):
                 # could not contact NSA
                 msg = 'Could not contact NSA %s. Reason: %s' % (header.provider_nsa, err.getErrorMessage())
-                ex = error.DownstreamNSAError(msg, nsa_id=header.provider_nsa)
+                ex = error.DownstreamNSAUnreachableError(msg, nsa_id=header.provider_nsa)
                 return failure.Failure(ex)
             else:
                 # cannot handle it here
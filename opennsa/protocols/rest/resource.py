@@ -77,7 +77,7 @@ def _createErrorResponse(err, request):
 
 
 @defer.inlineCallbacks
-def conn2dict(conn):
+def conn2dict(conn, data_plane_status=None):
 
     def label(label):
         if label is None:
@@ -98,18 +98,9 @@ def conn2dict(conn):
     d['provision_state']   = conn.provision_state
     d['lifecycle_state']   = conn.lifecycle_state
 
-    # this really needs to be in the database module (aggregator uses this too)
-    df = database.SubConnection.findBy(service_connection_id=conn.id)
-    sub_conns = yield df
-
-    # copied from aggregator, refactor sometime
-    if len(sub_conns) == 0: # apparently this can happen
-        data_plane_status = (False, 0, False)
-    else:
-        aggr_active     = all( [ sc.data_plane_active     for sc in sub_conns ] )
-        aggr_version    = max( [ sc.data_plane_version    for sc in sub_conns ] ) or 0 # can be None otherwise
-        aggr_consistent = all( [ sc.data_plane_consistent for sc in sub_conns ] )
-        data_plane_status = (aggr_active, aggr_version, aggr_consistent)
+    if data_plane_status is None:
+        status = yield database.getDataPlaneStatus( [ conn.id ] )
+        data_plane_status = status.get(conn.id, database.NO_DATA_PLANE_STATUS)
 
     d['data_plane_active'] = conn.data_plane = data_plane_status[0]
 
@@ -137,23 +128,47 @@ class P2PBaseResource(resource.Resource):
         # this should return a list of authZed connections with some usefull information
         # we cannot really do any meaningfull authz at the moment though...
 
-        @defer.inlineCallbacks
-        def gotConnections(conns):
-            res = []
-
-            for conn in conns:
-                d = yield conn2dict(conn)
-                res.append(d)
-
-            payload = json.dumps(res) + RN
+        # connections are loaded and written a page at the time, the list can be long
+        # the response is started when the first page has been loaded, so an error loading it gets a proper error response
+        finished = []
+        request.notifyFinish().addBoth(finished.append)
 
-            request.setResponseCode(200)
-            request.setHeader("Content-Type", 'application/json')
-            request.write(payload.encode())
-            request.finish()
+        @defer.inlineCallbacks
+        def writeConnections():
+            after_id = 0
+            separator = b'['
+            while not finished:
+                page = yield database.findConnectionSummaries(after_id=after_id)
+                if after_id == 0:
+                    request.setResponseCode(200)
+                    request.setHeader("Content-Type", 'application/json')
+                for conn, data_plane_status in page:
+                    d = yield conn2dict(conn, data_plane_status)
+                    request.write(separator + json.dumps(d).encode())
+                    separator = b', '
+                if len(page) < database.SUMMARY_PAGE_SIZE:
+                    break
+                after_id = page[-1][0].id
+            return separator
+
+        def finish(separator):
+            if not finished:
+                request.write(( '[]' if separator == b'[' else ']' ).encode() + RN.encode())
+                request.finish()
+
+        def writeError(err):
+            log.msg('Error while listing connections: %s' % err.getErrorMessage(), system=LOG_SYSTEM)
+            if finished:
+                return
+            if request.startedWriting:
+                # the status has been sent, so the error can only be reported by not completing the response,
+                # ending it normally would leave the client with a truncated list, which looks like a complete one
+                request.transport.abortConnection()
+            else:
+                _finishRequest(request, _errorCode(err.value), str(err.value) + RN)
 
-        d = database.ServiceConnection.find()
-        d.addCallbacks(gotConnections, _createErrorResponse, errbackArgs=(request,))
+        d = writeConnections()
+        d.addCallbacks(finish, writeError)
         return server.NOT_DONE_YET
 
 
@@ -243,16 +258,20 @@ class P2PBaseResource(resource.Resource):
 
                     conn = yield self.provider.getConnection(conn_id)
 
-                    def stateUpdate():
-                        log.msg('stateUpdate reservation_state: %s, provision_state: %s' % (str(conn.reservation_state), str(conn.provision_state)), debug=True, system=LOG_SYSTEM)
-                        if conn.reservation_state == state.RESERVE_HELD:
+                    def stateUpdate(event):
+                        reservation_state, provision_state, _ = event.new_states
+                        log.msg('stateUpdate reservation_state: %s, provision_state: %s' % (str(reservation_state), str(provision_state)), debug=True, system=LOG_SYSTEM)
+                        if reservation_state == state.RESERVE_HELD:
                             self.provider.reserveCommit(header, conn_id, request_info)
-                        if conn.reservation_state == state.RESERVE_START and conn.provision_state == state.RELEASED and auto_provision:
-                            self.provider.provision(header, conn_id, request_info)
-                        if conn.provision_state == state.PROVISIONED:
-                            state.desubscribe(conn_id, stateUpdate)
+                        if reservation_state == state.RESERVE_START and provision_state == state.RELEASED:
+                            if auto_provision:
+                                self.provider.provision(header, conn_id, request_info)
+                            else:
+                                subscription.cancel() # committed, nothing more to do
+                        if provision_state == state.PROVISIONED:
+                            subscription.cancel()
 
-                    state.subscribe(conn_id, stateUpdate)
+                    subscription = state.subscribe(conn_id, stateUpdate)
 
                 d.addCallback(connectionCreated)
 
@@ -333,18 +352,27 @@ class P2PStatusResource(resource.Resource):
         def gotConnection(conn):
             request.setResponseCode(200)
 
-            def writeStatusPayload():
+            def writeStatusPayload(timestamp, states):
                 d = {}
-                d['timestamp']         = int(time.time())
-                d['reservation_state'] = conn.reservation_state
-                d['provision_state']   = conn.provision_state
-                d['lifecycle_state']   = conn.lifecycle_state
+                d['timestamp']         = int(timestamp)
+                d['reservation_state'] = states[0]
+                d['provision_state']   = states[1]
+                d['lifecycle_state']   = states[2]
 
                 payload = json.dumps(d) + RN
-                request.write(payload)
+                request.write(payload.encode())
 
-            writeStatusPayload()
-            state.subscribe(conn.connection_id, lambda : writeStatusPayload() )
+            def stateUpdate(event):
+                writeStatusPayload(event.timestamp, event.new_states)
+                if event.new_states[2] == state.TERMINATED:
+                    request.finish() # no more updates will come
+
+            writeStatusPayload(time.time(), (conn.reservation_state, conn.provision_state, conn.lifecycle_state) )
+            if conn.lifecycle_state == state.TERMINATED:
+                request.finish()
+            else:
+                # the subscription is removed when the request finishes, including client disconnects
+                state.subscribe(conn.connection_id, stateUpdate, request)
             return server.NOT_DONE_YET
 
         def noConnection(err):
@@ -1,21 +1,32 @@
 """
 A nice handy HTTP client.
 
+All requests go through a shared pool of persistent (HTTP/1.1 keep-alive)
+connections, so consecutive requests to the same host do not have to set up
+a new TCP connection and TLS handshake for each request.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2011-2012)
 """
 
+from io import BytesIO
+
 from twisted.python import log
 from twisted.internet import reactor, defer
-from twisted.web import client as twclient, http as twhttp
+from twisted.web import client as twclient, http_headers
 from twisted.web.error import Error as WebError
-from twisted.internet.error import ConnectionClosed, ConnectionRefusedError
+from twisted.internet.error import ConnectionClosed, ConnectionDone, ConnectionRefusedError
+
+from opennsa import ctxfactory
 
 
 LOG_SYSTEM = 'HTTPClient'
 
 DEFAULT_TIMEOUT = 30 # seconds
 
+MAX_CONNECTIONS_PER_HOST    = 8  # concurrent requests (and cached connections) per host
+IDLE_TIMEOUT                = 20 # seconds, should be lower than the keep-alive timeout of most servers
+
 
 
 class HTTPRequestError(Exception):
@@ -24,63 +35,191 @@ class HTTPRequestError(Exception):
     """
 
 
-def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
 
-    if not headers:
-        headers = {}
+class HTTPConnectionPool(object):
+    """
+    Pool of persistent HTTP connections, shared between all clients.
 
-    headers['Content-Type'] = 'text/xml; charset=utf-8' # CXF will complain if this is not set
-    headers['soapaction'] = soap_action
+    The number of concurrent requests to a host is limited, excess requests
+    are queued. Idle connections are closed after the idle timeout.
 
-    return httpRequest(url, soap_envelope, headers, ctx_factory=ctx_factory)
+    Connections are kept per context factory, as the Twisted pool only keys
+    them on scheme, host, and port, and a TLS connection made with one client
+    certificate must not be used for requests with another.
+    """
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, idle_timeout=IDLE_TIMEOUT):
 
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+
+        self.pools  = {}            # ctx_factory -> twisted HTTPConnectionPool
+        self.agents = {}            # ctx_factory -> Agent
+        self.host_semaphores = {}   # (ctx_factory, scheme, host, port) -> DeferredSemaphore
+
+
+    def getAgent(self, ctx_factory=None):
+        try:
+            return self.agents[ctx_factory]
+        except KeyError:
+            pool = twclient.HTTPConnectionPool(reactor, persistent=True)
+            pool.maxPersistentPerHost    = self.max_per_host
+            pool.cachedConnectionTimeout = self.idle_timeout
+            self.pools[ctx_factory] = pool
+            if ctx_factory is None:
+                agent = twclient.Agent(reactor, pool=pool)
+            else:
+                agent = twclient.Agent(reactor, contextFactory=ctxfactory.AgentPolicy(ctx_factory), pool=pool)
+            self.agents[ctx_factory] = agent
+            return agent
+
+
+    def _hostSemaphore(self, url, ctx_factory):
+        uri = twclient.URI.fromBytes(url)
+        key = (ctx_factory, uri.scheme, uri.host, uri.port)
+        try:
+            return self.host_semaphores[key]
+        except KeyError:
+            semaphore = defer.DeferredSemaphore(self.max_per_host)
+            self.host_semaphores[key] = semaphore
+            return semaphore
+
+
+    def request(self, method, url, headers, payload=None, timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+        """
+        Perform a request, returning a deferred firing with an HTTPResponse.
+        """
+        agent = self.getAgent(ctx_factory)
+
+        def doRequest(retry=True):
+            body = None if payload is None else twclient.FileBodyProducer(BytesIO(payload))
+            d = agent.request(method, url, headers, body)
+
+            def requestFailed(err):
+                # A server may close an idle persistent connection, as we send a request on it.
+                # Twisted only retries idempotent requests. Others (e.g., SOAP POSTs) are only retried
+                # if the request was never sent, as the server may have processed it otherwise.
+                if retry and err.check(twclient.RequestTransmissionFailed):
+                    if all( reason.check(ConnectionDone) for reason in err.value.reasons ):
+                        log.msg('Connection closed before request to %s was sent, retrying' % url.decode(), debug=True, system=LOG_SYSTEM)
+                        return doRequest(retry=False)
+                return err
+
+            d.addCallbacks(readResponse, requestFailed)
+            return d
+
+        def readResponse(response):
+            response_headers = { name.decode().lower() : values[-1].decode() for name, values in response.headers.getAllRawHeaders() }
+            d = twclient.readBody(response)
+            d.addCallback(lambda body : HTTPResponse(response.code, response_headers, body))
+            return d
+
+        d = self._hostSemaphore(url, ctx_factory).run(doRequest)
+        d.addTimeout(timeout, reactor)
+        return d
+
+
+    def closeCachedConnections(self):
+        # the semaphores are created again on use, so hosts which are no longer used do not stay around
+        self.host_semaphores = {}
+        return defer.DeferredList( [ pool.closeCachedConnections() for pool in self.pools.values() ] )
+
+
+
+_pool = None
+
+def getPool():
+    # the pool is created on first use, as it must be created with the reactor that is used
+    global _pool
+    if _pool is None:
+        _pool = HTTPConnectionPool()
+    return _pool
+
+
+def closeConnections():
+    # close all idle connections, returns a deferred, useful when shutting down
+    if _pool is None:
+        return defer.succeed(None)
+    return _pool.closeCachedConnections()
+
+
+
+class HTTPResponse(object):
+    """
+    Status code, headers, and body of a response. Header names are lower case
+    str, and only the last value of a header is kept.
+    """
+    def __init__(self, code, headers, body):
+        self.code    = code
+        self.headers = headers
+        self.body    = body
 
 
-def httpRequest(url, payload, headers, method=b'POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
-    # copied from twisted.web.client in order to get access to the
-    # factory (which contains response codes, headers, etc)
+
+def _checkURL(url):
 
     # Make request work with both str and bytes url
     if type(url) is str:
         url = url.encode()
 
     if type(url) is not bytes:
-        e = HTTPRequestError('URL must be bytes, not %s' % type(url))
-        return defer.fail(e)
+        raise HTTPRequestError('URL must be bytes, not %s' % type(url))
 
     if not url.startswith(b'http'):
-        e = HTTPRequestError('URL does not start with http (URL %s)' % (url))
-        return defer.fail(e)
+        raise HTTPRequestError('URL does not start with http (URL %s)' % (url))
+
+    return url
 
-    log.msg(" -- Sending Payload to {} --".format(url), system=LOG_SYSTEM, payload=True)
-    log.msg(payload, system=LOG_SYSTEM, payload=True)
-    log.msg(' -- END --', system=LOG_SYSTEM, payload=True)
 
-    scheme, netloc, _ , _, _, _ = twhttp.urlparse(url)
-    if not b':' in netloc:
-        host = netloc
-        port = 80 if scheme == 'http' else 443
-    else:
-        host, s_port = netloc.split(b':',1)
-        port = int(s_port)
+def _createHeaders(headers):
 
-    factory = twclient.HTTPClientFactory(url, method, postdata=payload, timeout=timeout)
-    factory.noisy = False # stop spewing about factory start/stop
-    factory.protocol.handleStatus_204 = lambda _ : None # 204 is an ok reply, needed by NCS VPN backend
+    request_headers = http_headers.Headers()
+    request_headers.setRawHeaders(b'User-Agent', [ b'OpenNSA/Twisted' ])
+    for header, value in (headers or {}).items():
+        request_headers.setRawHeaders(header.encode('utf-8'), [ value.encode('utf-8') ])
+    return request_headers
 
-    # fix missing port in header (possible bug in twisted.web.client, or just low-level library)
-    factory.headers[b'host'] = netloc
-    factory.headers[b'User-Agent'] = b'OpenNSA/Twisted'
 
-    for header, value in headers.items():
-        factory.headers[header.encode('utf-8')] = value.encode('utf-8')
 
-    if scheme == b'https':
-        if ctx_factory is None:
-            return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
-        reactor.connectSSL(host, port, factory, ctx_factory)
-    else:
-        reactor.connectTCP(host, port, factory)
+def soapRequest(url, soap_action, soap_envelope, timeout=DEFAULT_TIMEOUT, ctx_factory=None, headers=None):
+
+    if not headers:
+        headers = {}
+
+    headers['Content-Type'] = 'text/xml; charset=utf-8' # CXF will complain if this is not set
+    headers['soapaction'] = soap_action
+
+    return httpRequest(url, soap_envelope, headers, timeout=timeout, ctx_factory=ctx_factory)
+
+
+
+def httpRequest(url, payload, headers, method=b'POST', timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+    """
+    Perform a request, returning a deferred firing with the response body.
+    Non-2xx responses result in a twisted.web.error.Error, with the status
+    and response body.
+    """
+    try:
+        url = _checkURL(url)
+    except HTTPRequestError as e:
+        return defer.fail(e)
+
+    if type(method) is str:
+        method = method.encode()
+    if type(payload) is str:
+        payload = payload.encode('utf-8')
+
+    if url.startswith(b'https') and ctx_factory is None:
+        return defer.fail(HTTPRequestError('Cannot perform https request without context factory'))
+
+    log.msg(" -- Sending Payload to {} --".format(url), system=LOG_SYSTEM, payload=True)
+    log.msg(payload, system=LOG_SYSTEM, payload=True)
+    log.msg(' -- END --', system=LOG_SYSTEM, payload=True)
+
+    def checkStatus(response):
+        if 200 <= response.code < 300:
+            return response.body # 204 is an ok reply, needed by NCS VPN backend
+        else:
+            raise WebError(str(response.code).encode(), response=response.body)
 
     def invocationError(err):
         if isinstance(err.value, ConnectionClosed): # note: this also includes ConnectionDone and ConnectionLost
@@ -94,7 +233,7 @@ def httpRequest(url, payload, headers, method=b'POST', timeout=DEFAULT_TIMEOUT,
             log.msg(' -- END --', system=LOG_SYSTEM, payload=True)
             return err
         elif isinstance(err.value, ConnectionRefusedError):
-            log.msg('Connection refused for %s:%i. Request URL: %s' % (host, port, url), system=LOG_SYSTEM)
+            log.msg('Connection refused. Request URL: %s' % (url), system=LOG_SYSTEM)
             return err
         else:
             return err
@@ -105,7 +244,27 @@ def httpRequest(url, payload, headers, method=b'POST', timeout=DEFAULT_TIMEOUT,
         log.msg('-- END --', system=LOG_SYSTEM, payload=True)
         return data
 
-    factory.deferred.addCallbacks(logReply, invocationError)
+    d = getPool().request(method, url, _createHeaders(headers), payload, timeout=timeout, ctx_factory=ctx_factory)
+    d.addCallback(checkStatus)
+    d.addCallbacks(logReply, invocationError)
+    return d
+
+
+
+def httpGet(url, headers=None, timeout=DEFAULT_TIMEOUT, ctx_factory=None):
+    """
+    Perform a GET request, returning a deferred firing with an HTTPResponse.
+
+    Unlike httpRequest, the response status and headers are available, and
+    any status is returned, i.e., 304 (Not Modified) is not an error. This
+    makes it usable for conditional requests.
+    """
+    try:
+        url = _checkURL(url)
+    except HTTPRequestError as e:
+        return defer.fail(e)
 
-    return factory.deferred
+    if url.startswith(b'https') and ctx_factory is None:
+        return defer.fail( HTTPRequestError('Cannot perform https request without context factory') )
 
+    return getPool().request(b'GET', url, _createHeaders(headers), timeout=timeout, ctx_factory=ctx_factory)
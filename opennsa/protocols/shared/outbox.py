@@ -0,0 +1,293 @@
+"""
+Persistent outbox for outgoing SOAP messages (confirmations and notifications).
+
+Messages are stored in the outbox table and put on an in-memory queue for the
+requester they are sent to. Each requester has its own queue, messages to a
+requester are delivered one at the time, in the order they were sent, while
+different requesters are delivered to concurrently. A slow or unavailable
+requester only holds up its own messages.
+
+If delivery fails because the requester could not be reached, it is retried
+with exponential backoff, until the message expires. If the requester replies
+with an error (e.g., a SOAP fault), retrying will not help, and the message is
+dropped. Delivered and dropped messages are removed from the table, messages
+still in it when OpenNSA is started are loaded and delivered. Nothing is
+delivered until they are loaded, and they are put in front of messages sent in
+the meantime, so messages to a requester stay in order across a restart.
+"""
+
+import collections
+
+from twisted.python import log
+from twisted.internet import reactor, defer
+from twisted.web.error import Error as WebError
+
+from twistar.registry import Registry
+
+from opennsa.protocols.shared import httpclient
+
+
+LOG_SYSTEM = 'Outbox'
+
+RETRY_INITIAL   = 2         # seconds, delay before the first retry
+RETRY_MAX       = 300       # seconds, maximum delay between retries
+MAX_AGE         = 24 * 3600 # seconds, messages which cannot be delivered in this time are dropped
+
+
+
+def _storeMessage(requester_url, soap_action, payload):
+    # returns a deferred firing with the id of the stored message
+    query = 'INSERT INTO outbox (requester_url, soap_action, payload, created) VALUES (%s, %s, %s, now() at time zone \'utc\') RETURNING id;'
+    d = Registry.DBPOOL.runQuery(query, (requester_url, soap_action, payload) )
+    d.addCallback(lambda rows : rows[0][0])
+    return d
+
+
+def _deleteMessage(message_id):
+    return Registry.DBPOOL.runOperation('DELETE FROM outbox WHERE id = %s;', (message_id,) )
+
+
+def _loadMessages():
+    # returns a deferred firing with a list of (id, requester_url, soap_action, payload, age in seconds)
+    query = 'SELECT id, requester_url, soap_action, payload, extract(epoch from (now() at time zone \'utc\') - created) FROM outbox ORDER BY id;'
+    return Registry.DBPOOL.runQuery(query)
+
+
+def _deliver(requester_url, soap_action, payload, ctx_factory):
+    return httpclient.soapRequest(requester_url, soap_action, payload, ctx_factory=ctx_factory)
+
+
+def _isPermanentFailure(err):
+    # the requester answered, but not with success, sending it again will not change that
+    # 502, 503, and 504 are usually from a proxy in front of a requester, which is down
+    return err.check(WebError) and int(err.value.status) not in (502, 503, 504)
+
+
+
+class OutboxMessage:
+
+    def __init__(self, requester_url, soap_action, payload, created):
+        self.requester_url  = requester_url
+        self.soap_action    = soap_action
+        self.payload        = payload
+        self.created        = created   # clock seconds
+        self.attempts       = 0
+        self.stored         = None      # deferred firing with the message id, once stored
+
+
+
+class RequesterQueue:
+    """
+    Messages for a single requester, delivered in order.
+    """
+    def __init__(self, outbox, requester_url):
+        self.outbox = outbox
+        self.requester_url = requester_url
+        self.messages = collections.deque()
+        self.delivering = False
+        self.retry_call = None
+        self.retry_delay = RETRY_INITIAL
+        self.stopped = False
+
+
+    def add(self, message):
+        self.messages.append(message)
+        self._deliverNext()
+
+
+    def addLoaded(self, messages):
+        # messages stored before a restart, in id order, they go before any message sent since
+        self.messages.extendleft(reversed(messages))
+
+
+    def _deliverNext(self):
+        if self.delivering or self.retry_call is not None or not self.messages or self.stopped or self.outbox.loading:
+            return
+        message = self.messages[0]
+        message.attempts += 1
+        self.delivering = True
+        d = defer.maybeDeferred(_deliver, message.requester_url, message.soap_action, message.payload, self.outbox.ctx_factory)
+        d.addCallbacks(self._delivered, self._deliveryFailed, callbackArgs=(message,), errbackArgs=(message,))
+
+
+    def _delivered(self, _, message):
+        if self.stopped: # the message is still stored, and will be delivered again after a restart
+            return
+        self.delivering = False
+        self.retry_delay = RETRY_INITIAL
+        self.messages.popleft()
+        self.outbox._removeMessage(message, delivered=True)
+        self._deliverNext()
+
+
+    def _deliveryFailed(self, err, message):
+        if self.stopped:
+            return
+        self.delivering = False
+
+        if _isPermanentFailure(err):
+            log.msg('Requester %s rejected %s, dropping message: %s' % (self.requester_url, message.soap_action, err.getErrorMessage()), system=LOG_SYSTEM)
+        elif self.outbox.clock.seconds() - message.created + self.retry_delay > self.outbox.max_age:
+            log.msg('Could not deliver %s to %s in %i attempts, dropping message: %s' % \
+                    (message.soap_action, self.requester_url, message.attempts, err.getErrorMessage()), system=LOG_SYSTEM)
+        else:
+            log.msg('Error delivering %s to %s, retrying in %i seconds: %s' % \
+                    (message.soap_action, self.requester_url, self.retry_delay, err.getErrorMessage()), system=LOG_SYSTEM)
+            self.retry_call = self.outbox.clock.callLater(self.retry_delay, self._retry)
+            self.retry_delay = min(self.retry_delay * 2, RETRY_MAX)
+            return
+
+        self.retry_delay = RETRY_INITIAL
+        self.messages.popleft()
+        self.outbox._removeMessage(message, delivered=False)
+        self._deliverNext()
+
+
+    def _retry(self):
+        self.retry_call = None
+        self._deliverNext()
+
+
+    def stop(self):
+        self.stopped = True
+        if self.retry_call is not None:
+            self.retry_call.cancel()
+            self.retry_call = None
+
+
+
+class Outbox:
+
+    def __init__(self, ctx_factory=None, max_age=MAX_AGE):
+        self.ctx_factory = ctx_factory
+        self.max_age = max_age
+        self.queues = {}    # requester url -> RequesterQueue
+        self.stored_ids = set() # ids of stored messages in the queues
+        self.stopped = False
+        self.loading = False    # messages from before the last stop are being loaded, nothing is delivered meanwhile
+
+        self.delivered = 0
+        self.dropped = 0
+
+        self.clock = reactor
+
+
+    def send(self, requester_url, soap_action, payload):
+        """
+        Store a message and queue it for delivery. Returns a deferred, which
+        fires when the message is stored, i.e., before it is delivered.
+        """
+        message = OutboxMessage(requester_url, soap_action, payload, self.clock.seconds())
+
+        def storeFailed(err):
+            # deliver it anyway, it will just not survive a restart
+            log.msg('Error storing %s for %s in outbox: %s' % (soap_action, requester_url, err.getErrorMessage()), system=LOG_SYSTEM)
+            return None
+
+        message.stored = defer.maybeDeferred(_storeMessage, requester_url, soap_action, payload)
+        message.stored.addCallbacks(self._stored, storeFailed)
+        self._queue(message)
+
+        d = defer.Deferred()
+        message.stored.addBoth(lambda message_id : d.callback(None) or message_id)
+        return d
+
+
+    def _stored(self, message_id):
+        self.stored_ids.add(message_id)
+        return message_id
+
+
+    def _getQueue(self, requester_url):
+        try:
+            return self.queues[requester_url]
+        except KeyError:
+            queue = RequesterQueue(self, requester_url)
+            self.queues[requester_url] = queue
+            return queue
+
+
+    def _queue(self, message):
+        self._getQueue(message.requester_url).add(message)
+
+
+    def _removeMessage(self, message, delivered):
+        if delivered:
+            self.delivered += 1
+        else:
+            self.dropped += 1
+
+        def removeStored(message_id):
+            if message_id is not None:
+                self.stored_ids.discard(message_id)
+                d = _deleteMessage(message_id)
+                d.addErrback(lambda err : log.msg('Error removing message %s from outbox: %s' % (message_id, err.getErrorMessage()), system=LOG_SYSTEM))
+            return message_id
+
+        message.stored.addCallback(removeStored)
+
+        queue = self.queues.get(message.requester_url)
+        if queue is not None and not queue.messages and queue.retry_call is None:
+            del self.queues[message.requester_url]
+
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Load messages not delivered before the last stop, and start delivering
+        them. Messages sent before the load has finished are held back, and
+        delivered after the loaded ones, so this should be called before the
+        service starts sending messages.
+        """
+        self.stopped = False
+        self.loading = True
+        try:
+            rows = yield _loadMessages()
+        except Exception:
+            # deliver what has been sent meanwhile, the stored messages are loaded on the next start
+            self.loading = False
+            self._deliverQueued()
+            raise
+
+        self.loading = False
+        if self.stopped: # stopped while loading
+            return
+
+        now = self.clock.seconds()
+        loaded = collections.OrderedDict() # requester url -> [ OutboxMessage ]
+        for message_id, requester_url, soap_action, payload, age in rows:
+            if message_id in self.stored_ids:
+                continue # sent after this process started
+            message = OutboxMessage(requester_url, soap_action, bytes(payload), now - float(age))
+            message.stored = defer.succeed( self._stored(message_id) )
+            loaded.setdefault(requester_url, []).append(message)
+
+        for requester_url, messages in loaded.items():
+            self._getQueue(requester_url).addLoaded(messages)
+        self._deliverQueued()
+
+        n_loaded = sum( len(messages) for messages in loaded.values() )
+        if n_loaded:
+            log.msg('Loaded %i undelivered messages' % n_loaded, system=LOG_SYSTEM)
+
+
+    def _deliverQueued(self):
+        for queue in list(self.queues.values()):
+            queue._deliverNext()
+
+
+    def stop(self):
+        """
+        Stop delivering messages. Messages not delivered yet are kept in the
+        database, and delivered when the outbox is started again.
+        """
+        self.stopped = True
+        for queue in self.queues.values():
+            queue.stop()
+        self.queues = {}
+        self.stored_ids = set()
+
+
+    def stats(self):
+        return { 'queued': sum( len(q.messages) for q in self.queues.values() ), 'requesters': len(self.queues),
+                 'delivered': self.delivered, 'dropped': self.dropped }
@@ -6,14 +6,166 @@ huge pain in the ass. This is a combination of things, such as seperate
 identities and endpoints, callbacks, and the combination of local providers.
 
 The class ProviderRegistry tries to keep it a bit sane.
+
+Providers spawned from NSI agents (i.e., remote providers) are put behind a
+ProviderDispatcher, which limits the number of concurrent calls to the
+provider, and stops calling it for a while, if it appears to be down.
 """
 
-from twisted.python import log
+from twisted.python import log, failure
+from twisted.internet import reactor, defer, error as interneterror
+from twisted.web import client as twclient
+from twisted.web.error import Error as WebError
 
 from opennsa import error
 
 LOG_SYSTEM = 'providerregistry'
 
+MAX_CONCURRENT_CALLS    = 20    # calls in progress (including waiting for confirmation) per provider, excess calls are queued
+FAILURE_THRESHOLD       = 5     # consecutive failures to reach a provider before calls are failed right away (circuit open)
+OPEN_TIME               = 30    # seconds the circuit stays open, before a single trial call is let through
+LATENCY_WEIGHT          = 0.2   # weight of the latest call in the average latency
+
+
+
+# failures of getting a request to, or a reply from, a provider
+TRANSPORT_ERRORS = (error.DownstreamNSAUnreachableError, error.CallbackTimeoutError, defer.TimeoutError,
+                    interneterror.ConnectError, twclient.ResponseNeverReceived, twclient.RequestTransmissionFailed)
+
+
+def _isUnavailable(err):
+    # Only transport failures count. Any NSI error means the provider is there, just not happy with the
+    # request, also DownstreamNSAError, which may come from a provider further down the chain being down.
+    if err.check(WebError):
+        return err.value.status != b'500' # a soap fault is a reply, other statuses are usually from a proxy
+    return err.check(*TRANSPORT_ERRORS) is not None
+
+
+
+class ProviderDispatcher(object):
+    """
+    Sits in front of a provider. Calls to the provider are made through a
+    semaphore, limiting the number of concurrent calls, and the latency and
+    failures of the calls are tracked.
+
+    When a number of consecutive calls have failed due to the provider being
+    unavailable (not being reachable or not replying in time), the circuit
+    is opened, and calls fail right away with DownstreamNSAError. After a
+    while a single call is let through, if it succeeds the circuit is closed
+    again, otherwise it stays open for another period.
+
+    Other attributes are taken from the provider.
+    """
+    def __init__(self, provider, provider_urn, max_concurrent=MAX_CONCURRENT_CALLS, failure_threshold=FAILURE_THRESHOLD, open_time=OPEN_TIME):
+        self.provider           = provider
+        self.provider_urn       = provider_urn
+        self.failure_threshold  = failure_threshold
+        self.open_time          = open_time
+
+        self.semaphore = defer.DeferredSemaphore(max_concurrent)
+        self.consecutive_failures = 0
+        self.opened_at = None       # clock seconds when the circuit was opened, None if closed
+        self.trial_call = False     # if a trial call is in progress, while the circuit is open
+
+        self.calls      = 0
+        self.failures   = 0
+        self.rejected   = 0
+        self.latency    = None      # average latency of calls (seconds)
+
+        self.clock = reactor
+
+
+    def __getattr__(self, attr):
+        return getattr(self.provider, attr)
+
+
+    def reserve(self, *args, **kwargs):
+        return self.dispatch('reserve', *args, **kwargs)
+
+    def reserveCommit(self, *args, **kwargs):
+        return self.dispatch('reserveCommit', *args, **kwargs)
+
+    def reserveAbort(self, *args, **kwargs):
+        return self.dispatch('reserveAbort', *args, **kwargs)
+
+    def provision(self, *args, **kwargs):
+        return self.dispatch('provision', *args, **kwargs)
+
+    def release(self, *args, **kwargs):
+        return self.dispatch('release', *args, **kwargs)
+
+    def terminate(self, *args, **kwargs):
+        return self.dispatch('terminate', *args, **kwargs)
+
+    def querySummary(self, *args, **kwargs):
+        return self.dispatch('querySummary', *args, **kwargs)
+
+    def queryRecursive(self, *args, **kwargs):
+        return self.dispatch('queryRecursive', *args, **kwargs)
+
+
+    def dispatch(self, operation, *args, **kwargs):
+        trial_call = False
+        if self.opened_at is not None:
+            if not self._allowTrialCall():
+                return self._reject(operation)
+            trial_call = True
+        return self.semaphore.run(self._call, operation, trial_call, args, kwargs)
+
+
+    def _allowTrialCall(self):
+        if self.trial_call or self.clock.seconds() - self.opened_at < self.open_time:
+            return False
+        self.trial_call = True
+        return True
+
+
+    def _reject(self, operation):
+        self.rejected += 1
+        msg = 'Provider %s is unavailable (%i consecutive failures), not sending %s request' % (self.provider_urn, self.consecutive_failures, operation)
+        return defer.fail( error.DownstreamNSAError(msg, nsa_id=self.provider_urn) )
+
+
+    def _call(self, operation, trial_call, args, kwargs):
+        # the circuit may have been opened while the call was queued
+        if self.opened_at is not None and not trial_call:
+            return self._reject(operation)
+
+        self.calls += 1
+        start_time = self.clock.seconds()
+        d = defer.maybeDeferred(getattr(self.provider, operation), *args, **kwargs)
+        d.addBoth(self._callDone, start_time, trial_call)
+        return d
+
+
+    def _callDone(self, result, start_time, trial_call):
+        latency = self.clock.seconds() - start_time
+        self.latency = latency if self.latency is None else (1 - LATENCY_WEIGHT) * self.latency + LATENCY_WEIGHT * latency
+        if trial_call:
+            self.trial_call = False
+
+        if isinstance(result, failure.Failure) and _isUnavailable(result):
+            self.failures += 1
+            self.consecutive_failures += 1
+            if trial_call or (self.opened_at is None and self.consecutive_failures >= self.failure_threshold):
+                log.msg('Provider %s unavailable after %i consecutive failures, failing calls for %i seconds. Last error: %s' % \
+                        (self.provider_urn, self.consecutive_failures, self.open_time, result.getErrorMessage()), system=LOG_SYSTEM)
+                self.opened_at = self.clock.seconds()
+        else:
+            self.consecutive_failures = 0
+            if self.opened_at is not None:
+                log.msg('Provider %s available again' % self.provider_urn, system=LOG_SYSTEM)
+                self.opened_at = None
+
+        return result
+
+
+    def stats(self):
+        return { 'calls': self.calls, 'failures': self.failures, 'rejected': self.rejected, 'latency': self.latency,
+                 'in_progress': self.semaphore.limit - self.semaphore.tokens, 'queued': len(self.semaphore.waiting),
+                 'open': self.opened_at is not None }
+
+
 
 class ProviderRegistry(object):
 
@@ -78,7 +230,7 @@ class ProviderRegistry(object):
                 return
 
         factory = self.provider_factories[ nsi_agent.getServiceType() ]
-        provisioner = factory(nsi_agent)
+        provisioner = ProviderDispatcher(factory(nsi_agent), nsi_agent.urn())
 
         self.addProvider(nsi_agent.urn(), network_id, provisioner)
         log.msg('Spawned new provider for %s' % nsi_agent, system=LOG_SYSTEM)
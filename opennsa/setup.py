@@ -19,20 +19,25 @@ import datetime
 import importlib
 
 from twisted.python import log
+from twisted.internet import defer
 from twisted.web import resource, server
 from twisted.application import internet, service as twistedservice
 
 from opennsa import __version__ as version
 
-from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource
+from opennsa import config, logging, constants as cnt, nsa, provreg, database, aggregator, viewresource, state, journal
 from opennsa.topology import nrm, nml, linkvector, service as nmlservice
 from opennsa.protocols import rest, nsi2
-from opennsa.protocols.shared import httplog
+from opennsa.protocols.shared import httplog, httpclient, outbox
+from opennsa.backends.common import ssh
 from opennsa.discovery import service as discoveryservice, fetcher
 
 
 NSI_RESOURCE = b'NSI'
 
+# coalesce link vector updates (from discovery fetching) within this time, before updating the discovery document
+LINK_VECTOR_NOTIFY_DELAY = 2 # seconds
+
 
 def setupBackend(backend_cfg, network_name, nrm_ports, parent_requester):
 
@@ -143,6 +148,8 @@ class OpenNSAService(twistedservice.MultiService):
     def __init__(self, vc):
         twistedservice.MultiService.__init__(self)
         self.vc = vc
+        self.journal = None
+        self.outbox = None
 
 
     def setupServiceFactory(self):
@@ -164,6 +171,10 @@ class OpenNSAService(twistedservice.MultiService):
         # database
         database.setupDatabase(vc[config.DATABASE], vc[config.DATABASE_USER], vc[config.DATABASE_PASSWORD], vc[config.DATABASE_HOST], vc[config.SERVICE_ID_START])
 
+        # state transition journal
+        self.journal = journal.JournalWriter()
+        state.setJournal(self.journal)
+
         service_endpoints = []
 
         # base names
@@ -193,13 +204,16 @@ class OpenNSAService(twistedservice.MultiService):
 
         plugin.init(vc, ctx_factory)
 
+        # confirmations and notifications to requesters
+        self.outbox = outbox.Outbox(ctx_factory)
+
         # the dance to setup dynamic providers right
         top_resource = resource.Resource()
         requester_creator = CS2RequesterCreator(top_resource, None, vc[config.HOST], vc[config.PORT], vc[config.TLS], ctx_factory) # set aggregator later
 
         provider_registry = provreg.ProviderRegistry( { cnt.CS2_SERVICE_TYPE : requester_creator.create } )
 
-        link_vector = linkvector.LinkVector()
+        link_vector = linkvector.LinkVector(notify_delay=LINK_VECTOR_NOTIFY_DELAY)
 
         networks = {}
         ports = {} # { network : { port : nrmport } }
@@ -209,7 +223,7 @@ class OpenNSAService(twistedservice.MultiService):
 
         requester_creator.aggregator = aggr
 
-        pc = nsi2.setupProvider(aggr, top_resource, ctx_factory=ctx_factory, allowed_hosts=vc.get(config.ALLOWED_HOSTS))
+        pc = nsi2.setupProvider(aggr, top_resource, ctx_factory=ctx_factory, allowed_hosts=vc.get(config.ALLOWED_HOSTS), outbox=self.outbox)
         aggr.parent_requester = pc
 
         # setup backend(s) - for now we only support one
@@ -312,7 +326,7 @@ class OpenNSAService(twistedservice.MultiService):
 
         discovery_resource = ds.resource()
         top_resource.children[NSI_RESOURCE].putChild(discovery_resource_name, discovery_resource)
-        link_vector.callOnUpdate( lambda : discovery_resource.updateResource ( ds.xml() ))
+        link_vector.callOnUpdate( lambda changed_networks : discovery_resource.updateResource ( ds.xml() ))
 
         service_endpoints.append( ('Discovery', discovery_url) )
 
@@ -330,6 +344,10 @@ class OpenNSAService(twistedservice.MultiService):
 
         factory, ctx_factory = self.setupServiceFactory()
 
+        # load messages left from the last run, before anything new can be sent, so they are delivered first
+        d = self.outbox.start()
+        d.addErrback(lambda err : log.msg('Error loading undelivered messages from outbox: %s' % err.getErrorMessage()))
+
         if self.vc[config.TLS]:
             internet.SSLServer(self.vc[config.PORT], factory, ctx_factory).setServiceParent(self)
         else:
@@ -343,6 +361,12 @@ class OpenNSAService(twistedservice.MultiService):
 
     def stopService(self):
         twistedservice.Service.stopService(self)
+        if self.outbox is not None:
+            self.outbox.stop()
+        defs = [ httpclient.closeConnections(), ssh.closeConnectionPools() ]
+        if self.journal is not None:
+            defs.append( self.journal.flush() )
+        return defer.DeferredList(defs)
 
 
 
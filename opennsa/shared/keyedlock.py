@@ -0,0 +1,78 @@
+"""
+Keyed lock. Serialises operations with the same key (typically a connection
+id), while operations with different keys run concurrently.
+
+Locks are created on demand, and removed when released with no waiters, so
+idle keys do not take up any memory.
+"""
+
+import functools
+
+from twisted.internet import defer
+
+
+
+class KeyedLock:
+
+    def __init__(self):
+        self.locks = {} # key -> DeferredLock, only for held locks
+
+
+    def acquire(self, key):
+        """
+        Acquire the lock for key. Returns a deferred firing when acquired.
+        """
+        try:
+            lock = self.locks[key]
+        except KeyError:
+            lock = defer.DeferredLock()
+            self.locks[key] = lock
+        return lock.acquire().addCallback(lambda _ : None)
+
+
+    def release(self, key):
+        lock = self.locks[key]
+        lock.release() # may run the next waiter, which can release (and remove) the lock before this returns
+        if not lock.locked and not lock.waiting and self.locks.get(key) is lock:
+            del self.locks[key]
+
+
+    def run(self, key, f, *args, **kwargs):
+        """
+        Run f with the lock for key held. Returns a deferred with the result of f.
+        """
+        def runLocked(_):
+            d = defer.maybeDeferred(f, *args, **kwargs)
+            d.addBoth(releaseLock)
+            return d
+
+        def releaseLock(result):
+            self.release(key)
+            return result
+
+        return self.acquire(key).addCallback(runLocked)
+
+
+    def locked(self, key):
+        return key in self.locks
+
+
+    def __len__(self):
+        return len(self.locks)
+
+
+
+def connectionLocked(f):
+    """
+    Decorator for provider operations taking (header, connection_id, ...).
+    Calls for the same connection id are run one at the time, using the
+    connection_locks (KeyedLock) attribute of the object. Calls without a
+    connection id (e.g., a new reservation) are not serialised.
+    """
+    @functools.wraps(f)
+    def lockedOperation(self, header, connection_id, *args, **kwargs):
+        if connection_id is None:
+            return f(self, header, connection_id, *args, **kwargs)
+        return self.connection_locks.run(connection_id, f, self, header, connection_id, *args, **kwargs)
+
+    return lockedOperation
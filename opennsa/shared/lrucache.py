@@ -0,0 +1,76 @@
+"""
+Size bounded least-recently-used cache, which never drops an object in use.
+
+The cache keeps a strong reference to at most max_size entries. An entry
+pushed out of these is only dropped when nothing else references the value
+anymore, i.e., when it is idle. Until then a lookup returns the same object,
+so a cached object is never replaced by a second copy while it is in use,
+e.g., by a request or a callback holding on to a database object. Values
+must therefore support weak references.
+"""
+
+import weakref
+from collections import OrderedDict
+
+
+
+class LRUCache:
+    """
+    Mapping with a maximum size. When full, adding an entry evicts the least
+    recently used one, once it is not referenced anywhere else. Lookups with
+    get count hits and misses.
+    """
+    def __init__(self, max_size):
+        if max_size < 1:
+            raise ValueError('Cache size must be at least 1, not %s' % max_size)
+        self.max_size = max_size
+        self.entries = OrderedDict()                # key -> value, the max_size most recently used entries
+        self.in_use = weakref.WeakValueDictionary() # key -> value, entries evicted from the above, but still referenced
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            value = self.in_use.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.put(key, value)
+            self.hits += 1
+            return value
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+
+    def put(self, key, value):
+        self.in_use.pop(key, None)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.in_use[old_key] = old_value # gone as soon as it is no longer referenced
+            self.evictions += 1
+
+
+    def evict(self, key):
+        # remove an entry, also if in use (e.g., terminated), no-op if it is not in the cache
+        self.entries.pop(key, None)
+        self.in_use.pop(key, None)
+
+
+    def stats(self):
+        return { 'size': len(self.entries), 'in_use': len(self.in_use), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.in_use
+
+
+    def __len__(self):
+        return len(self.entries) + len(self.in_use)
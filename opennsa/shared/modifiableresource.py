@@ -1,10 +1,11 @@
 """
-twisted.web.resource.Resource that supports the if-modified-since header.
-Currently only leaf behaviour is supported.
+twisted.web.resource.Resource that supports the if-modified-since and
+if-none-match headers. Currently only leaf behaviour is supported.
 
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 Copyright: NORDUnet (2013-2014)
 """
+import hashlib
 import datetime
 
 from twisted.web import resource
@@ -13,7 +14,9 @@ from twisted.web import resource
 RFC850_FORMAT       = '%a, %d %b %Y %H:%M:%S GMT'
 CONTENT_TYPE        = 'Content-type'
 LAST_MODIFIED       = 'Last-modified'
+ETAG                = 'ETag'
 IF_MODIFIED_SINCE   = 'if-modified-since'
+IF_NONE_MATCH       = 'if-none-match'
 
 
 
@@ -28,17 +31,21 @@ class ModifiableResource(resource.Resource):
         self.log_system = log_system
         self.mime_type = mime_type
 
+        self.representation = None
         self.updateResource(None) # so we always have something, resource generate an error though
 
 
     def updateResource(self, representation, update_time=None):
         # if no update time is given the current time will be used
+        if update_time is None and representation is not None and representation == self.representation:
+            return # identical representation, keep modification time so conditional requests still match
         self.representation = representation
         if update_time is None:
             update_time = datetime.datetime.utcnow().replace(microsecond=0)
 
         self.last_update_time = update_time
         self.last_modified_timestamp = datetime.datetime.strftime(update_time, RFC850_FORMAT)
+        self.etag = None if representation is None else '"%s"' % hashlib.sha1(representation).hexdigest()
 
 
     def render_GET(self, request):
@@ -46,20 +53,28 @@ class ModifiableResource(resource.Resource):
         if self.representation is None:
             # we haven't been given a representation yet
             request.setResponseCode(500)
-            return 'Resource has not yet been created/updated.'
+            return b'Resource has not yet been created/updated.'
+
+        # check for if-none-match header, and send 304 back if the representation is the same
+        inm_header = request.getHeader(IF_NONE_MATCH)
+        if inm_header:
+            if self.etag in [ etag.strip() for etag in inm_header.split(',') ]:
+                request.setResponseCode(304)
+                return b''
 
         # check for if-modified-since header, and send 304 back if it is not been modified
         msd_header = request.getHeader(IF_MODIFIED_SINCE)
-        if msd_header:
+        if msd_header and not inm_header: # if-none-match takes precedence
             try:
                 msd = datetime.datetime.strptime(msd_header, RFC850_FORMAT)
                 if msd >= self.last_update_time:
                     request.setResponseCode(304)
-                    return ''
+                    return b''
             except ValueError:
                 pass # error parsing timestamp
 
         request.setHeader(LAST_MODIFIED, self.last_modified_timestamp)
+        request.setHeader(ETAG, self.etag)
         if self.mime_type:
             request.setHeader(CONTENT_TYPE, self.mime_type)
 
@@ -0,0 +1,106 @@
+"""
+Registry of outstanding calls to child providers.
+
+Each call is registered under the correlation id of the request, together
+with the group it belongs to (e.g., the service connection the request was
+made for), so both the call and the number of outstanding calls in a group
+can be looked up in constant time.
+
+Calls which are never completed (the provider never replied), are expired
+after a while, so they do not stay around forever. As all calls have the same
+time to live, the oldest call is always the first to expire, so expiry is done
+when calls are added, without any timers.
+"""
+
+from collections import OrderedDict
+
+from twisted.python import log
+from twisted.internet import reactor
+
+
+LOG_SYSTEM = 'PendingCalls'
+
+PENDING_CALL_TTL = 3600 # seconds, calls not completed in this time are expired
+
+
+
+class PendingCalls:
+    """
+    Mapping from correlation id to call info, with outstanding calls counted per group.
+    """
+    def __init__(self, ttl=PENDING_CALL_TTL):
+        self.ttl = ttl
+        self.calls = OrderedDict()  # correlation_id -> (group, info, expire time), in order of expiry
+        self.groups = {}            # group -> number of outstanding calls
+
+        self.expired = 0
+
+        self.clock = reactor
+
+
+    def add(self, correlation_id, group, info):
+        self.expire()
+        if correlation_id in self.calls:
+            raise ValueError('Call with correlation id %s already pending' % correlation_id)
+        self.calls[correlation_id] = (group, info, self.clock.seconds() + self.ttl)
+        self.groups[group] = self.groups.get(group, 0) + 1
+
+
+    def get(self, correlation_id, default=None):
+        try:
+            return self.calls[correlation_id][1]
+        except KeyError:
+            return default
+
+
+    def pop(self, correlation_id):
+        """
+        Complete a call. Returns the info for the call, raises KeyError if the call is not pending.
+        """
+        group, info, _ = self.calls.pop(correlation_id)
+        self._decrement(group)
+        return info
+
+
+    def group(self, correlation_id):
+        return self.calls[correlation_id][0]
+
+
+    def outstanding(self, group):
+        return self.groups.get(group, 0)
+
+
+    def expire(self):
+        now = self.clock.seconds()
+        while self.calls:
+            correlation_id, (group, info, expire_time) = next(iter(self.calls.items()))
+            if expire_time > now:
+                break
+            log.msg('Call %s (%s) not completed in %i seconds, expiring it' % (correlation_id, group, self.ttl), system=LOG_SYSTEM)
+            del self.calls[correlation_id]
+            self._decrement(group)
+            self.expired += 1
+
+
+    def _decrement(self, group):
+        count = self.groups[group] - 1
+        if count:
+            self.groups[group] = count
+        else:
+            del self.groups[group]
+
+
+    def stats(self):
+        return { 'pending': len(self.calls), 'groups': len(self.groups), 'expired': self.expired }
+
+
+    def __contains__(self, correlation_id):
+        return correlation_id in self.calls
+
+
+    def __getitem__(self, correlation_id):
+        return self.calls[correlation_id][1]
+
+
+    def __len__(self):
+        return len(self.calls)
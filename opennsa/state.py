@@ -6,8 +6,9 @@ Copyright: NORDUnet (2011)
 """
 
 from twisted.python import log
+from twisted.internet import defer
 
-from opennsa import error
+from opennsa import error, eventbus
 
 
 LOG_SYSTEM = 'opennsa.state'
@@ -67,33 +68,67 @@ LIFECYCLE_TRANSITIONS = {
     TERMINATED      : []
 }
 
-SUBSCRIPTIONS = {}
+# state change events, see opennsa.eventbus
+BUS = eventbus.EventBus()
 
-def subscribe(connection_id, f):
-    global SUBSCRIPTIONS
-    SUBSCRIPTIONS.setdefault(connection_id, []).append(f)
+# transitions are recorded here, if set (a journal.JournalWriter), see setJournal
+JOURNAL = None
 
-def desubscribe(connection_id, f):
-    SUBSCRIPTIONS[connection_id].remove(f)
+def setJournal(journal_writer):
+    global JOURNAL
+    JOURNAL = journal_writer
 
+def subscribe(connection_id, f, request=None):
+    # f is called with a StateEvent, returns a subscription, which can be cancelled
+    return BUS.subscribe(connection_id, f, request)
 
-def saveNotify(conn):
 
-    def notify(conn):
-        try:
-            for f in SUBSCRIPTIONS[conn.connection_id]:
-                try:
-                    f()
-                except Exception as e:
-                    log.msg('Error during state notificaton: %s' % str(e), system=LOG_SYSTEM)
-        except KeyError:
-            #print('Nothing to notify about {}'.format(conn.connection_id))
-            pass
+def _states(conn):
+    return (conn.reservation_state, conn.provision_state, conn.lifecycle_state)
 
-        return conn
+
+# connections with transitions being coalesced, see coalesce / commit
+# connection object id -> [ StateEvent ]
+_COALESCING = {}
+
+
+def _publish(conn, events):
+    for event in events:
+        if JOURNAL is not None:
+            JOURNAL.record(conn.tablename(), event)
+        BUS.publish(event)
+    return conn
+
+
+def saveNotify(conn, old_states):
+
+    event = eventbus.StateEvent(conn.connection_id, old_states, _states(conn))
+
+    if id(conn) in _COALESCING:
+        _COALESCING[id(conn)].append(event)
+        return defer.succeed(conn)
 
     d = conn.save()
-    d.addCallback(notify)
+    d.addCallback(_publish, [ event ])
+    return d
+
+
+def coalesce(conn):
+    """
+    Start coalescing the transitions of a connection. Transitions are not
+    saved until commit is called, which saves the connection once, and then
+    publishes the events of all the transitions, in order.
+    """
+    assert id(conn) not in _COALESCING, 'Connection %s: Already coalescing transitions' % conn.connection_id
+    _COALESCING[id(conn)] = []
+
+
+def commit(conn):
+    # save coalesced transitions, returns a deferred firing with the connection
+    events = _COALESCING.pop(id(conn))
+
+    d = conn.save()
+    d.addCallback(_publish, events)
     return d
 
 
@@ -103,93 +138,72 @@ def _switchState(transition_schema, old_state, new_state):
     else:
         raise error.InternalServerError('Transition from state %s to %s not allowed' % (old_state, new_state))
 
+
+def _transition(conn, transition_schema, attribute, new_state):
+    old_states = _states(conn)
+    _switchState(transition_schema, getattr(conn, attribute), new_state)
+    setattr(conn, attribute, new_state)
+    return saveNotify(conn, old_states)
+
+
 # Reservation
 
 
 def reserveChecking(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_CHECKING)
-    conn.reservation_state = RESERVE_CHECKING
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_CHECKING)
 
 def reserveHeld(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_HELD)
-    conn.reservation_state = RESERVE_HELD
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_HELD)
 
 def reserveFailed(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_FAILED)
-    conn.reservation_state = RESERVE_FAILED
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_FAILED)
 
 def reserveCommit(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_COMMITTING)
-    conn.reservation_state = RESERVE_COMMITTING
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_COMMITTING)
 
 def reserveAbort(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_ABORTING)
-    conn.reservation_state = RESERVE_ABORTING
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_ABORTING)
 
 def reserveTimeout(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_TIMEOUT)
-    conn.reservation_state = RESERVE_TIMEOUT
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_TIMEOUT)
 
 def reserved(conn):
-    _switchState(RESERVE_TRANSITIONS, conn.reservation_state, RESERVE_START)
-    conn.reservation_state = RESERVE_START
-    return saveNotify(conn)
+    return _transition(conn, RESERVE_TRANSITIONS, 'reservation_state', RESERVE_START)
 
 def reserveMultiSwitch(conn, *states):
     # switch through multiple states in one go, note this does not save the state (because it is often needed with allocation switch)
+    old_states = _states(conn)
     for s in states:
         _switchState(RESERVE_TRANSITIONS, conn.reservation_state, s)
         conn.reservation_state = s
-    return saveNotify(conn)
+    return saveNotify(conn, old_states)
 
 
 # Provision
 
 def provisioning(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONING)
-    conn.provision_state = PROVISIONING
-    return saveNotify(conn)
+    return _transition(conn, PROVISION_TRANSITIONS, 'provision_state', PROVISIONING)
 
 def provisioned(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, PROVISIONED)
-    conn.provision_state = PROVISIONED
-    return saveNotify(conn)
+    return _transition(conn, PROVISION_TRANSITIONS, 'provision_state', PROVISIONED)
 
 def releasing(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASING)
-    conn.provision_state = RELEASING
-    return saveNotify(conn)
+    return _transition(conn, PROVISION_TRANSITIONS, 'provision_state', RELEASING)
 
 def released(conn):
-    _switchState(PROVISION_TRANSITIONS, conn.provision_state, RELEASED)
-    conn.provision_state = RELEASED
-    return saveNotify(conn)
+    return _transition(conn, PROVISION_TRANSITIONS, 'provision_state', RELEASED)
 
 # Lifecyle
 
 def passedEndtime(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, PASSED_ENDTIME)
-    conn.lifecycle_state = PASSED_ENDTIME
-    return saveNotify(conn)
+    return _transition(conn, LIFECYCLE_TRANSITIONS, 'lifecycle_state', PASSED_ENDTIME)
 
 def failed(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, FAILED)
-    conn.lifecycle_state = FAILED
-    return saveNotify(conn)
+    return _transition(conn, LIFECYCLE_TRANSITIONS, 'lifecycle_state', FAILED)
 
 def terminating(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATING)
-    conn.lifecycle_state = TERMINATING
-    return saveNotify(conn)
+    return _transition(conn, LIFECYCLE_TRANSITIONS, 'lifecycle_state', TERMINATING)
 
 def terminated(conn):
-    _switchState(LIFECYCLE_TRANSITIONS, conn.lifecycle_state, TERMINATED)
-    conn.lifecycle_state = TERMINATED
-    return saveNotify(conn)
+    return _transition(conn, LIFECYCLE_TRANSITIONS, 'lifecycle_state', TERMINATED)
 
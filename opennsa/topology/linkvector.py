@@ -4,12 +4,25 @@ OpenNSA Link vector path finder.
 For each demarcation port in the network, a vector is kept of remote networks
 that can be reached from the link. Somewhat BGP like.
 
+Shortest paths are calculated with a heap based dijkstra for each local
+network. When a single vector changes, only the part of the shortest path
+trees affected by the change is recalculated.
+
+Update subscribers are notified once per change set, with the networks whose
+reachability changed. A change set is either an explicit batch (see
+beginUpdate / commitUpdate), or, if a notify delay is set, all the changes
+made within the delay after the first change.
+
 Author: Henrik Thostrup Jensen <htj@nordu.net>
 
 Copyright: NORDUnet (2011-2015)
 """
 
+import heapq
+import contextlib
+
 from twisted.python import log
+from twisted.internet import reactor
 
 
 
@@ -21,7 +34,7 @@ DEFAULT_MAX_COST = 5
 
 class LinkVector:
 
-    def __init__(self, local_networks=None, blacklist_networks=None, max_cost=DEFAULT_MAX_COST):
+    def __init__(self, local_networks=None, blacklist_networks=None, max_cost=DEFAULT_MAX_COST, notify_delay=None):
 
         # networks hosted by the local nsa, we want these in the vectors (though not used),
         # but don't want to export/use them in reachability
@@ -34,6 +47,10 @@ class LinkVector:
         # augment ports with vectors, and cost, hence it is needed here
         self.vectors = {} # (network, port) -> { network : cost }
 
+        # adjacency indexes for the vectors, used in path calculation
+        self.ports    = {} # network -> { port : { network : cost } }
+        self.incoming = {} # dest_network -> set( (network, port) )
+
         # this is the calculated shortest paths, should be recalculated when vector information changes
         #oself._shortest_paths = {} # network -> (network, port name, cost)
         # calculated shortests path, dijkstra style, but for each network
@@ -43,6 +60,14 @@ class LinkVector:
         # update callback subscribers
         self.subscribers = []
 
+        # change set handling, None delay means notify immediately when a change set is done
+        self.notify_delay = notify_delay
+        self.clock = reactor # this is needed in order to test delayed notifications
+        self._batch_depth = 0
+        self._snapshot = None # { local_network : { network : cost } } before the current change set
+        self._notify_call = None
+
+        # there cannot be any subscribers yet, so no change set for the initial networks
         for local_network in local_networks or []:
             self.addLocalNetwork(local_network)
 
@@ -50,12 +75,66 @@ class LinkVector:
     # -- updates
 
     def callOnUpdate(self, f):
+        # f is called with the set of networks whose reachability changed
         self.subscribers.append(f)
 
 
+    def beginUpdate(self):
+        self._batch_depth += 1
+
+
+    def commitUpdate(self):
+        assert self._batch_depth > 0, 'commitUpdate called without beginUpdate'
+        self._batch_depth -= 1
+        self.updated()
+
+
+    @contextlib.contextmanager
+    def batch(self):
+        self.beginUpdate()
+        try:
+            yield self
+        finally:
+            self.commitUpdate()
+
+
+    def _changing(self):
+        # record reachability before the first change of a change set, only needed if someone is notified
+        if self._snapshot is None and self.subscribers:
+            self._snapshot = { ln : dict(dist) for ln, dist in self.network_dist.items() }
+
+
     def updated(self):
+        if self._snapshot is None or self._batch_depth > 0 or not self.subscribers:
+            return # no changes, change set not done yet, or no one to notify
+
+        if self.notify_delay is None:
+            self._notify()
+        elif self._notify_call is None or not self._notify_call.active():
+            self._notify_call = self.clock.callLater(self.notify_delay, self._notify)
+
+
+    def _notify(self):
+        if self._batch_depth > 0:
+            return # a batch was started while waiting, commitUpdate will notify
+
+        snapshot, self._snapshot = self._snapshot, None
+        self._notify_call = None
+        if snapshot is None:
+            return
+
+        changed_networks = set()
+        for local_network, dist in self.network_dist.items():
+            old_dist = snapshot.get(local_network)
+            if old_dist is None:
+                changed_networks.add(local_network)
+                changed_networks.update(dist)
+            else:
+                changed_networks.update( n for n in set(dist) | set(old_dist) if dist.get(n) != old_dist.get(n) )
+
         for f in self.subscribers:
-            f()
+            f(changed_networks)
+
 
     # -- local networks
 
@@ -66,13 +145,13 @@ class LinkVector:
     def addLocalNetwork(self, network):
         if network in self.local_networks:
             raise ValueError('network {} already exists in local network, refusing to add twice'.format(network))
+        self._changing()
         self.local_networks.append(network)
 
-        self.network_dist[network] = {}
-        self.network_prev[network] = {}
-
-        # recalculate and update
-        self._calculateVectors()
+        # the vectors have not changed, so only the new network needs calculation
+        dist, prev = self._dijkstra(network)
+        self.network_dist[network] = dist
+        self.network_prev[network] = prev
         self.updated()
 
 
@@ -80,6 +159,8 @@ class LinkVector:
 
     def updateVector(self, network, port, vectors):
 
+        old_vectors = dict(self.vectors.get((network, port), {}))
+
         if (network, port) in self.vectors:
             np_vectors = self.vectors[network, port]
             for dest_network, cost in vectors.items():
@@ -90,25 +171,45 @@ class LinkVector:
                     existing_cost = np_vectors[dest_network]
                     if cost != existing_cost:
                         log.msg('Updating vector {}:{} -> {} {} ({})'.format(network, port, dest_network, cost, existing_cost), system=LOG_SYSTEM)
+                        np_vectors[dest_network] = cost
                     else:
                         # skip update as entry is identical, only debug here
                         log.msg('Skiping vector update {}:{} -> {} {} ({})'.format(network, port, dest_network, cost, existing_cost),
                                 debug=True, system=LOG_SYSTEM)
         else:
-            self.vectors[(network,port)] = vectors
+            np_vectors = dict(vectors)
+            self.vectors[(network,port)] = np_vectors
+            self.ports.setdefault(network, {})[port] = np_vectors
             for dest_network, cost in vectors.items():
                 log.msg('Add vector {}:{} -> {} {}'.format(network, port, dest_network, cost), system=LOG_SYSTEM)
 
-        self._calculateVectors()
+        if np_vectors != old_vectors:
+            self._changing()
+            for dest_network in np_vectors:
+                self.incoming.setdefault(dest_network, set()).add( (network, port) )
+            self._repairVectors(network, port, old_vectors, np_vectors)
         self.updated()
 
 
     def deleteVector(self, network, port):
         try:
-            self.vectors.pop((network, port))
-            self._calculateVectors()
+            old_vectors = self.vectors.pop((network, port))
         except KeyError:
             log.msg('Tried to delete non-existing vector for %s' % port, system=LOG_SYSTEM)
+            return
+
+        self._changing()
+        network_ports = self.ports[network]
+        network_ports.pop(port)
+        if not network_ports:
+            self.ports.pop(network)
+        for dest_network in old_vectors:
+            self.incoming[dest_network].discard( (network, port) )
+            if not self.incoming[dest_network]:
+                self.incoming.pop(dest_network)
+
+        self._repairVectors(network, port, old_vectors, {})
+        self.updated()
 
 
     def _calculateVectors(self):
@@ -121,40 +222,72 @@ class LinkVector:
             self.network_prev[local_network] = prev
 
 
-    def _dijkstra(self, source_network):
+    def _repairVectors(self, network, port, old_vectors, new_vectors):
 
-        # build unvisisted set, not sure all of these are needed
-        unvisited_networks = set()
-        unvisited_networks.update(self.local_networks)
-        unvisited_networks.update( [ network for network, port in self.vectors.keys() ] )
-        for vector in self.vectors.values():
-            unvisited_networks.update( vector.keys() )
-        # remove source network?
+        # Repair the shortest paths of each local network after the vector for (network, port) changed
+
+        for local_network in self.local_networks:
 
-        unvisited_networks -= set(self.blacklist_networks)
+            dist = self.network_dist[local_network]
+            prev = self.network_prev[local_network]
+
+            if network != local_network and network not in dist:
+                continue # network is not reachable, so the vector cannot be used from this local network
+
+            # find destinations which where reached through the vector, and has gotten worse
+            invalid = set()
+            worse = [ dn for dn, cost in old_vectors.items() if dn not in new_vectors or new_vectors[dn] > cost ]
+            worse = [ dn for dn in worse if prev.get(dn) == (network, port) ]
+            if worse:
+                children = {}
+                for dn, (prev_network, _) in prev.items():
+                    children.setdefault(prev_network, []).append(dn)
+                stack = worse
+                while stack:
+                    dn = stack.pop()
+                    if dn not in invalid:
+                        invalid.add(dn)
+                        stack.extend( children.get(dn, []) )
+                for dn in invalid:
+                    dist.pop(dn)
+                    prev.pop(dn)
+
+            # reprocess the changed network, and any network with a vector into the invalidated part of the tree
+            boundary = set( [ network ] )
+            for dn in invalid:
+                boundary.update( n for n, p in self.incoming.get(dn, []) if n == local_network or n in dist )
+
+            heap = [ (0, n, None) if n == local_network else (dist[n], n, prev[n]) for n in boundary ]
+            self._propagate(local_network, dist, prev, heap)
+
+
+    def _dijkstra(self, source_network):
 
         dist = {} # { network : cost }
         prev = {} # { network : (source_network, source_port) }
 
-        while unvisited_networks:
+        self._propagate(source_network, dist, prev, [ (0, source_network, None) ])
+        return dist, prev
+
 
-            if not dist:
-                u = source_network
-                u_cost = 0
-            else:
-                # FIXME need to check if empty
-                cost_network = [ (cost, network) for network, cost in dist.items() if network in unvisited_networks ]
-                if not cost_network:
-                    return dist, prev # nothing more can be visited
-                #cn = min( [ (cost, network) for network, cost in dist.items() if network in unvisited_networks ] )
-                #cn = min(cost_network)
-                u_cost, u = min(cost_network)
-
-            for port, vectors in [ (port, vectors) for (network, port), vectors in self.vectors.items() if network == u ]:
+    def _propagate(self, source_network, dist, prev, heap):
+
+        # Dijkstra from the networks in the heap, updating dist and prev in place.
+        # The source network itself is never part of dist and prev.
+
+        blacklist = set(self.blacklist_networks)
+
+        heapq.heapify(heap)
+        while heap:
+            u_cost, u, u_prev = heapq.heappop(heap)
+            if u != source_network and (dist.get(u) != u_cost or prev.get(u) != u_prev):
+                continue # stale entry, network has been reached in a cheaper way
+
+            for port, vectors in self.ports.get(u, {}).items():
                 for dest_network, cost in vectors.items():
                     if dest_network == source_network:
                         continue # skip routes to source
-                    if dest_network in self.blacklist_networks:
+                    if dest_network in blacklist:
                         continue # skip networks in blacklist
                     dest_cost = u_cost + cost
                     if dest_cost > self.max_cost:
@@ -164,12 +297,7 @@ class LinkVector:
                     if prev_dist is None or dest_cost < prev_dist:
                         dist[dest_network] = dest_cost
                         prev[dest_network] = (u, port)
-            if u == source_network and not dist:
-                return dist, prev
-
-            unvisited_networks.remove(u)
-
-        return dist, prev
+                        heapq.heappush(heap, (dest_cost, dest_network, (u, port)) )
 
 
     def path(self, network, source):
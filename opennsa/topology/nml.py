@@ -37,7 +37,7 @@ class Port(object):
 
 
     def canMatchLabel(self, label):
-        return nsa.Label.canMatch(self, label)
+        return nsa.Label.canMatch(self._label, label)
 
 
     def isBidirectional(self):
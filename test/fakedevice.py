@@ -0,0 +1,702 @@
+"""
+Fake network devices for testing and benchmarking the SSH based backends.
+
+A FakeDevice is a Twisted Conch SSH server, which emulates the CLI prompts and
+configuration behaviour of a device family, so the backends can be run without
+hardware. Supported families are JunOS (junosmx, junosex, juniperex,
+junipervpls), Force10, Brocade, and Pica8 OVS.
+
+The device keeps the configuration applied to it (as a list of configuration
+lines), can add latency to commands and commits, and can fail commits, either
+randomly or on request. Like on the real devices, a failed commit is reported
+with an error message, followed by the prompt, and the session stays open.
+The failed changes are discarded.
+"""
+
+import os
+import re
+import random
+
+from zope.interface import implementer
+
+from twisted.python import components, log
+from twisted.internet import reactor, defer, protocol
+from twisted.cred import portal, checkers, credentials, error as crederror
+from twisted.conch import avatar, error as concherror
+from twisted.conch.interfaces import IConchUser, ISession
+from twisted.conch.ssh import factory, keys, session, transport
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+LOG_SYSTEM = 'FakeDevice'
+
+JUNOS   = 'junos'
+FORCE10 = 'force10'
+BROCADE = 'brocade'
+PICA8   = 'pica8'
+
+LINE_SPLIT = re.compile(b'\r\n|\r|\n')
+
+_HOST_KEY = None # generating a key takes a while, so all devices use the same one
+
+
+
+def createKey():
+    return keys.Key( rsa.generate_private_key(public_exponent=65537, key_size=2048) )
+
+
+def hostKey():
+    global _HOST_KEY
+    if _HOST_KEY is None:
+        _HOST_KEY = createKey()
+    return _HOST_KEY
+
+
+def createClientKey(directory):
+    """
+    Create a client key pair in directory, for the backend to log in with.
+    Returns (public key path, private key path).
+    """
+    key = createKey()
+    public_key_path  = os.path.join(directory, 'id_rsa.pub')
+    private_key_path = os.path.join(directory, 'id_rsa')
+    with open(public_key_path, 'wb') as f:
+        f.write( key.public().toString('openssh') )
+    with open(private_key_path, 'wb') as f:
+        f.write( key.toString('openssh') )
+    return public_key_path, private_key_path
+
+
+
+class FakeDevice:
+
+    def __init__(self, flavour, username='opennsa', password=None, enable_password=None, hostname='fakedevice',
+                 latency=0, commit_latency=0, failure_rate=0, seed=None):
+
+        assert flavour in CLI_FLAVOURS, 'Unknown device flavour: %s' % flavour
+
+        self.flavour         = flavour
+        self.username        = username
+        self.password        = password
+        self.enable_password = enable_password
+        self.hostname        = hostname
+        self.latency         = latency          # seconds per command
+        self.commit_latency  = commit_latency   # seconds per commit
+        self.failure_rate    = failure_rate     # probability of a commit failing
+        self.random          = random.Random(seed)
+
+        self.config = [] # configuration lines, in the order they were added
+        self.fail_next = 0
+
+        self.sessions = 0
+        self.commands = 0
+        self.commits  = 0
+        self.failures = 0
+
+        self.port = None
+        self.transports = set()
+        self.stopped_d = None
+
+        self.clock = reactor
+
+
+    @property
+    def fingerprint(self):
+        return hostKey().fingerprint()
+
+
+    def listen(self, port=0, interface='127.0.0.1'):
+        """
+        Start the SSH server. Returns the port number it listens on.
+        """
+        self.port = reactor.listenTCP(port, FakeDeviceSSHFactory(self), interface=interface)
+        return self.port.getHost().port
+
+
+    def stop(self):
+        """
+        Stop the SSH server and close all connections.
+        Returns a deferred, which fires when all connections have been closed.
+        """
+        d = defer.maybeDeferred(self.port.stopListening)
+        if self.transports:
+            self.stopped_d = defer.Deferred()
+            for t in list(self.transports):
+                t.transport.loseConnection()
+            d.addCallback(lambda _ : self.stopped_d)
+        return d
+
+
+    def _connectionMade(self, t):
+        self.transports.add(t)
+
+
+    def _connectionLost(self, t):
+        self.transports.discard(t)
+        if not self.transports and self.stopped_d is not None:
+            d, self.stopped_d = self.stopped_d, None
+            d.callback(None)
+
+
+    def failNext(self, n=1):
+        """
+        Make the next n commits fail.
+        """
+        self.fail_next += n
+
+
+    def shouldFail(self):
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            return True
+        return self.failure_rate > 0 and self.random.random() < self.failure_rate
+
+
+    # configuration state
+
+    def applyChanges(self, changes):
+        """
+        Apply a list of ('set', line) / ('delete', prefix) changes.
+        """
+        self.commits += 1
+        for op, line in changes:
+            if op == 'set':
+                if line not in self.config:
+                    self.config.append(line)
+            else:
+                self.config = [ l for l in self.config if not (l == line or l.startswith(line + ' ')) ]
+
+
+    def stats(self):
+        return { 'sessions': self.sessions, 'commands': self.commands, 'commits': self.commits,
+                 'failures': self.failures, 'config_lines': len(self.config) }
+
+
+
+# -- CLI emulation
+
+
+class DeviceCLI(protocol.Protocol):
+    """
+    Base class for CLI emulation. Input lines are handled one at the time,
+    with the device latency, by handleLine, which returns the output.
+    """
+    greeting_delayed = True # send the greeting after the shell request has been answered
+
+    def __init__(self, device, echo):
+        self.device = device
+        self.echo   = echo
+        self.buffer = b''
+        self.lines  = []
+        self.busy   = False
+        self.closed = False
+        self.delayed_call = None # greeting or line being handled
+        self.changes = [] # uncommitted changes
+
+
+    def connectionMade(self):
+        self.device.sessions += 1
+        if self.greeting_delayed:
+            # the shell request is answered when this returns, the greeting comes after that
+            self.busy = True
+            self.delayed_call = self.device.clock.callLater(0, self.greet)
+        else:
+            self.send( self.greeting() )
+
+
+    def greet(self):
+        self.delayed_call = None
+        self.busy = False
+        self.send( self.greeting() )
+        self.processLines()
+
+
+    def send(self, text):
+        if not self.closed and text:
+            self.transport.write( text.encode() )
+
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.transport.loseConnection()
+
+
+    def dataReceived(self, data):
+        self.buffer += data
+        parts = LINE_SPLIT.split(self.buffer)
+        self.buffer = parts.pop()
+        self.lines += [ p.decode() for p in parts if p.strip() ]
+        self.processLines()
+
+
+    def processLines(self):
+        if self.busy or self.closed or not self.lines:
+            return
+        line = self.lines.pop(0)
+        if self.echo and not self.hideInput():
+            self.send(line + '\r\n')
+        self.busy = True
+        self.device.commands += 1
+        self.delayed_call = self.device.clock.callLater(self.delay(line), self.lineDone, line)
+
+
+    def lineDone(self, line):
+        self.delayed_call = None
+        self.busy = False
+        if self.closed:
+            return
+        try:
+            output = self.handleLine(line.strip())
+        except Exception as e:
+            log.msg('Error handling line %s: %s' % (line, str(e)), system=LOG_SYSTEM)
+            output = 'error: %s\r\n' % str(e)
+        self.send(output)
+        self.processLines()
+
+
+    def delay(self, line):
+        return self.device.latency
+
+
+    def hideInput(self):
+        return False
+
+
+    def commit(self):
+        """
+        Apply the uncommitted changes, unless the commit should fail, in which
+        case they are discarded. Returns True if the changes were applied.
+        """
+        changes, self.changes = self.changes, []
+        if self.device.shouldFail():
+            self.device.failures += 1
+            return False
+        self.device.applyChanges(changes)
+        return True
+
+
+    def connectionLost(self, reason=None):
+        self.closed = True
+        if self.delayed_call is not None and self.delayed_call.active():
+            self.delayed_call.cancel()
+        self.delayed_call = None
+
+
+    def greeting(self):
+        raise NotImplementedError('DeviceCLI.greeting must be overwritten in sub-class')
+
+
+    def handleLine(self, line):
+        raise NotImplementedError('DeviceCLI.handleLine must be overwritten in sub-class')
+
+
+
+class JunosCLI(DeviceCLI):
+
+    CONFIGURE = ('configure', 'configure private', 'configure exclusive', 'edit', 'edit private')
+
+    def __init__(self, device, echo):
+        DeviceCLI.__init__(self, device, echo)
+        self.configuring = False
+
+
+    def prompt(self):
+        return '%s@%s%s ' % (self.device.username, self.device.hostname, '#' if self.configuring else '>')
+
+
+    def greeting(self):
+        return '--- JUNOS 15.1R7.9 built 2018-10-18 00:00:00 UTC\r\n' + self.prompt()
+
+
+    def edit(self, output=''):
+        return output + '\r\n[edit]\r\n' + self.prompt()
+
+
+    def delay(self, line):
+        if line.strip() == 'commit':
+            return self.device.latency + self.device.commit_latency
+        return self.device.latency
+
+
+    def handleLine(self, line):
+        if not self.configuring:
+            if line in self.CONFIGURE:
+                self.configuring = True
+                warning = 'warning: uncommitted changes will be discarded on exit\r\n' if 'private' in line else ''
+                return self.edit(warning + 'Entering configuration mode\r\n')
+            elif line in ('exit', 'quit'):
+                self.close()
+                return ''
+            else:
+                return 'unknown command.\r\n' + self.prompt()
+
+        if line.startswith('set '):
+            self.changes.append( ('set', line[4:]) )
+            return self.edit()
+        elif line.startswith('delete '):
+            self.changes.append( ('delete', line[7:]) )
+            return self.edit()
+        elif line == 'commit':
+            if self.commit():
+                return 'commit complete\r\n' + self.edit()
+            return self.edit('error: configuration check-out failed\r\n')
+        elif line in ('exit', 'quit'):
+            self.configuring = False
+            self.changes = []
+            return 'Exiting configuration mode\r\n\r\n' + self.prompt()
+        else:
+            return self.edit('syntax error.\r\n')
+
+
+
+class ContextCLI(DeviceCLI):
+    """
+    Base for the industry standard (IOS like) CLIs, where configuration is
+    done in contexts, and changes are applied when leaving configuration mode.
+    """
+    commit_error = None # error message for a failed commit, set in sub-classes
+
+    def __init__(self, device, echo):
+        DeviceCLI.__init__(self, device, echo)
+        self.mode = 'user'      # user -> enable -> configure
+        self.context = None     # e.g., 'interface vlan 1780'
+
+
+    def configurationLine(self, line):
+        # returns the context this line starts, or None
+        raise NotImplementedError('ContextCLI.configurationLine must be overwritten in sub-class')
+
+
+    def configure(self, line):
+        if line.startswith('no ') and self.context is None:
+            self.changes.append( ('delete', line[3:]) )
+            return
+        context = self.configurationLine(line)
+        if context is not None:
+            self.context = context
+            self.changes.append( ('set', context) )
+        elif self.context is not None:
+            self.changes.append( ('set', self.context + ' ' + line) )
+        else:
+            self.changes.append( ('set', line) )
+
+
+    def end(self, prompt):
+        self.mode = 'enable'
+        self.context = None
+        if self.commit():
+            return prompt
+        return self.commit_error + prompt
+
+
+
+class Force10CLI(ContextCLI):
+
+    commit_error = '% Error: configuration failed\r\n'
+
+    def __init__(self, device, echo):
+        ContextCLI.__init__(self, device, echo)
+        self.password_prompt = False
+
+
+    def prompt(self):
+        if self.mode == 'user':
+            return '\r\n%s>' % self.device.hostname
+        elif self.mode == 'enable':
+            return '\r\n%s#' % self.device.hostname
+        elif self.context is not None:
+            return '\r\n%s(conf-if-vl-%s)#' % (self.device.hostname, self.context.split()[-1])
+        else:
+            return '\r\n%s(conf)#' % self.device.hostname
+
+
+    def greeting(self):
+        return 'Dell Force10 Networks\r\n' + self.prompt()
+
+
+    def hideInput(self):
+        return self.password_prompt
+
+
+    def configurationLine(self, line):
+        if line.startswith('interface vlan '):
+            return line
+        return None
+
+
+    def handleLine(self, line):
+        if self.password_prompt:
+            self.password_prompt = False
+            if self.device.enable_password is None or line == self.device.enable_password:
+                self.mode = 'enable'
+            else:
+                return '% Error: Bad passwords' + self.prompt()
+            return self.prompt()
+
+        if self.mode == 'user':
+            if line == 'enable':
+                self.password_prompt = True
+                return 'Password: '
+            elif line == 'exit':
+                self.close()
+                return ''
+        elif self.mode == 'enable':
+            if line == 'configure':
+                self.mode = 'configure'
+                return self.prompt()
+            elif line.startswith('write'):
+                return 'Copy completed successfully.' + self.prompt()
+            elif line == 'exit':
+                self.close()
+                return ''
+        else:
+            if line == 'end':
+                return self.end(self.prompt())
+            elif line == 'exit':
+                if self.context is not None:
+                    self.context = None
+                    return self.prompt()
+                return self.end(self.prompt())
+            self.configure(line)
+            return self.prompt()
+
+        return '% Error: Invalid input at "^" marker.' + self.prompt()
+
+
+
+class BrocadeCLI(ContextCLI):
+
+    # the brocade backend sends enable before waiting for the prompt, so it must have arrived with the shell
+    greeting_delayed = False
+
+    commit_error = 'Error - configuration failed\r\n'
+
+    def prompt(self):
+        if self.mode == 'user':
+            return '\r\nSSH@%s>' % self.device.hostname
+        elif self.mode == 'enable':
+            return '\r\nSSH@%s#' % self.device.hostname
+        elif self.context is not None:
+            return '\r\nSSH@%s(config-vlan-%s)#' % (self.device.hostname, self.context.split()[1])
+        else:
+            return '\r\nSSH@%s(config)#' % self.device.hostname
+
+
+    def greeting(self):
+        return self.prompt()
+
+
+    def configurationLine(self, line):
+        if line.startswith('vlan '):
+            return ' '.join(line.split()[:2]) # vlan <id> name <name>, the name is an attribute
+        return None
+
+
+    def configure(self, line):
+        ContextCLI.configure(self, line)
+        if line.startswith('vlan ') and ' name ' in line:
+            self.changes.append( ('set', self.context + ' name ' + line.split(' name ', 1)[1]) )
+
+
+    def handleLine(self, line):
+        if self.mode == 'user':
+            if line.startswith('enable'):
+                password = line[len('enable'):].strip()
+                if self.device.enable_password is None or password == self.device.enable_password:
+                    self.mode = 'enable'
+                    return self.prompt()
+                return 'Error - Incorrect username or password.' + self.prompt()
+            elif line == 'exit':
+                self.close()
+                return ''
+        elif self.mode == 'enable':
+            if line == 'configure terminal':
+                self.mode = 'configure'
+                return self.prompt()
+            elif line == 'exit':
+                self.close()
+                return ''
+        else:
+            if line == 'end':
+                return self.end(self.prompt())
+            self.configure(line)
+            return self.prompt()
+
+        return 'Invalid input -> %s' % line + self.prompt()
+
+
+
+class Pica8CLI(DeviceCLI):
+    """
+    Pica8 is configured with shell commands (ovs-vsctl / ovs-ofctl), which
+    print nothing on success. Each command is its own commit.
+    """
+    VSCTL = re.compile(r'.*ovs-vsctl \S+ (add|remove) port (\S+) trunk (\d+)$')
+    OFCTL = re.compile(r'.*ovs-ofctl (add-flow|del-flows) (\S+) (in_port=[^,]+,dl_vlan=\d+)(,\S*)?$')
+
+    def greeting(self):
+        return ''
+
+
+    def delay(self, line):
+        if 'ovs-' in line:
+            return self.device.latency + self.device.commit_latency
+        return self.device.latency
+
+
+    def handleLine(self, line):
+        if line == 'echo':
+            return '\n'
+        elif line == 'exit':
+            self.close()
+            return ''
+
+        m = self.VSCTL.match(line)
+        if m:
+            op, port, vlan = m.groups()
+            self.changes.append( ('set' if op == 'add' else 'delete', 'port %s trunk %s' % (port, vlan)) )
+            if self.commit():
+                return ''
+            return 'ovs-vsctl: transaction error\n'
+
+        m = self.OFCTL.match(line)
+        if m:
+            op, bridge, match, actions = m.groups()
+            if op == 'add-flow':
+                self.changes.append( ('set', 'flow %s %s' % (bridge, match)) )
+            else:
+                self.changes.append( ('delete', 'flow %s %s' % (bridge, match)) )
+            if self.commit():
+                return ''
+            return 'ovs-ofctl: %s: failed\n' % bridge
+
+        return 'sh: %s: not found\n' % line.split()[0]
+
+
+
+CLI_FLAVOURS = {
+    JUNOS   : JunosCLI,
+    FORCE10 : Force10CLI,
+    BROCADE : BrocadeCLI,
+    PICA8   : Pica8CLI
+}
+
+
+
+# -- SSH server
+
+
+@implementer(ISession)
+class FakeDeviceSession:
+
+    def __init__(self, avatar):
+        self.device = avatar.device
+        self.pty = False
+        self.cli = None
+
+
+    def getPty(self, term, windowSize, modes):
+        self.pty = True
+
+
+    def openShell(self, proto):
+        self.cli = CLI_FLAVOURS[self.device.flavour](self.device, self.pty)
+        self.cli.makeConnection(proto)
+        proto.makeConnection( session.wrapProtocol(self.cli) )
+
+
+    def execCommand(self, proto, command):
+        raise concherror.ConchError('Command execution not supported')
+
+
+    def windowChanged(self, newWindowSize):
+        pass
+
+
+    def eofReceived(self):
+        if self.cli is not None:
+            self.cli.close()
+
+
+    def closed(self):
+        if self.cli is not None:
+            self.cli.connectionLost()
+
+
+
+class FakeDeviceAvatar(avatar.ConchUser):
+
+    def __init__(self, device):
+        avatar.ConchUser.__init__(self)
+        self.device = device
+        self.channelLookup[b'session'] = session.SSHSession
+
+
+components.registerAdapter(FakeDeviceSession, FakeDeviceAvatar, ISession)
+
+
+
+@implementer(portal.IRealm)
+class FakeDeviceRealm:
+
+    def __init__(self, device):
+        self.device = device
+
+    def requestAvatar(self, avatar_id, mind, *interfaces):
+        return IConchUser, FakeDeviceAvatar(self.device), lambda : None
+
+
+
+@implementer(checkers.ICredentialsChecker)
+class AnyKeyChecker:
+    """
+    Accepts any public key for the device user, the device is not about security.
+    """
+    credentialInterfaces = (credentials.ISSHPrivateKey,)
+
+    def __init__(self, username):
+        self.username = username
+
+    def requestAvatarId(self, creds):
+        if creds.username != self.username:
+            return defer.fail(crederror.UnauthorizedLogin('Unknown user'))
+        if creds.signature is None:
+            return defer.fail(concherror.ValidPublicKey())
+        if keys.Key.fromString(creds.blob).verify(creds.signature, creds.sigData):
+            return defer.succeed(creds.username)
+        return defer.fail(crederror.UnauthorizedLogin('Invalid signature'))
+
+
+
+class FakeDeviceServerTransport(transport.SSHServerTransport):
+
+    def connectionMade(self):
+        transport.SSHServerTransport.connectionMade(self)
+        self.factory.device._connectionMade(self)
+
+    def connectionLost(self, reason):
+        transport.SSHServerTransport.connectionLost(self, reason)
+        self.factory.device._connectionLost(self)
+
+
+
+class FakeDeviceSSHFactory(factory.SSHFactory):
+
+    protocol = FakeDeviceServerTransport
+    noisy = False
+
+    def __init__(self, device):
+        self.device = device
+        key = hostKey()
+        self.publicKeys  = { b'ssh-rsa': key.public() }
+        self.privateKeys = { b'ssh-rsa': key }
+
+        username = device.username.encode()
+        checker_list = [ AnyKeyChecker(username) ]
+        if device.password is not None:
+            password_checker = checkers.InMemoryUsernamePasswordDatabaseDontUse()
+            password_checker.addUser(username, device.password.encode())
+            checker_list.append(password_checker)
+        self.portal = portal.Portal(FakeDeviceRealm(device), checker_list)
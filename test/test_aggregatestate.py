@@ -0,0 +1,138 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa import state, aggregatestate
+
+
+class FakeSubConnection:
+
+    def __init__(self, service_connection_id, connection_id, provider_nsa='urn:ogf:network:example.net:nsa'):
+        self.service_connection_id  = service_connection_id
+        self.connection_id          = connection_id
+        self.provider_nsa           = provider_nsa
+        self.reservation_state      = state.RESERVE_HELD
+        self.provision_state        = state.RELEASED
+        self.lifecycle_state        = state.CREATED
+        self.data_plane_active      = False
+        self.data_plane_version     = None
+        self.data_plane_consistent  = False
+
+
+
+class AggregateStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sub_conns = [ FakeSubConnection(1, 'sc-%i' % i) for i in range(3) ]
+        self.aggr = aggregatestate.AggregateState()
+        for sc in self.sub_conns:
+            self.aggr.update(sc)
+
+
+    def testStates(self):
+
+        self.assertEquals(self.aggr.total, 3)
+        self.failUnless(self.aggr.all('reservation_state', state.RESERVE_HELD))
+
+        for sc in self.sub_conns[:2]:
+            sc.provision_state = state.PROVISIONED
+            self.aggr.update(sc)
+            self.aggr.update(sc) # no change, nothing counted
+
+        self.assertEquals(self.aggr.count('provision_state', state.PROVISIONED), 2)
+        self.failIf(self.aggr.all('provision_state', state.PROVISIONED))
+
+        self.sub_conns[2].provision_state = state.PROVISIONED
+        self.aggr.update(self.sub_conns[2])
+        self.failUnless(self.aggr.all('provision_state', state.PROVISIONED))
+        self.assertEquals(self.aggr.count('provision_state', state.RELEASED), 0)
+
+
+    def testDataPlaneStatus(self):
+
+        self.assertEquals(self.aggr.dataPlaneStatus(), (False, 0, False) )
+
+        for sc in self.sub_conns:
+            sc.data_plane_active, sc.data_plane_version, sc.data_plane_consistent = True, 1, True
+            self.aggr.update(sc)
+            if sc is not self.sub_conns[-1]:
+                self.assertEquals(self.aggr.dataPlaneStatus(), (False, 1, False) ) # partially active is not consistent
+
+        self.assertEquals(self.aggr.dataPlaneStatus(), (True, 1, True) )
+
+        self.sub_conns[0].data_plane_active, self.sub_conns[0].data_plane_version = False, 2
+        self.aggr.update(self.sub_conns[0])
+        self.assertEquals(self.aggr.dataPlaneStatus(), (False, 2, False) )
+
+
+
+class AggregateStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sub_conns = { 1: [ FakeSubConnection(1, 'sc-1'), FakeSubConnection(1, 'sc-2') ] }
+        self.loads = []
+        self.states = aggregatestate.AggregateStates(self.loadSubConnections, 10)
+
+
+    def loadSubConnections(self, service_connection_key):
+        d = defer.Deferred()
+        self.loads.append( (service_connection_key, d) )
+        return d
+
+
+    def testLazyLoad(self):
+
+        sc = self.sub_conns[1][0]
+        sc.provision_state = state.PROVISIONED
+        self.states.update(sc) # not loaded, nothing to update
+
+        d1 = self.states.get(1)
+        d2 = self.states.get(1)
+        self.assertEquals(len(self.loads), 1) # loaded once
+        self.loads[0][1].callback(self.sub_conns[1])
+
+        aggr = self.successResultOf(d1)
+        self.assertIdentical(self.successResultOf(d2), aggr)
+        self.assertEquals(aggr.count('provision_state', state.PROVISIONED), 1)
+
+        # updated in place once loaded
+        sc = self.sub_conns[1][1]
+        sc.provision_state = state.PROVISIONED
+        self.states.update(sc)
+        aggr = self.successResultOf(self.states.get(1))
+        self.failUnless(aggr.all('provision_state', state.PROVISIONED))
+        self.assertEquals(len(self.loads), 1)
+
+        # new sub connection
+        self.states.update(FakeSubConnection(1, 'sc-3'))
+        self.assertEquals(aggr.total, 3)
+
+        self.states.evict(1)
+        self.states.get(1)
+        self.assertEquals(len(self.loads), 2)
+
+
+    def testLoadFailure(self):
+
+        d = self.states.get(1)
+        self.loads[0][1].errback(ValueError('database gone'))
+        self.failureResultOf(d, ValueError)
+
+        self.states.get(1)
+        self.assertEquals(len(self.loads), 2)
+
+
+    def testUpdateWhileLoading(self):
+
+        d = self.states.get(1)
+
+        # the sub connection changes after the load has read it, but before it has finished
+        sc = FakeSubConnection(1, 'sc-1')
+        sc.provision_state = state.PROVISIONED
+        self.states.update(sc)
+        self.states.update(FakeSubConnection(1, 'sc-3'))
+
+        self.loads[0][1].callback(self.sub_conns[1])
+        aggr = self.successResultOf(d)
+        self.assertEquals(aggr.total, 3)
+        self.assertEquals(aggr.count('provision_state', state.PROVISIONED), 1)
+        self.assertEquals(self.states.updated, {})
@@ -0,0 +1,183 @@
+"""
+Aggregator queryRecursive fan-out, with the database lookups replaced by fakes.
+"""
+
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import nsa, provreg, aggregator, error, state, constants as cnt
+
+
+NSA_URN     = 'urn:ogf:network:aggr.example.net:nsa'
+PROVIDER_A  = 'urn:ogf:network:a.example.net:nsa'
+PROVIDER_B  = 'urn:ogf:network:b.example.net:nsa'
+
+
+
+class FakeConnection:
+
+    def __init__(self, key, connection_id, network='aggr.example.net:topology', provider_nsa=None):
+        self.id = key
+        self.connection_id = connection_id
+        self.global_reservation_id = None
+        self.description = None
+        self.requester_nsa = 'urn:ogf:network:requester.example.net:nsa'
+        self.provider_nsa = provider_nsa
+        self.source_network = network
+        self.source_port = 'p1'
+        self.source_label = None
+        self.dest_network = network
+        self.dest_port = 'p2'
+        self.dest_label = None
+        self.start_time = None
+        self.end_time = datetime.datetime(2030, 1, 1)
+        self.bandwidth = 100
+        self.revision = 0
+        self.reservation_state = state.RESERVE_START
+        self.provision_state = state.PROVISIONED
+        self.lifecycle_state = state.CREATED
+        self.data_plane_active = True
+        self.data_plane_version = 0
+        self.data_plane_consistent = True
+
+
+
+def connectionInfo(conn):
+    source_stp = nsa.STP(conn.source_network, conn.source_port)
+    dest_stp   = nsa.STP(conn.dest_network, conn.dest_port)
+    sd = nsa.Point2PointService(source_stp, dest_stp, conn.bandwidth)
+    criteria = nsa.QueryCriteria(conn.revision, nsa.Schedule(conn.start_time, conn.end_time), sd)
+    states = (conn.reservation_state, conn.provision_state, conn.lifecycle_state, (True, 0, True))
+    return nsa.ConnectionInfo(conn.connection_id, None, None, cnt.EVTS_AGOLE, [ criteria ], conn.provider_nsa, NSA_URN, states, 0, 0)
+
+
+
+class FakeProvider:
+
+    def __init__(self):
+        self.queries = [] # (header, connection_ids)
+
+    def queryRecursive(self, header, connection_ids, global_reservation_ids, request_info=None):
+        self.queries.append( (header, connection_ids) )
+        return defer.succeed(None)
+
+
+
+class FakeRequester:
+
+    def __init__(self):
+        self.results = []
+
+    def queryRecursiveConfirmed(self, header, reservations):
+        self.results.append( (header, reservations) )
+
+
+
+class QueryRecursiveTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.provider_a = FakeProvider()
+        self.provider_b = FakeProvider()
+        pr = provreg.ProviderRegistry({})
+        pr.addProvider(PROVIDER_A, 'a.example.net:topology', self.provider_a)
+        pr.addProvider(PROVIDER_B, 'b.example.net:topology', self.provider_b)
+
+        # two connections, going through both providers
+        self.conns = {}
+        self.sub_conns = {}
+        for key in (1, 2):
+            self.conns['conn-%i' % key] = FakeConnection(key, 'conn-%i' % key)
+            self.sub_conns[key] = [ FakeConnection(None, 'a-%i' % key, 'a.example.net:topology', PROVIDER_A),
+                                    FakeConnection(None, 'b-%i' % key, 'b.example.net:topology', PROVIDER_B) ]
+
+        self.requester = FakeRequester()
+        self.clock = task.Clock()
+        self.aggregator = aggregator.Aggregator(nsa.NetworkServiceAgent('aggr.example.net', 'http://aggr.example.net/nsi'),
+                                                None, None, self.requester, pr, [], None)
+        self.aggregator.clock = self.clock
+        self.aggregator.getConnection = lambda cid : defer.succeed(self.conns[cid]) if cid in self.conns else \
+                                                     defer.fail(error.ConnectionNonExistentError('No connection with id %s' % cid))
+        self.sub_conn_loads = []
+        def getSubConnectionsByConnectionKeys(keys):
+            self.sub_conn_loads.append(keys)
+            return defer.succeed( { key : self.sub_conns[key] for key in keys } )
+        self.aggregator.getSubConnectionsByConnectionKeys = getSubConnectionsByConnectionKeys
+
+        self.header = nsa.NSIHeader('urn:ogf:network:requester.example.net:nsa', NSA_URN)
+
+
+    def reply(self, provider, connection_ids):
+        header, _ = provider.queries[0]
+        self.aggregator.queryRecursiveConfirmed(header, [ connectionInfo(sc) for sub_conns in self.sub_conns.values() for sc in sub_conns if sc.connection_id in connection_ids ] )
+
+
+    def children(self, reservation):
+        return [ child.connection_id for child in reservation.criterias[0].children ]
+
+
+    @defer.inlineCallbacks
+    def testMultipleConnections(self):
+
+        yield self.aggregator.queryRecursive(self.header, [ 'conn-1', 'conn-2' ], None)
+        self.assertEquals(self.sub_conn_loads, [ [ 1, 2 ] ]) # sub connections loaded together
+
+        # one query per provider
+        self.assertEquals( [ cids for _, cids in self.provider_a.queries ], [ [ 'a-1', 'a-2' ] ] )
+        self.assertEquals( [ cids for _, cids in self.provider_b.queries ], [ [ 'b-1', 'b-2' ] ] )
+
+        self.reply(self.provider_b, [ 'b-1', 'b-2' ])
+        self.assertEquals(self.requester.results, [])
+        self.reply(self.provider_a, [ 'a-1', 'a-2' ])
+
+        self.assertEquals(len(self.requester.results), 1)
+        header, reservations = self.requester.results[0]
+        self.assertEquals(header.correlation_id, self.header.correlation_id)
+        self.assertEquals( [ r.connection_id for r in reservations ], [ 'conn-1', 'conn-2' ] )
+        self.assertEquals(self.children(reservations[0]), [ 'a-1', 'b-1' ] )
+        self.assertEquals(self.children(reservations[1]), [ 'a-2', 'b-2' ] )
+
+        self.assertEquals(len(self.aggregator.query_requests), 0)
+        self.assertEquals(len(self.aggregator.query_calls), 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def testPartialResult(self):
+
+        yield self.aggregator.queryRecursive(self.header, [ 'conn-1', 'conn-2' ], None)
+        self.reply(self.provider_a, [ 'a-1', 'a-2' ])
+
+        self.clock.advance(aggregator.QUERY_RECURSIVE_TIMEOUT)
+
+        self.assertEquals(len(self.requester.results), 1)
+        _, reservations = self.requester.results[0]
+        self.assertEquals(self.children(reservations[0]), [ 'a-1' ] )
+        self.assertEquals(self.children(reservations[1]), [ 'a-2' ] )
+
+        # late reply is ignored
+        self.reply(self.provider_b, [ 'b-1', 'b-2' ])
+        self.assertEquals(len(self.requester.results), 1)
+        self.assertEquals(len(self.aggregator.query_calls), 0)
+
+
+    @defer.inlineCallbacks
+    def testChildNotAcking(self):
+
+        self.provider_b.queryRecursive = lambda *args : defer.fail(error.DownstreamNSAError('not reachable'))
+
+        yield self.aggregator.queryRecursive(self.header, [ 'conn-1' ], None)
+        self.reply(self.provider_a, [ 'a-1' ])
+
+        # no need to wait for the one which did not ack
+        self.assertEquals(len(self.requester.results), 1)
+        self.assertEquals(self.children(self.requester.results[0][1][0]), [ 'a-1' ] )
+
+
+    @defer.inlineCallbacks
+    def testUnknownConnection(self):
+
+        yield self.failUnlessFailure(self.aggregator.queryRecursive(self.header, [ 'conn-1', 'conn-3' ], None), error.ConnectionNonExistentError)
+        self.assertEquals(self.provider_a.queries, [])
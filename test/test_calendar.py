@@ -1,8 +1,9 @@
+import random
 import datetime
 
 from twisted.trial import unittest
 
-from opennsa import error
+from opennsa import error, nsa, constants as cnt
 from opennsa.backends.common import calendar
 
 
@@ -87,3 +88,116 @@ class CalendarTest(unittest.TestCase):
         self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', ds2, de2)
 
 
+
+    def testRemove(self):
+
+        de1 = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        de2 = datetime.datetime.utcnow() + datetime.timedelta(seconds=7)
+
+        self.c.addReservation('r1', None, de1)
+        self.c.addReservation('r2', None, de2)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r1', None, de2)
+
+        self.c.removeReservation('r1', None, de1)
+        self.c.checkReservation('r1', None, de2)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.checkReservation, 'r2', None, de1)
+
+        self.failUnlessRaises(ValueError, self.c.removeReservation, 'r1', None, de1)
+        self.failUnlessEqual(self.c.reservations, [ ('r2', None, de2) ] )
+
+
+    def testIntervalIndex(self):
+
+        t = lambda h : datetime.datetime(2030, 1, 1) + datetime.timedelta(hours=h)
+
+        ii = calendar.IntervalIndex()
+        ii.add(t(10), t(20))
+        ii.add(t(0),  t(30)) # long interval, spanning the first one
+        ii.add(t(40), t(50))
+
+        self.failUnless( ii.overlaps(t(25), t(26)) ) # only covered by the long interval
+        self.failUnless( ii.overlaps(t(30), t(35)) ) # touching counts as overlap
+        self.failIf(     ii.overlaps(t(31), t(39)) )
+        self.failUnless( ii.overlaps(t(45), t(60)) )
+
+        ii.remove(t(0), t(30))
+        self.failIf(     ii.overlaps(t(25), t(26)) )
+        self.failUnless( ii.overlaps(t(15), t(16)) )
+        self.failUnlessRaises(KeyError, ii.remove, t(0), t(30))
+
+
+    def testIntervalIndexBlocks(self):
+
+        # small blocks, so intervals are spread over many blocks, which are split and removed
+        self.patch(calendar.IntervalIndex, 'BLOCK_SIZE', 2)
+
+        t = lambda h : datetime.datetime(2030, 1, 1) + datetime.timedelta(hours=h)
+        rng = random.Random(42)
+        intervals = []
+
+        ii = calendar.IntervalIndex()
+        for i in range(60):
+            st = rng.randint(0, 100)
+            interval = (t(st), t(st + rng.randint(0, 10)))
+            ii.add(*interval)
+            intervals.append(interval)
+            if i % 3 == 0:
+                ii.remove(*intervals.pop(rng.randrange(len(intervals))))
+
+        self.failUnlessEqual(len(ii), len(intervals))
+        self.failUnlessEqual(list(ii.intervals()), sorted(intervals))
+        for h in range(0, 115, 3):
+            expected = any( st <= t(h+2) and et >= t(h) for st, et in intervals )
+            self.failUnlessEqual(ii.overlaps(t(h), t(h+2)), expected)
+
+        for st, et in list(intervals):
+            ii.remove(st, et)
+        self.failUnlessEqual(len(ii), 0)
+        self.failIf( ii.overlaps(t(0), t(200)) )
+        self.failUnlessRaises(KeyError, ii.remove, t(0), t(30))
+
+
+    def testAddReservations(self):
+
+        t = lambda h : datetime.datetime(2030, 1, 1) + datetime.timedelta(hours=h)
+
+        self.c.addReservation('r1', t(40), t(50))
+        self.c.addReservations( [ ('r1', t(0), t(30), None, None), ('r1', t(10), t(20), None, None), ('r2', None, t(5), None, None) ] )
+
+        self.failUnlessEqual(sorted(self.c.reservations), [ ('r1', t(0), t(30)), ('r1', t(10), t(20)), ('r1', t(40), t(50)), ('r2', None, t(5)) ] )
+        self.failUnless( self.c.index['r1'].overlaps(t(25), t(26)) )
+        self.failIf(     self.c.index['r1'].overlaps(t(31), t(39)) )
+
+        self.c.removeReservation('r1', t(0), t(30))
+        self.failIf(     self.c.index['r1'].overlaps(t(25), t(26)) )
+
+
+    def testFindFreeLabel(self):
+
+        get_resource = lambda port, label : port + ':' + ('' if label is None else label.labelValue())
+        de = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+
+        for vlan in range(1, 100):
+            self.c.addReservation('p1:%i' % vlan, None, de, 'p1', nsa.Label(cnt.ETHERNET_VLAN, vlan))
+        self.c.addReservation('p2:100', None, de, 'p2', nsa.Label(cnt.ETHERNET_VLAN, 100))
+
+        label = nsa.Label(cnt.ETHERNET_VLAN, '1-101')
+
+        self.failUnlessEqual(self.c.findFreeLabel(get_resource, ['p1'], label, None, de), nsa.Label(cnt.ETHERNET_VLAN, 100) )
+        self.failUnlessEqual(self.c.findFreeLabel(get_resource, ['p1', 'p2'], label, None, de), nsa.Label(cnt.ETHERNET_VLAN, 101) )
+        self.failUnlessEqual(list(self.c.freeLabels(get_resource, ['p1'], label, None, de)), [ nsa.Label(cnt.ETHERNET_VLAN, 100), nsa.Label(cnt.ETHERNET_VLAN, 101) ] )
+
+        self.failUnlessRaises(error.STPUnavailableError, self.c.findFreeLabel, get_resource, ['p1'], nsa.Label(cnt.ETHERNET_VLAN, '1-99'), None, de)
+
+        self.failUnlessEqual(self.c.findFreeLabel(get_resource, ['p3'], None, None, de), None)
+        self.c.addReservation('p3:', None, de)
+        self.failUnlessRaises(error.STPUnavailableError, self.c.findFreeLabel, get_resource, ['p3'], None, None, de)
+
+
+        # vlans as a global resource, reserved on another port
+        global_resource = lambda port, label : label.labelValue()
+        self.c.addReservation('5', None, de, 'p5', nsa.Label(cnt.ETHERNET_VLAN, 5))
+        self.failUnlessEqual(self.c.findFreeLabel(global_resource, ['p4'], nsa.Label(cnt.ETHERNET_VLAN, '5-6'), None, de), nsa.Label(cnt.ETHERNET_VLAN, 6) )
+        self.c.removeReservation('5', None, de)
+        self.failIf('p5' in self.c.port_values)
+        self.failUnlessEqual(self.c.findFreeLabel(global_resource, ['p4'], nsa.Label(cnt.ETHERNET_VLAN, '5-6'), None, de), nsa.Label(cnt.ETHERNET_VLAN, 5) )
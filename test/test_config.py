@@ -3,9 +3,13 @@ from twisted.trial import unittest
 import json
 import tempfile
 import configparser
+from io import StringIO
 
 from opennsa import config, setup
-from . import db
+from opennsa.topology import nrm
+from opennsa.backends import dud
+from opennsa.backends.common import genericbackend
+from . import db, topology
 
 
 
@@ -211,3 +215,14 @@ class ConfigTest(unittest.TestCase):
         nsa_service = setup.OpenNSAService(verified_config)
         factory, _ = nsa_service.setupServiceFactory()
 
+
+
+    def testRestoreConcurrency(self):
+
+        nrm_ports = nrm.parsePortSpec(StringIO(topology.ARUBA_TOPOLOGY))
+
+        backend = dud.DUDNSIBackend('aruba.net:topology', nrm_ports, None, {})
+        self.assertEquals(backend.restore_concurrency, genericbackend.RESTORE_CONCURRENCY)
+
+        backend = dud.DUDNSIBackend('aruba.net:topology', nrm_ports, None, { config.RESTORE_CONCURRENCY: '2' })
+        self.assertEquals(backend.restore_concurrency, 2)
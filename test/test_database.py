@@ -4,7 +4,7 @@ import psycopg2
 from twisted.internet import defer
 from twisted.trial import unittest
 
-from opennsa import state
+from opennsa import state, database
 from opennsa.backends.common import genericbackend
 
 from . import db
@@ -48,3 +48,82 @@ class DatabaseTest(unittest.TestCase):
         except psycopg2.IntegrityError as e:
             pass # intended
 
+
+
+    @defer.inlineCallbacks
+    def testConnectionSummaries(self):
+
+        now = datetime.datetime.utcnow()
+
+        def createServiceConnection(connection_id):
+            return database.ServiceConnection(
+                connection_id=connection_id, revision=0, global_reservation_id=None, description='test',
+                requester_nsa='req-nsa', requester_url=None, reserve_time=now,
+                reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED,
+                source_network='src-net', source_port='src-port', source_label=None,
+                dest_network='dst-net', dest_port='dst-port', dest_label=None,
+                start_time=None, end_time=None, symmetrical=False, directionality='Bidirectional', bandwidth=200).save()
+
+        def createSubConnection(service_connection_id, connection_id, order_id, active, version, consistent):
+            return database.SubConnection(
+                service_connection_id=service_connection_id, connection_id=connection_id, provider_nsa='prov-nsa',
+                revision=0, order_id=order_id,
+                reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED,
+                data_plane_active=active, data_plane_version=version, data_plane_consistent=consistent,
+                source_network='src-net', source_port='src-port', source_label=None,
+                dest_network='dst-net', dest_port='dst-port', dest_label=None).save()
+
+        try:
+            c1 = yield createServiceConnection('summary-1')
+            c2 = yield createServiceConnection('summary-2')
+            c3 = yield createServiceConnection('summary-3')
+
+            yield createSubConnection(c1.id, 'summary-sub-1', 0, True,  1, True)
+            yield createSubConnection(c1.id, 'summary-sub-2', 1, True,  3, True)
+            yield createSubConnection(c2.id, 'summary-sub-3', 0, True,  None, None)
+            yield createSubConnection(c2.id, 'summary-sub-4', 1, False, 2, True)
+
+            where = ['connection_id LIKE ?', 'summary-%']
+            page = yield database.findConnectionSummaries(where, page_size=2)
+            self.assertEquals( [ (c.connection_id, dps) for c, dps in page ], [ ('summary-1', (True, 3, True)), ('summary-2', (False, 2, False)) ] )
+
+            page = yield database.findConnectionSummaries(where, after_id=page[-1][0].id, page_size=2)
+            self.assertEquals( [ (c.connection_id, dps) for c, dps in page ], [ ('summary-3', database.NO_DATA_PLANE_STATUS) ] )
+
+        finally:
+            dbconfig = database.Registry.getConfig()
+            yield dbconfig.delete('sub_connections', where=['connection_id LIKE ?', 'summary-sub-%'])
+            yield dbconfig.delete('service_connections', where=['connection_id LIKE ?', 'summary-%'])
+
+
+    @defer.inlineCallbacks
+    def testChangedColumnsSave(self):
+
+        now = datetime.datetime.utcnow()
+
+        conn = database.ServiceConnection(
+            connection_id='tracked-1', revision=0, global_reservation_id=None, description='test',
+            requester_nsa='req-nsa', requester_url=None, reserve_time=now,
+            reservation_state=state.RESERVE_START, provision_state=state.RELEASED, lifecycle_state=state.CREATED,
+            source_network='src-net', source_port='src-port', source_label=None,
+            dest_network='dst-net', dest_port='dst-port', dest_label=None,
+            start_time=None, end_time=None, symmetrical=False, directionality='Bidirectional', bandwidth=200)
+
+        try:
+            yield conn.save()
+            self.assertEquals(conn.changedColumns(), {})
+
+            state.coalesce(conn)
+            yield state.provisioning(conn)
+            yield state.provisioned(conn)
+            self.assertEquals(conn.changedColumns(), { 'provision_state': state.PROVISIONED } )
+            yield state.commit(conn)
+            self.assertEquals(conn.changedColumns(), {})
+
+            conns = yield database.ServiceConnection.findBy(connection_id='tracked-1')
+            self.assertEquals(conns[0].provision_state, state.PROVISIONED)
+            self.assertEquals(conns[0].changedColumns(), {})
+
+        finally:
+            dbconfig = database.Registry.getConfig()
+            yield dbconfig.delete('service_connections', where=['connection_id = ?', 'tracked-1'])
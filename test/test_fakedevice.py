@@ -0,0 +1,151 @@
+"""
+Runs the SSH backend command senders against the fake devices.
+"""
+
+import tempfile
+import shutil
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa import error
+from opennsa.backends.common import ssh
+from opennsa.backends import brocade, force10, junipervpls, pica8ovs
+
+from . import fakedevice
+
+
+USER = 'opennsa'
+PASSWORD = 'secret'
+
+
+class FakeDeviceTestMixin:
+
+    def setUp(self):
+        self.key_directory = tempfile.mkdtemp()
+        self.public_key, self.private_key = fakedevice.createClientKey(self.key_directory)
+        self.device = self.createDevice()
+        self.port = self.device.listen()
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield ssh.closeConnectionPools()
+        yield self.device.stop()
+        shutil.rmtree(self.key_directory)
+
+
+    @defer.inlineCallbacks
+    def testSetupTeardown(self):
+
+        yield self.setupLink()
+        self.assertEquals(self.device.config, self.setup_config)
+
+        yield self.teardownLink()
+        self.assertEquals(self.device.config, [])
+        self.assertEquals(self.device.failures, 0)
+
+
+    @defer.inlineCallbacks
+    def testFailure(self):
+
+        # the device reports the error and keeps the session open, the backend must detect it
+        self.device.failNext()
+        yield self.failUnlessFailure(self.setupLink(), error.InternalNRMError)
+        self.assertEquals(self.device.config, [])
+        self.assertEquals(self.device.failures, 1)
+
+        # the device is still usable after a failure
+        yield self.setupLink()
+        self.assertEquals(self.device.config, self.setup_config)
+
+
+    @defer.inlineCallbacks
+    def testConcurrentSetups(self):
+
+        self.device.latency = 0.01
+        yield defer.gatherResults( [ self.setupLink(vlan) for vlan in (1780, 1781, 1782) ], consumeErrors=True)
+        self.assertEquals(self.device.commits, self.commits_per_link * 3)
+        self.assertEquals(self.device.sessions, 3)
+
+
+
+class BrocadeTest(FakeDeviceTestMixin, unittest.TestCase):
+
+    commits_per_link = 1
+    setup_config = [ 'vlan 1780', 'vlan 1780 name opennsa-1780', 'vlan 1780 tagged ethernet 1/1', 'vlan 1780 tagged ethernet 1/2' ]
+
+    def createDevice(self):
+        return fakedevice.FakeDevice(fakedevice.BROCADE, USER, enable_password=PASSWORD)
+
+    def sender(self):
+        return brocade.BrocadeCommandSender('127.0.0.1', self.port, self.device.fingerprint, USER, self.public_key, self.private_key, PASSWORD)
+
+    def setupLink(self, vlan=1780):
+        return self.sender().sendCommands( brocade._createSetupCommands('1/1.%i' % vlan, '1/2.%i' % vlan) )
+
+    def teardownLink(self, vlan=1780):
+        return self.sender().sendCommands( brocade._createTeardownCommands('1/1.%i' % vlan, '1/2.%i' % vlan) )
+
+
+
+class Force10Test(FakeDeviceTestMixin, unittest.TestCase):
+
+    commits_per_link = 1
+    setup_config = [ 'interface vlan 1780', 'interface vlan 1780 name opennsa-1780', 'interface vlan 1780 tagged te 0/1',
+                     'interface vlan 1780 tagged te 0/2', 'interface vlan 1780 no shutdown' ]
+
+    def createDevice(self):
+        return fakedevice.FakeDevice(fakedevice.FORCE10, USER, password=PASSWORD, enable_password=PASSWORD)
+
+    def sender(self):
+        creator = ssh.SSHConnectionCreator('127.0.0.1', self.port, [ self.device.fingerprint ], USER, password=PASSWORD)
+        return force10.Force10CommandSender(creator, PASSWORD)
+
+    def setupLink(self, vlan=1780):
+        return self.sender().sendCommands( force10._createSetupCommands('te 0/1.%i' % vlan, 'te 0/2.%i' % vlan) )
+
+    def teardownLink(self, vlan=1780):
+        return self.sender().sendCommands( force10._createTeardownCommands('te 0/1.%i' % vlan, 'te 0/2.%i' % vlan) )
+
+
+
+class JuniperVPLSTest(FakeDeviceTestMixin, unittest.TestCase):
+
+    commits_per_link = 1
+
+    def createDevice(self):
+        return fakedevice.FakeDevice(fakedevice.JUNOS, USER)
+
+    @property
+    def setup_config(self):
+        return [ cmd[4:] for cmd in self.sender().createSetupCommands('xe-0/0/1', 'xe-0/0/2', 1780, 'vpls-1780', '65000') ]
+
+    def sender(self):
+        return junipervpls.JuniperVPLSCommandSender('127.0.0.1', self.port, self.device.fingerprint, USER, self.public_key, self.private_key)
+
+    def setupLink(self, vlan=1780):
+        return self.sender().setupLink('xe-0/0/1', 'xe-0/0/2', vlan, 'vpls-%i' % vlan, '65000')
+
+    def teardownLink(self, vlan=1780):
+        return self.sender().teardownLink('xe-0/0/1', 'xe-0/0/2', vlan, 'vpls-%i' % vlan)
+
+
+
+class Pica8OVSTest(FakeDeviceTestMixin, unittest.TestCase):
+
+    commits_per_link = 4 # every ovs command is applied on its own
+    setup_config = [ 'port ge-1/1/1 trunk 1780', 'port ge-1/1/2 trunk 1780',
+                     'flow br0 in_port=129,dl_vlan=1780', 'flow br0 in_port=130,dl_vlan=1780' ]
+
+    def createDevice(self):
+        return fakedevice.FakeDevice(fakedevice.PICA8, USER)
+
+    def sender(self):
+        return pica8ovs.Pica8OVSCommandSender('127.0.0.1', self.port, self.device.fingerprint, USER, self.public_key, self.private_key, '127.0.0.1')
+
+    def setupLink(self, vlan=1780):
+        return self.sender().setupLink( pica8ovs.Pica8OVSTarget('ge-1/1/1', vlan), pica8ovs.Pica8OVSTarget('ge-1/1/2', vlan) )
+
+    def teardownLink(self, vlan=1780):
+        return self.sender().teardownLink( pica8ovs.Pica8OVSTarget('ge-1/1/1', vlan), pica8ovs.Pica8OVSTarget('ge-1/1/2', vlan) )
@@ -0,0 +1,105 @@
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from twisted.web import server
+
+from opennsa import config
+from opennsa.shared import modifiableresource
+from opennsa.discovery import fetcher
+from opennsa.protocols.shared import httpclient
+
+
+
+class FetcherTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.resource = modifiableresource.ModifiableResource('TestResource', 'application/xml')
+        self.resource.updateResource(b'<document/>')
+
+        self.port = reactor.listenTCP(0, server.Site(self.resource), interface='127.0.0.1')
+        url = 'http://127.0.0.1:%i/' % self.port.getHost().port
+
+        self.fetcher = fetcher.FetcherService(None, {}, [ config.Peer(url, 1) ], None)
+        self.documents = []
+        self.fetcher.gotDocument = lambda document, peer : self.documents.append(document) or True
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield httpclient.closeConnections()
+        yield self.port.stopListening()
+
+
+    @defer.inlineCallbacks
+    def testConditionalFetch(self):
+
+        ps = self.fetcher.peer_states[0]
+
+        yield self.fetcher._fetchPeer(ps)
+        self.failUnlessEqual(self.documents, [ b'<document/>' ])
+        self.failIfEqual(ps.etag, None)
+
+        # not modified, document should not be parsed again
+        yield self.fetcher._fetchPeer(ps)
+        self.failUnlessEqual(len(self.documents), 1)
+
+        # no validators, but same content, should not be parsed either
+        ps.etag = None
+        ps.last_modified = None
+        yield self.fetcher._fetchPeer(ps)
+        self.failUnlessEqual(len(self.documents), 1)
+
+        self.resource.updateResource(b'<document>updated</document>')
+        yield self.fetcher._fetchPeer(ps)
+        self.failUnlessEqual(self.documents, [ b'<document/>', b'<document>updated</document>' ])
+
+
+    def testPeerBackoff(self):
+
+        ps = self.fetcher.peer_states[0]
+
+        self.failUnlessEqual(self.fetcher._nextInterval(ps, True), fetcher.FETCH_INTERVAL_MIN)
+        self.failUnlessEqual(self.fetcher._nextInterval(ps, True), fetcher.FETCH_INTERVAL_MIN * 2)
+
+        self.failUnlessEqual(self.fetcher._nextInterval(ps, False), fetcher.FETCH_INTERVAL_MIN)
+        self.failUnlessEqual(self.fetcher._nextInterval(ps, False), fetcher.FETCH_INTERVAL_MIN * 2)
+        self.failUnlessEqual(ps.failures, 2)
+
+        for _ in range(20):
+            self.fetcher._nextInterval(ps, False)
+        self.failUnlessEqual(self.fetcher._nextInterval(ps, False), fetcher.FETCH_INTERVAL_MAX)
+
+        self.fetcher._nextInterval(ps, True)
+        self.failUnlessEqual(ps.failures, 0)
+
+
+    def testFetchWhileFetching(self):
+
+        ps = self.fetcher.peer_states[0]
+        self.fetcher.clock = clock = task.Clock()
+        self.fetcher.running = True
+
+        responses = []
+        def httpGet(url, headers, timeout, ctx_factory):
+            d = defer.Deferred()
+            responses.append(d)
+            return d
+        self.patch(fetcher.httpclient, 'httpGet', httpGet)
+
+        d1 = self.fetcher._fetchPeer(ps)
+        d2 = self.fetcher.fetchDocuments()
+        self.failUnlessEqual(len(responses), 1) # the fetch in progress is not started again
+
+        responses[0].callback( httpclient.HTTPResponse(200, {}, b'<document/>') )
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.failUnlessEqual(self.documents, [ b'<document/>' ])
+        self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
+
+        # a fetch replaces the scheduled one
+        self.fetcher.fetchDocuments()
+        responses[1].callback( httpclient.HTTPResponse(304, {}, b'') )
+        self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
+
+        self.fetcher._scheduleFetch(ps, 10)
+        self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
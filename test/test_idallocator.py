@@ -0,0 +1,59 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa import database
+
+
+class ConnectionIdAllocatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = 1000
+        self.requests = [] # deferreds for outstanding block reservations
+        self.patch(database, '_reserveIdBlock', self.reserveIdBlock)
+
+
+    def reserveIdBlock(self, block_size):
+        d = defer.Deferred()
+        self.requests.append( (d, block_size) )
+        return d
+
+
+    def completeRequest(self):
+        d, block_size = self.requests.pop(0)
+        self.counter += block_size
+        d.callback(self.counter)
+
+
+    def testBlockAllocation(self):
+
+        allocator = database.ConnectionIdAllocator(block_size=4, refill_threshold=1)
+
+        d1 = allocator.allocate()
+        d2 = allocator.allocate()
+        self.assertEquals(len(self.requests), 1) # only one reservation in flight
+
+        self.completeRequest()
+        self.assertEquals(self.successResultOf(d1), 1001)
+        self.assertEquals(self.successResultOf(d2), 1002)
+        self.assertEquals(self.requests, [])
+
+        self.assertEquals(self.successResultOf(allocator.allocate()), 1003)
+        self.assertEquals(len(self.requests), 1) # running low, next block is reserved ahead
+
+        self.counter += 10 # another process reserved a block
+        self.completeRequest()
+        ids = [ self.successResultOf(allocator.allocate()) for _ in range(3) ]
+        self.assertEquals(ids, [1004, 1015, 1016])
+
+
+    def testReservationFailure(self):
+
+        allocator = database.ConnectionIdAllocator(block_size=4)
+        d = allocator.allocate()
+        self.requests.pop(0)[0].errback(ValueError('database down'))
+        self.failureResultOf(d, ValueError)
+
+        d = allocator.allocate() # tries again
+        self.completeRequest()
+        self.assertEquals(self.successResultOf(d), 1001)
+
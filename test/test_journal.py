@@ -0,0 +1,58 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import journal, eventbus, state
+
+
+class JournalWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.fail_writes = False
+        self.patch(journal, '_insertRows', self.insertRows)
+
+        self.clock = task.Clock()
+        self.writer = journal.JournalWriter(flush_interval=2, batch_size=3, max_buffer=5)
+        self.writer.clock = self.clock
+
+
+    def insertRows(self, rows):
+        if self.fail_writes:
+            return defer.fail(IOError('database is gone'))
+        self.batches.append(rows)
+        return defer.succeed(None)
+
+
+    def record(self, n):
+        for i in range(n):
+            event = eventbus.StateEvent('conn-%i' % i, (state.RESERVE_START, state.RELEASED, state.CREATED),
+                                                       (state.RESERVE_CHECKING, state.RELEASED, state.CREATED), 1500000000 + i)
+            self.writer.record('service_connections', event)
+
+
+    def testBatchedFlush(self):
+
+        self.record(2)
+        self.assertEquals(self.batches, [])
+        self.clock.advance(2)
+        self.assertEquals( [ len(b) for b in self.batches ], [2] )
+        self.assertEquals(self.batches[0][0][:2], ('service_connections', 'conn-0') )
+
+        self.record(4) # batch size reached, flush right away
+        self.clock.advance(0)
+        self.assertEquals( [ len(b) for b in self.batches ], [2, 3, 1] )
+        self.assertEquals(self.writer.stats(), { 'buffered': 0, 'written': 6, 'dropped': 0 } )
+
+
+    def testFailedFlush(self):
+
+        self.fail_writes = True
+        self.record(7)
+        self.clock.advance(0)
+        self.assertEquals(self.writer.stats(), { 'buffered': 5, 'written': 0, 'dropped': 2 } )
+
+        self.fail_writes = False
+        self.clock.advance(2)
+        self.assertEquals( [ len(b) for b in self.batches ], [3, 2] )
+        self.assertEquals(self.batches[0][0][1], 'conn-2') # oldest events are dropped
+
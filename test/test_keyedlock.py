@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from opennsa.shared import keyedlock
+
+
+class KeyedLockTest(unittest.TestCase):
+
+
+    def testSerialisedPerKey(self):
+
+        locks = keyedlock.KeyedLock()
+        calls = []
+        d1, d2, d3 = defer.Deferred(), defer.Deferred(), defer.Deferred()
+
+        def op(name, d):
+            calls.append(name)
+            return d
+
+        r1 = locks.run('c1', op, 'c1-first',  d1)
+        r2 = locks.run('c1', op, 'c1-second', d2)
+        r3 = locks.run('c2', op, 'c2-first',  d3)
+
+        self.assertEquals(calls, ['c1-first', 'c2-first']) # different keys run concurrently
+
+        d1.callback('one')
+        self.assertEquals(calls, ['c1-first', 'c2-first', 'c1-second'])
+        self.assertEquals(self.successResultOf(r1), 'one')
+
+        d2.errback(ValueError('failed')) # a failure also releases the lock
+        self.failureResultOf(r2, ValueError)
+        self.assertFalse(locks.locked('c1'))
+
+        d3.callback(None)
+        self.assertEquals(len(locks), 0) # idle locks are removed
+
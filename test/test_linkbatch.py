@@ -0,0 +1,133 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa.backends.common import linkbatch
+
+
+
+class BatchConnectionManager:
+
+    def __init__(self):
+        self.sessions = [] # one entry per device session: list of commands
+
+    def createCommands(self, connection_id, source_target, dest_target, bandwidth):
+        if source_target == 'bad':
+            raise ValueError('Cannot create commands for %s' % connection_id)
+        return [ 'set %s %s-%s' % (connection_id, source_target, dest_target) ]
+
+    def sendCommands(self, commands):
+        self.sessions.append(commands)
+        return defer.succeed(None)
+
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+        return self.sendCommands(self.createCommands(connection_id, source_target, dest_target, bandwidth))
+
+    def teardownLink(self, connection_id, source_target, dest_target, bandwidth):
+        return self.sendCommands(self.createCommands(connection_id, source_target, dest_target, bandwidth))
+
+    def setupLinks(self, links):
+        return linkbatch.sendBatch(links, self.createCommands, self.sendCommands)
+
+    def teardownLinks(self, links):
+        return linkbatch.sendBatch(links, self.createCommands, self.sendCommands)
+
+
+class DirectConnectionManager:
+
+    def __init__(self):
+        self.sessions = []
+
+    def setupLink(self, connection_id, source_target, dest_target, bandwidth):
+        self.sessions.append( [ 'set %s %s-%s' % (connection_id, source_target, dest_target) ] )
+        return defer.succeed(None)
+
+
+
+class LinkBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cm = BatchConnectionManager()
+        self.clock = task.Clock()
+        self.batcher = linkbatch.LinkBatcher(self.cm, window=0.5)
+        self.batcher.clock = self.clock
+
+
+    def testBatchedSetup(self):
+
+        d1 = self.batcher.setupLink('c1', 'p1', 'p2', 100)
+        d2 = self.batcher.setupLink('c2', 'bad', 'p2', 100)
+        d3 = self.batcher.setupLink('c3', 'p3', 'p4', 100)
+        self.assertEquals(self.cm.sessions, [])
+
+        self.clock.advance(0.5)
+
+        self.assertEquals(self.cm.sessions, [ ['set c1 p1-p2', 'set c3 p3-p4'] ]) # one session
+        self.successResultOf(d1)
+        self.failureResultOf(d2, ValueError)
+        self.successResultOf(d3)
+
+
+    def testBatchFailure(self):
+
+        def failSend(commands):
+            self.cm.sessions.append(commands)
+            if any( 'reject' in cmd for cmd in commands ):
+                return defer.fail(IOError('commit failed'))
+            return defer.succeed(None)
+        self.cm.sendCommands = failSend
+
+        d1 = self.batcher.teardownLink('c1', 'p1', 'p2', 100)
+        d2 = self.batcher.teardownLink('c2', 'reject', 'p4', 100)
+        d3 = self.batcher.teardownLink('c3', 'p5', 'p6', 100)
+        self.clock.advance(0.5)
+
+        # the batch is rejected, then each link is sent on its own
+        self.assertEquals(self.cm.sessions, [ ['set c1 p1-p2', 'set c2 reject-p4', 'set c3 p5-p6'], ['set c1 p1-p2'], ['set c2 reject-p4'], ['set c3 p5-p6'] ])
+        self.successResultOf(d1)
+        self.failureResultOf(d2, IOError)
+        self.successResultOf(d3)
+
+
+    def testSetupLinksFailure(self):
+
+        def failLinks(links):
+            raise IOError('device unavailable')
+        self.cm.setupLinks = failLinks
+        self.cm.setupLink = lambda connection_id, source_target, dest_target, bandwidth : \
+            defer.fail(IOError('bad link')) if source_target == 'bad' else defer.succeed(None)
+
+        d1 = self.batcher.setupLink('c1', 'p1', 'p2', 100)
+        d2 = self.batcher.setupLink('c2', 'bad', 'p4', 100)
+        self.clock.advance(0.5)
+        self.successResultOf(d1)
+        self.failureResultOf(d2, IOError)
+
+
+    def testTeardownsBeforeSetups(self):
+
+        commits = []
+        def sendCommands(commands):
+            d = defer.Deferred()
+            commits.append( (commands, d) )
+            return d
+        self.cm.sendCommands = sendCommands
+
+        d1 = self.batcher.setupLink('c1', 'p1', 'p2', 100)
+        d2 = self.batcher.teardownLink('c2', 'p1', 'p3', 100)
+        self.clock.advance(0.5)
+
+        self.assertEquals( [ commands for commands, _ in commits ], [ ['set c2 p1-p3'] ] ) # setup waits for the teardown
+        commits[0][1].callback(None)
+        self.successResultOf(d2)
+        self.assertEquals( [ commands for commands, _ in commits ], [ ['set c2 p1-p3'], ['set c1 p1-p2'] ] )
+        commits[1][1].callback(None)
+        self.successResultOf(d1)
+
+
+    def testNoBatchInterface(self):
+
+        cm = DirectConnectionManager()
+        batcher = linkbatch.LinkBatcher(cm)
+        self.successResultOf( batcher.setupLink('c1', 'p1', 'p2', 100) ) # called directly, no window
+        self.assertEquals(cm.sessions, [ ['set c1 p1-p2'] ])
+
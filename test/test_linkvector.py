@@ -1,4 +1,5 @@
 from twisted.trial import unittest
+from twisted.internet import task
 
 from opennsa.topology import linkvector
 
@@ -135,3 +136,74 @@ class LinkVectorTest(unittest.TestCase):
         self.failUnlessEqual(self.rv.vector(BONAIRE_TOPO,  source=ARUBA_OJS_NET), (ARUBA_OJS_NET, 'san'))
         self.failUnlessEqual(self.rv.vector(BONAIRE_TOPO,  source=ARUBA_SAN_NET), (ARUBA_SAN_NET, 'bon'))
 
+
+
+    def testVectorCostChangeAndDelete(self):
+
+        self.rv = linkvector.LinkVector( [ LOCAL_TOPO ] )
+
+        self.rv.updateVector(LOCAL_TOPO,   ARUBA_PORT,   { ARUBA_TOPO : 1, CURACAO_TOPO : 2 } )
+        self.rv.updateVector(LOCAL_TOPO,   BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+        self.rv.updateVector(BONAIRE_TOPO, CURACAO_PORT, { CURACAO_TOPO : 2, DOMINCA_TOPO : 1 } )
+        self.rv.updateVector(CURACAO_TOPO, DOMINICA_PORT, { DOMINCA_TOPO : 4 } )
+
+        self.failUnlessEqual(self.rv.vector(CURACAO_TOPO, source=LOCAL_TOPO), (LOCAL_TOPO, ARUBA_PORT))
+        self.failUnlessEqual(self.rv.vector(DOMINCA_TOPO, source=LOCAL_TOPO), (LOCAL_TOPO, BONAIRE_PORT))
+
+        # curacao gets more expensive through aruba, route through bonaire instead
+        self.rv.updateVector(LOCAL_TOPO, ARUBA_PORT, { CURACAO_TOPO : 4 } )
+        self.failUnlessEqual(self.rv.vector(CURACAO_TOPO, source=LOCAL_TOPO), (LOCAL_TOPO, BONAIRE_PORT))
+        self.failUnlessEqual(self.rv.network_dist[LOCAL_TOPO][CURACAO_TOPO], 3)
+
+        self.rv.deleteVector(LOCAL_TOPO, BONAIRE_PORT)
+        self.failUnlessEqual(self.rv.vector(CURACAO_TOPO, source=LOCAL_TOPO), (LOCAL_TOPO, ARUBA_PORT))
+        self.failUnlessEqual(self.rv.vector(BONAIRE_TOPO, source=LOCAL_TOPO), (None, None))
+        self.failUnlessEqual(self.rv.vector(DOMINCA_TOPO, source=LOCAL_TOPO), (None, None)) # cost 8, over max cost
+
+
+    def testBatchedNotification(self):
+
+        updates = []
+        self.rv.callOnUpdate(updates.append)
+
+        with self.rv.batch():
+            self.rv.updateVector(LOCAL_TOPO, ARUBA_PORT,   { ARUBA_TOPO : 1 } )
+            self.rv.updateVector(ARUBA_TOPO, BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+            self.failUnlessEqual(updates, [])
+
+        self.failUnlessEqual(updates, [ set( [ ARUBA_TOPO, BONAIRE_TOPO ] ) ] )
+
+        # identical update, no change set
+        self.rv.updateVector(LOCAL_TOPO, ARUBA_PORT, { ARUBA_TOPO : 1 } )
+        self.failUnlessEqual(len(updates), 1)
+
+
+    def testDelayedNotification(self):
+
+        clock = task.Clock()
+        self.rv = linkvector.LinkVector( [ LOCAL_TOPO ], notify_delay=1 )
+        self.rv.clock = clock
+
+        updates = []
+        self.rv.callOnUpdate(updates.append)
+
+        self.rv.updateVector(LOCAL_TOPO, ARUBA_PORT,   { ARUBA_TOPO : 1 } )
+        self.rv.updateVector(ARUBA_TOPO, BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+        self.rv.updateVector(ARUBA_TOPO, CURACAO_PORT, { CURACAO_TOPO : 1 } )
+        self.rv.deleteVector(ARUBA_TOPO, CURACAO_PORT)
+        self.failUnlessEqual(updates, [])
+
+        clock.advance(1)
+        self.failUnlessEqual(updates, [ set( [ ARUBA_TOPO, BONAIRE_TOPO ] ) ] )
+
+
+    def testNoSubscribers(self):
+
+        # nothing is recorded when there is no one to notify
+        self.rv.updateVector(LOCAL_TOPO, ARUBA_PORT, { ARUBA_TOPO : 1 } )
+        self.failUnlessEqual(self.rv._snapshot, None)
+
+        updates = []
+        self.rv.callOnUpdate(updates.append)
+        self.rv.updateVector(ARUBA_TOPO, BONAIRE_PORT, { BONAIRE_TOPO : 1 } )
+        self.failUnlessEqual(updates, [ set( [ BONAIRE_TOPO ] ) ] )
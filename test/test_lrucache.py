@@ -0,0 +1,70 @@
+import gc
+
+from twisted.trial import unittest
+
+from opennsa.shared import lrucache
+
+
+class Value:
+
+    def __init__(self, name):
+        self.name = name
+
+
+
+class LRUCacheTest(unittest.TestCase):
+
+
+    def testEviction(self):
+
+        cache = lrucache.LRUCache(2)
+        cache.put('a', Value('a'))
+        cache.put('b', Value('b'))
+
+        self.assertEquals(cache.get('a').name, 'a') # a is now most recently used
+        cache.put('c', Value('c'))
+        gc.collect()
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+        self.assertEquals(len(cache), 2)
+
+        cache.evict('a')
+        cache.evict('x') # not there, no error
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.stats(), { 'size': 1, 'in_use': 0, 'hits': 1, 'misses': 1, 'evictions': 1 } )
+
+
+    def testInUseNotDropped(self):
+
+        cache = lrucache.LRUCache(1)
+        a = Value('a')
+        cache.put('a', a)
+        cache.put('b', Value('b')) # a is evicted, but still referenced
+
+        self.assertIn('a', cache)
+        self.assertIdentical(cache.get('a'), a) # same object, no second copy
+        self.assertEquals(cache.stats()['size'], 1)
+
+        # b has now been evicted, and is not referenced anywhere
+        gc.collect()
+        self.assertNotIn('b', cache)
+        self.assertEquals(cache.get('b'), None)
+
+        del a
+        cache.put('c', Value('c'))
+        gc.collect()
+        self.assertNotIn('a', cache)
+        self.assertEquals(len(cache), 1)
+
+
+    def testCompositeKey(self):
+
+        cache = lrucache.LRUCache(10)
+        cache.put( ('urn:ogf:network:a:nsa', 'conn-1'), Value('A'))
+        cache.put( ('urn:ogf:network:b:nsa', 'conn-1'), Value('B'))
+
+        self.assertEquals(cache.get( ('urn:ogf:network:a:nsa', 'conn-1') ).name, 'A')
+        self.assertEquals(cache.get( ('urn:ogf:network:b:nsa', 'conn-1') ).name, 'B')
+
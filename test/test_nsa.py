@@ -50,6 +50,30 @@ class LabelTest(unittest.TestCase):
         self.failUnlessRaises(nsa.EmptyLabelSet, nsa.Label('', '1781-1784').intersect, nsa.Label('', '1780-1780') )
 
 
+    def testLabelSetOperations(self):
+
+        l1_10  = nsa.Label('', '1-10')
+        l5_20  = nsa.Label('', '5-8,12-20')
+
+        self.assertEquals( l1_10.union(l5_20).values,       [ (1,10), (12,20) ] )
+        self.assertEquals( l1_10.difference(l5_20).values,  [ (1,4), (9,10) ] )
+        self.assertEquals( l5_20.difference(l1_10).values,  [ (12,20) ] )
+        self.assertEquals( l1_10.union(nsa.Label('', 11)).values, [ (1,11) ] )
+
+        self.assertRaises(nsa.EmptyLabelSet, l1_10.difference, nsa.Label('', '1-20'))
+
+        self.failUnless( 6 in l5_20 )
+        self.failIf(     9 in l5_20 )
+        self.failUnless( 20 in l5_20 )
+        self.failIf(     21 in l5_20 )
+
+        self.assertEquals( l5_20.count(), 13 )
+        self.assertEquals( list(l5_20.iterValues())[:5], [ 5,6,7,8,12 ] )
+
+        self.failUnless( nsa.Label.canMatch(l1_10, l5_20) )
+        self.failIf(     nsa.Label.canMatch(nsa.Label('', '9-11'), l5_20) )
+
+
     def testNetworkServiceAgent(self):
 
         agent = nsa.NetworkServiceAgent('id', 'http://localhost:8888')
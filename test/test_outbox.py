@@ -0,0 +1,141 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task, error
+from twisted.web.error import Error as WebError
+
+from opennsa.protocols.shared import outbox
+
+
+URL_A = 'http://requester-a.example.org/nsi'
+URL_B = 'http://requester-b.example.org/nsi'
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stored = {}        # id -> (url, action, payload)
+        self.deliveries = []    # (url, payload, Deferred)
+        self.next_id = 1
+
+        self.patch(outbox, '_storeMessage', self.storeMessage)
+        self.patch(outbox, '_deleteMessage', self.deleteMessage)
+        self.patch(outbox, '_loadMessages', self.loadMessages)
+        self.patch(outbox, '_deliver', self.deliver)
+
+        self.clock = task.Clock()
+        self.outbox = outbox.Outbox(max_age=100)
+        self.outbox.clock = self.clock
+
+
+    def storeMessage(self, requester_url, soap_action, payload):
+        message_id = self.next_id
+        self.next_id += 1
+        self.stored[message_id] = (requester_url, soap_action, payload)
+        return defer.succeed(message_id)
+
+    def deleteMessage(self, message_id):
+        del self.stored[message_id]
+        return defer.succeed(None)
+
+    def loadMessages(self):
+        return defer.succeed( [ (mid, url, action, payload, 10) for mid, (url, action, payload) in sorted(self.stored.items()) ] )
+
+    def deliver(self, requester_url, soap_action, payload, ctx_factory):
+        d = defer.Deferred()
+        self.deliveries.append( (requester_url, payload, d) )
+        return d
+
+
+    def testOrderedPerRequester(self):
+
+        d = self.outbox.send(URL_A, 'action', b'a1')
+        self.assertTrue(d.called) # stored, not delivered
+        self.outbox.send(URL_A, 'action', b'a2')
+        self.outbox.send(URL_B, 'action', b'b1')
+
+        # one message at the time per requester, requesters in parallel
+        self.assertEquals( [ (url, payload) for url, payload, _ in self.deliveries ], [ (URL_A, b'a1'), (URL_B, b'b1') ] )
+
+        self.deliveries[0][2].callback(None)
+        self.assertEquals(self.deliveries[2][:2], (URL_A, b'a2') )
+        self.assertEquals(sorted(self.stored), [2, 3])
+
+        self.deliveries[1][2].callback(None)
+        self.deliveries[2][2].callback(None)
+        self.assertEquals(self.stored, {})
+        self.assertEquals(self.outbox.stats(), { 'queued': 0, 'requesters': 0, 'delivered': 3, 'dropped': 0 } )
+
+
+    def testRetry(self):
+
+        self.outbox.send(URL_A, 'action', b'a1')
+        self.outbox.send(URL_A, 'action', b'a2')
+
+        self.deliveries[0][2].errback(error.ConnectionRefusedError())
+        self.assertEquals(len(self.deliveries), 1)
+
+        self.clock.advance(outbox.RETRY_INITIAL)
+        self.assertEquals(self.deliveries[1][:2], (URL_A, b'a1') )
+        self.deliveries[1][2].errback(error.TimeoutError())
+
+        self.clock.advance(outbox.RETRY_INITIAL)
+        self.assertEquals(len(self.deliveries), 2) # backoff
+        self.clock.advance(outbox.RETRY_INITIAL)
+        self.assertEquals(self.deliveries[2][:2], (URL_A, b'a1') )
+
+        self.deliveries[2][2].callback(None)
+        self.assertEquals(self.deliveries[3][:2], (URL_A, b'a2') )
+
+
+    def testDrop(self):
+
+        self.outbox.send(URL_A, 'action', b'a1')
+        self.outbox.send(URL_A, 'action', b'a2')
+
+        # soap fault, the requester will not accept it
+        self.deliveries[0][2].errback(WebError(b'500', response=b'fault'))
+        self.assertEquals(self.deliveries[1][:2], (URL_A, b'a2') )
+
+        # cannot be delivered within max age
+        attempts = 0
+        while self.outbox.stats()['queued']:
+            self.deliveries[-1][2].errback(error.ConnectionRefusedError())
+            attempts += 1
+            for call in self.clock.getDelayedCalls():
+                self.clock.advance(call.getTime() - self.clock.seconds())
+
+        self.assertEquals(attempts, 6) # retried after 2, 4, 8, 16, 32 seconds, 64 more would be too late
+
+        self.assertEquals(self.stored, {})
+        self.assertEquals(self.outbox.stats()['dropped'], 2)
+
+
+    def testRestart(self):
+
+        self.outbox.send(URL_A, 'action', b'a1')
+        self.outbox.send(URL_B, 'action', b'b1')
+        self.outbox.stop()
+
+        # delivery in flight when stopped, the message is kept, and delivered again after the restart
+        self.deliveries[0][2].callback(None)
+        self.assertEquals(sorted(self.stored), [1, 2])
+        self.assertEquals(self.outbox.stats()['delivered'], 0)
+
+        # the same process, a message is sent while the stored messages are loaded
+        self.outbox = outbox.Outbox()
+        self.outbox.clock = self.clock
+        load_d = defer.Deferred()
+        self.patch(outbox, '_loadMessages', lambda : load_d)
+
+        started = self.outbox.start()
+        self.outbox.send(URL_A, 'action', b'a2')
+        self.assertEquals(len(self.deliveries), 2) # nothing is delivered before the stored messages are loaded
+
+        self.loadMessages().chainDeferred(load_d)
+        self.successResultOf(started)
+
+        # stored messages are delivered before newer ones
+        self.assertEquals( [ (url, payload) for url, payload, _ in self.deliveries[2:] ], [ (URL_A, b'a1'), (URL_B, b'b1') ] )
+        self.deliveries[2][2].callback(None)
+        self.assertEquals(self.deliveries[4][:2], (URL_A, b'a2') )
+        self.assertEquals(sorted(self.stored), [2, 3])
+        self.assertEquals(self.outbox.stats()['queued'], 2)
@@ -0,0 +1,60 @@
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.shared import pendingcalls
+
+
+class PendingCallsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = pendingcalls.PendingCalls(ttl=60)
+        self.calls.clock = self.clock
+
+
+    def testOutstanding(self):
+
+        self.calls.add('c1', 'conn-a', 'info-1')
+        self.calls.add('c2', 'conn-a', 'info-2')
+        self.calls.add('c3', 'conn-b', 'info-3')
+
+        self.assertIn('c1', self.calls)
+        self.assertEquals(self.calls['c2'], 'info-2')
+        self.assertEquals(self.calls.group('c2'), 'conn-a')
+        self.assertEquals(self.calls.outstanding('conn-a'), 2)
+
+        self.assertEquals(self.calls.pop('c1'), 'info-1')
+        self.assertNotIn('c1', self.calls)
+        self.assertEquals(self.calls.outstanding('conn-a'), 1)
+        self.assertRaises(KeyError, self.calls.pop, 'c1')
+
+        self.calls.pop('c2')
+        self.assertEquals(self.calls.outstanding('conn-a'), 0)
+        self.assertEquals(self.calls.outstanding('conn-b'), 1)
+        self.assertEquals(self.calls.stats(), { 'pending': 1, 'groups': 1, 'expired': 0 } )
+
+
+    def testDuplicate(self):
+
+        self.calls.add('c1', 'conn-a', 'info-1')
+        self.assertRaises(ValueError, self.calls.add, 'c1', 'conn-a', 'info-1')
+        self.assertEquals(self.calls.outstanding('conn-a'), 1)
+
+
+    def testExpiry(self):
+
+        self.calls.add('c1', 'conn-a', 'info-1')
+        self.clock.advance(30)
+        self.calls.add('c2', 'conn-a', 'info-2')
+        self.clock.advance(30)
+
+        self.calls.add('c3', 'conn-b', 'info-3')
+        self.assertNotIn('c1', self.calls)
+        self.assertIn('c2', self.calls)
+        self.assertEquals(self.calls.outstanding('conn-a'), 1)
+
+        self.clock.advance(60)
+        self.calls.expire()
+        self.assertEquals(len(self.calls), 0)
+        self.assertEquals(self.calls.outstanding('conn-a'), 0)
+        self.assertEquals(self.calls.stats(), { 'pending': 0, 'groups': 0, 'expired': 3 } )
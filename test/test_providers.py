@@ -7,6 +7,7 @@ from twisted.internet import reactor, defer, task
 from opennsa import nsa, provreg, database, error, setup, aggregator, config, plugin, constants as cnt
 from opennsa.topology import nrm, linkvector, nml
 from opennsa.backends import dud
+from opennsa.protocols.shared import httpclient
 
 from . import topology, common, db
 
@@ -1034,6 +1035,8 @@ class RemoteProviderTest(GenericProviderTest, unittest.TestCase):
         self.backend.stopService()
         self.provider_service.stopService()
         self.requester_iport.stopListening()
+        # the soap requests use persistent connections, close them so the reactor is clean
+        yield httpclient.closeConnections()
 
         from opennsa.backends.common import genericbackend
         # keep it simple...
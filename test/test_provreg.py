@@ -1,4 +1,7 @@
 from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectionRefusedError
+from twisted.web.error import Error as WebError
 
 from opennsa import constants as cnt, error, nsa, provreg
 
@@ -69,3 +72,114 @@ class TestProviderRegistry(unittest.TestCase):
         provider = self.pr.getProvider('testnetwork_a2')
         self.failUnlessEqual(provider, fake_provider_a2)
 
+
+
+
+class FakeProvider:
+
+    def __init__(self):
+        self.calls = []     # (connection_id, Deferred)
+
+    def urn(self):
+        return 'urn:ogf:network:fake:nsa'
+
+    def reserveCommit(self, header, connection_id, request_info=None):
+        d = defer.Deferred()
+        self.calls.append( (connection_id, d) )
+        return d
+
+
+
+class TestProviderDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = FakeProvider()
+        self.clock = task.Clock()
+        self.dispatcher = provreg.ProviderDispatcher(self.provider, self.provider.urn(), max_concurrent=2, failure_threshold=2, open_time=10)
+        self.dispatcher.clock = self.clock
+
+
+    def call(self, connection_id):
+        return self.dispatcher.reserveCommit(None, connection_id)
+
+
+    def testPassThrough(self):
+
+        self.failUnlessEqual(self.dispatcher.urn(), self.provider.urn())
+
+
+    def testConcurrencyLimit(self):
+
+        ds = [ self.call('conn-%i' % i) for i in range(3) ]
+        self.failUnlessEqual( [ cid for cid, _ in self.provider.calls ], [ 'conn-0', 'conn-1' ] )
+        self.failUnlessEqual(self.dispatcher.stats()['queued'], 1)
+
+        self.provider.calls[0][1].callback('ok')
+        self.failUnlessEqual( [ cid for cid, _ in self.provider.calls ], [ 'conn-0', 'conn-1', 'conn-2' ] )
+        self.failUnlessEqual(self.successResultOf(ds[0]), 'ok')
+
+
+    def testCircuitOpens(self):
+
+        ds = [ self.call('conn-%i' % i) for i in range(4) ]
+        self.provider.calls[1][1].errback(error.CallbackTimeoutError('no reply'))
+        self.provider.calls[0][1].errback(error.DownstreamNSAUnreachableError('not reachable'))
+        self.failureResultOf(ds[0], error.DownstreamNSAError)
+        self.failureResultOf(ds[1], error.CallbackTimeoutError)
+
+        # the call queued when the circuit opened fails without reaching the provider, as do new calls
+        self.failUnlessEqual( [ cid for cid, _ in self.provider.calls ], [ 'conn-0', 'conn-1', 'conn-2' ] )
+        self.failureResultOf(ds[3], error.DownstreamNSAError)
+        self.failureResultOf(self.call('conn-4'), error.DownstreamNSAError)
+        self.failUnlessEqual(len(self.provider.calls), 3)
+        self.failUnlessEqual(self.dispatcher.stats()['rejected'], 2)
+
+        self.provider.calls[2][1].callback('ok')
+        self.successResultOf(ds[2])
+
+
+    def testCircuitRecovers(self):
+
+        for i in range(2):
+            d = self.call('conn-%i' % i)
+            self.provider.calls[-1][1].errback(ConnectionRefusedError())
+            self.failureResultOf(d)
+
+        # a single trial call, which fails, keeping the circuit open
+        self.clock.advance(10)
+        d = self.call('conn-2')
+        self.failureResultOf(self.call('conn-3'), error.DownstreamNSAError)
+        self.provider.calls[-1][1].errback(WebError(b'503'))
+        self.failureResultOf(d)
+        self.failureResultOf(self.call('conn-4'), error.DownstreamNSAError)
+
+        # trial call succeeds, circuit closes
+        self.clock.advance(10)
+        d = self.call('conn-5')
+        self.provider.calls[-1][1].callback('ok')
+        self.successResultOf(d)
+        self.call('conn-6')
+        self.failUnlessEqual(self.provider.calls[-1][0], 'conn-6')
+        self.failIf(self.dispatcher.stats()['open'])
+
+
+    def testNSIErrorsDoesNotOpenCircuit(self):
+
+        for i in range(3):
+            d = self.call('conn-%i' % i)
+            self.provider.calls[-1][1].errback(error.ConnectionCreateError('invalid request'))
+            self.failureResultOf(d, error.ConnectionCreateError)
+
+        # a reachable aggregator, replying that one of its children is down
+        for i in range(3):
+            d = self.call('conn-%i' % i)
+            self.provider.calls[-1][1].errback(error.DownstreamNSAError('child not reachable'))
+            self.failureResultOf(d, error.DownstreamNSAError)
+
+        d = self.call('conn-fault')
+        self.provider.calls[-1][1].errback(WebError(b'500', response=b'fault'))
+        self.failureResultOf(d, WebError)
+
+        self.call('conn-3')
+        self.failUnlessEqual(len(self.provider.calls), 8)
+        self.failUnlessEqual(self.dispatcher.stats()['failures'], 0)
@@ -0,0 +1,83 @@
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from opennsa.shared import keyedlock
+from opennsa.backends.common import scheduler
+
+
+class CallSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.scheduler = scheduler.CallScheduler()
+        self.scheduler.clock = self.clock
+        self.calls = []
+
+
+    def schedule(self, connection_id, seconds):
+        transition_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+        self.scheduler.scheduleCall(connection_id, transition_time, self.calls.append, connection_id)
+
+
+    def testBatchedCalls(self):
+
+        self.schedule('c1', 20)
+        self.schedule('c2', 10)
+        self.schedule('c3', 10)
+        self.schedule('c4', 30)
+
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+        self.assertEquals(self.scheduler.stats()['pending'], 4)
+
+        self.clock.advance(11)
+        self.assertEquals(self.calls, ['c2', 'c3'])
+        self.assertFalse(self.scheduler.hasScheduledCall('c2'))
+        self.assertEquals(len(self.clock.getDelayedCalls()), 1)
+
+        self.clock.advance(20)
+        self.assertEquals(self.calls, ['c2', 'c3', 'c1', 'c4'])
+        self.assertEquals(self.scheduler.stats()['pending'], 0)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def testCancelAndReschedule(self):
+
+        self.schedule('c1', 10)
+        self.schedule('c2', 20)
+
+        self.scheduler.cancelCall('c1')
+        self.scheduler.cancelCall('c3') # not scheduled, no error
+        self.schedule('c1', 30)
+
+        self.clock.advance(25)
+        self.assertEquals(self.calls, ['c2'])
+
+        self.clock.advance(10)
+        self.assertEquals(self.calls, ['c2', 'c1'])
+
+        self.schedule('c1', 10)
+        self.scheduler.cancelAllCalls()
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        self.assertFalse(self.scheduler.hasScheduledCall('c1'))
+
+
+    def testLockedCalls(self):
+
+        locks = keyedlock.KeyedLock()
+        self.scheduler = scheduler.CallScheduler(locks)
+        self.scheduler.clock = self.clock
+
+        self.schedule('c1', 10)
+        self.schedule('c2', 10)
+
+        locks.acquire('c1') # c1 is busy, e.g., with a request
+        self.clock.advance(11)
+        self.assertEquals(self.calls, ['c2'])
+
+        self.scheduler.cancelCall('c1') # the request cancels the call, while it is waiting for the lock
+        locks.release('c1')
+        self.assertEquals(self.calls, ['c2'])
+        self.assertEquals(len(locks), 0)
+
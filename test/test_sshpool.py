@@ -0,0 +1,196 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa.backends.common import ssh
+
+
+
+class FakeTransport:
+
+    def __init__(self, ssh_connection):
+        self.ssh_connection = ssh_connection
+
+    def loseConnection(self):
+        self.ssh_connection.lost()
+
+
+
+class FakeSSHConnection:
+
+    def __init__(self):
+        self.transport = FakeTransport(self)
+        self.ssh_connection_lost_d = defer.Deferred()
+        self.channels = []
+        self.global_requests = []
+        self.fail_open = False
+
+    def openChannel(self, channel):
+        self.channels.append(channel)
+        if self.fail_open:
+            channel.channel_open.errback(ValueError('channel refused'))
+        else:
+            channel.channel_open.callback(channel)
+
+    def sendGlobalRequest(self, request, data, wantReply=0):
+        d = defer.Deferred()
+        self.global_requests.append(d)
+        return d
+
+    def lost(self):
+        if not self.ssh_connection_lost_d.called:
+            self.ssh_connection_lost_d.callback(self)
+
+
+
+class FakeChannel:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.channel_open = defer.Deferred()
+        self.closed = False
+
+    def closeIt(self):
+        self.closed = True
+
+
+
+class FakeConnectionCreator:
+
+    host = 'switch.example.org'
+    port = 22
+    username = 'opennsa'
+
+    def __init__(self):
+        self.connections = []
+
+    def getSSHConnection(self):
+        c = FakeSSHConnection()
+        self.connections.append(c)
+        return defer.succeed(c)
+
+
+
+class SSHConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.creator = FakeConnectionCreator()
+        self.pool = ssh.SSHConnectionPool(self.creator, max_channels=2, idle_timeout=100, keepalive_interval=30, command_timeout=60)
+        self.clock = task.Clock()
+        self.pool.clock = self.clock
+
+
+    def testChannelsShareConnection(self):
+
+        commands = [ defer.Deferred() for _ in range(3) ]
+        results = [ self.pool.runChannel(FakeChannel, lambda channel, d: d, d) for d in commands ]
+
+        self.assertEquals(len(self.creator.connections), 1)
+        self.assertEquals(len(self.creator.connections[0].channels), 2) # third waits for a channel
+
+        commands[0].callback('done')
+        self.assertEquals(self.successResultOf(results[0]), 'done')
+        self.assertEquals(len(self.creator.connections[0].channels), 3)
+
+        commands[1].callback(None)
+        commands[2].callback(None)
+        self.assertEquals(self.pool.stats()['open_channels'], 0)
+
+
+    def testReconnect(self):
+
+        self.successResultOf( self.pool.runChannel(FakeChannel, lambda channel: None) )
+        self.creator.connections[0].fail_open = True # device closed the connection while idle
+
+        self.successResultOf( self.pool.runChannel(FakeChannel, lambda channel: None) )
+        self.assertEquals(len(self.creator.connections), 2)
+
+        self.creator.connections[1].lost()
+        self.successResultOf( self.pool.runChannel(FakeChannel, lambda channel: None) )
+        self.assertEquals(len(self.creator.connections), 3)
+
+
+    def testKeepaliveAndIdle(self):
+
+        self.successResultOf( self.pool.runChannel(FakeChannel, lambda channel: None) )
+        conn = self.creator.connections[0]
+
+        self.clock.advance(30)
+        self.assertEquals(len(conn.global_requests), 1)
+        conn.global_requests[0].callback(None)
+
+        self.clock.advance(30)
+        self.assertEquals(len(conn.global_requests), 2)
+        conn.global_requests[1].callback(None)
+
+        self.clock.advance(60) # idle for 120 seconds
+        self.assertTrue(conn.ssh_connection_lost_d.called)
+        self.assertFalse(self.pool.stats()['connected'])
+
+
+    def testKeepaliveTimeout(self):
+
+        self.successResultOf( self.pool.runChannel(FakeChannel, lambda channel: None) )
+        conn = self.creator.connections[0]
+
+        self.clock.advance(30)
+        self.clock.advance(30) # no reply
+        self.assertTrue(conn.ssh_connection_lost_d.called)
+        self.assertFalse(self.pool.stats()['connected'])
+
+
+    def testCommandTimeout(self):
+
+        hung = [ self.pool.runChannel(FakeChannel, lambda channel: defer.Deferred()) for _ in range(2) ] # prompts never come
+        waiting = self.pool.runChannel(FakeChannel, lambda channel: 'done')
+        self.assertNoResult(waiting)
+
+        self.clock.advance(60)
+        for d in hung:
+            self.failureResultOf(d, defer.TimeoutError)
+        self.assertEquals(self.successResultOf(waiting), 'done')
+
+        channels = self.creator.connections[0].channels
+        self.assertTrue(channels[0].closed)
+        self.assertTrue(channels[1].closed)
+        self.assertFalse(channels[2].closed)
+        self.assertEquals(self.pool.stats()['channels_timed_out'], 2)
+        self.assertEquals(self.pool.stats()['open_channels'], 0)
+
+
+    def testChannelClosedOnFailure(self):
+
+        def fail(channel):
+            raise ValueError('unexpected device output')
+
+        self.failureResultOf( self.pool.runChannel(FakeChannel, fail), ValueError)
+        self.assertTrue(self.creator.connections[0].channels[0].closed)
+
+
+
+class ConnectionPoolRegistryTest(unittest.TestCase):
+
+    def tearDown(self):
+        return ssh.closeConnectionPools()
+
+
+    def testSharedPool(self):
+
+        pool = ssh.getConnectionPool(FakeConnectionCreator(), 1)
+        self.assertIdentical(ssh.getConnectionPool(FakeConnectionCreator(), 1), pool)
+        self.assertIdentical(ssh.getConnectionPool(FakeConnectionCreator(), 4), pool) # logged, first limit is kept
+        self.assertEquals(pool.max_channels, 1)
+
+
+    def testCloseWaitsForConnections(self):
+
+        creator = FakeConnectionCreator()
+        pool = ssh.getConnectionPool(creator, 1)
+        self.successResultOf( pool.getConnection() )
+        ssh_connection = creator.connections[0]
+        ssh_connection.transport.loseConnection = lambda : None # closing takes a while
+
+        d = ssh.closeConnectionPools()
+        self.assertNoResult(d)
+        ssh_connection.lost()
+        self.successResultOf(d)
+        self.assertIdentical(pool.ssh_connection, None)
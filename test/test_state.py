@@ -0,0 +1,83 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from opennsa import state, eventbus
+
+
+class Connection:
+    # stand-in for the database objects, counts saves
+
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.reservation_state = state.RESERVE_START
+        self.provision_state = state.RELEASED
+        self.lifecycle_state = state.CREATED
+        self.saves = 0
+
+    def save(self):
+        self.saves += 1
+        return defer.succeed(self)
+
+    def tablename(self):
+        return 'test_connections'
+
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        state.BUS.clock = self.clock
+        self.events = []
+        self.subscription = state.subscribe('conn-1', self.events.append)
+
+    def tearDown(self):
+        self.subscription.cancel()
+        state.BUS.clock = eventbus.reactor
+
+
+    @defer.inlineCallbacks
+    def testCoalescedTransitions(self):
+
+        conn = Connection('conn-1')
+
+        state.coalesce(conn)
+        yield state.provisioning(conn)
+        yield state.provisioned(conn)
+        self.assertEquals(conn.saves, 0)
+
+        yield state.commit(conn)
+        self.assertEquals(conn.saves, 1)
+        self.assertEquals(self.events, []) # delivery is asynchronous
+
+        self.clock.advance(0)
+        self.assertEquals( [ (e.old_states[1], e.new_states[1]) for e in self.events ],
+                           [ (state.RELEASED, state.PROVISIONING), (state.PROVISIONING, state.PROVISIONED) ] )
+
+        yield state.releasing(conn) # no longer coalescing
+        self.assertEquals(conn.saves, 2)
+        self.clock.advance(0)
+        self.assertEquals(len(self.events), 3)
+
+
+    @defer.inlineCallbacks
+    def testSubscriptionRemoval(self):
+
+        conn = Connection('conn-1')
+        other_events = []
+        subscription = state.subscribe('conn-1', other_events.append)
+        self.assertEquals(state.BUS.subscriberCount('conn-1'), 2)
+
+        yield state.terminating(conn)
+        subscription.cancel() # cancelled before delivery, does not get the event
+        self.clock.advance(0)
+        self.assertEquals(len(self.events), 1)
+        self.assertEquals(other_events, [])
+        self.assertEquals(state.BUS.subscriberCount('conn-1'), 1)
+
+        yield state.terminated(conn)
+        self.assertEquals(state.BUS.subscriberCount('conn-1'), 0)
+        self.clock.advance(0)
+        self.assertEquals(len(self.events), 2) # subscribers get the terminated event
+        self.assertFalse(self.subscription.active)
+
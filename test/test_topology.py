@@ -218,3 +218,18 @@ class TopologyTest(unittest.TestCase):
 
     testNoAvailableBandwidth.skip = 'Bandwidth currently not available in path finding'
 
+
+
+
+class PortTest(unittest.TestCase):
+
+    def testCanMatchLabel(self):
+
+        port = nml.Port('ps-out', 'ps-out', LABEL)
+        self.failUnless(port.canMatchLabel( nsa.Label(cnt.ETHERNET_VLAN, '1700-1781') ))
+        self.failIf(port.canMatchLabel( nsa.Label(cnt.ETHERNET_VLAN, '1790-1799') ))
+        self.failIf(port.canMatchLabel(None))
+
+        unlabeled = nml.Port('ps-in', 'ps-in', None)
+        self.failUnless(unlabeled.canMatchLabel(None))
+        self.failIf(unlabeled.canMatchLabel(LABEL))